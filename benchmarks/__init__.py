@@ -0,0 +1 @@
+"""Offline benchmarks of goutte against a simulated DigitalOcean API"""
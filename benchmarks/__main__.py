@@ -0,0 +1,64 @@
+"""Benchmark command line interface
+
+    python -m benchmarks --droplets 500 --snapshots 20 --output bench.json
+"""
+import json
+import sys
+
+import click
+
+from benchmarks import harness
+
+
+@click.command(help='Benchmark goutte against a simulated DigitalOcean API.')
+@click.option('--droplets', type=click.IntRange(min=0), default=100,
+              help='Number of droplets')
+@click.option('--volumes', type=click.IntRange(min=0), default=0,
+              help='Number of volumes')
+@click.option('--snapshots', type=click.IntRange(min=0), default=10,
+              help='Number of existing snapshots per resource')
+@click.option('--retention', type=click.IntRange(min=1), default=5,
+              help='Number of snapshots to keep')
+@click.option('--latency', type=float, default=0,
+              help='Seconds of latency per request')
+@click.option('--throttle', type=click.FloatRange(0, 1), default=0,
+              help='Share of requests answered with a 429')
+@click.option('--concurrency', type=click.IntRange(min=1), default=1,
+              help='Resources processed in parallel')
+@click.option('--engine', type=click.Choice(['sync', 'async']),
+              default='sync', help='Engine used to call the API')
+@click.option('--wait', is_flag=True, help='Wait for the snapshots')
+@click.option('--provider', type=click.Choice(['api', 'memory']),
+              default='api', help='Serve the account over the fake HTTP '
+                                  'API or from memory (sync engine only)')
+@click.option('--seed', type=int, default=0, help='Random seed')
+@click.option('--output', type=click.File('w'), default='-',
+              help='Write the json result to a file')
+@click.option('--baseline', type=click.File('r'),
+              help='Fail when regressing from a json result')
+@click.option('--time-tolerance', type=float,
+              help='Allowed wall time regression from the baseline (0.5 '
+                   'for 50%), not compared by default')
+@click.option('--verbose', is_flag=True, help='Keep the goutte logs')
+def entrypoint(baseline: click.File, output: click.File,
+               time_tolerance: float, **params) -> None:
+    """Benchmark command line interface entrypoint"""
+    if params['provider'] == 'memory' and params['engine'] != 'sync':
+        raise click.UsageError('--provider memory needs the sync engine')
+    result = harness.run(**params)
+    json.dump(result, output, indent=2)
+    output.write('\n')
+    if result['exit_code']:
+        click.echo(f'goutte exited with {result["exit_code"]}', err=True)
+        sys.exit(1)
+    if baseline:
+        tolerances = dict(harness.METRICS, wall_time=time_tolerance)
+        regressions = harness.compare(result, json.load(baseline),
+                                      tolerances)
+        for regression in regressions:
+            click.echo(f'Regression: {regression}', err=True)
+        sys.exit(1 if regressions else 0)
+
+
+if __name__ == '__main__':
+    entrypoint(prog_name='python -m benchmarks')
@@ -0,0 +1,215 @@
+"""In-process fake of the DigitalOcean v2 API for the benchmarks
+
+The fake generates an account of droplets and volumes with their goutte
+snapshots, answers the endpoints goutte uses with a configurable latency
+and rate limits a share of the requests.
+"""
+from datetime import datetime, timedelta
+from typing import Any, Dict, List, Optional, Tuple
+from urllib.parse import parse_qsl, urlencode, urlsplit
+import asyncio
+import itertools
+import json
+import random
+import threading
+import time
+
+import requests
+
+API_URL = 'https://api.digitalocean.com/v2/'
+
+Answer = Tuple[int, Dict[str, str], Any]
+
+
+class FakeApi:
+    """Simulated account answering the API requests"""
+
+    def __init__(self, droplets: int, volumes: int, snapshots: int,
+                 latency: float = 0, throttle: float = 0,
+                 seed: int = 0) -> None:
+        self.latency = latency
+        self.throttle = throttle
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+        self.ids = itertools.count(1)
+        self.calls = 0
+        self.throttled = 0
+        self.endpoints = {}  # type: Dict[str, int]
+        self.droplets = [{'id': next(self.ids), 'name': f'droplet{i}',
+                          'tags': [], 'snapshot_ids': [], 'features': [],
+                          'networks': {'v4': [], 'v6': []}}
+                         for i in range(droplets)]
+        self.volumes = [{'id': f'vol-{next(self.ids)}', 'name': f'volume{i}',
+                         'tags': []} for i in range(volumes)]
+        self.snapshots = {}  # type: Dict[str, Dict[str, Any]]
+        self.actions = {}  # type: Dict[int, Dict[str, Any]]
+        created = datetime(2019, 1, 1)
+        for resource in self.droplets + self.volumes:
+            for day in range(snapshots):
+                self.add_snapshot(resource, created + timedelta(days=day))
+
+    def names(self, kind: str) -> List[str]:
+        """Return the names of the droplets or volumes"""
+        return [resource['name'] for resource in getattr(self, kind)]
+
+    def add_snapshot(self, resource: Dict[str, Any],
+                     created: Optional[datetime] = None,
+                     name: Optional[str] = None) -> Dict[str, Any]:
+        """Add a snapshot of a resource to the account"""
+        created = created or datetime.utcnow()
+        snapshot = {
+            'id': str(next(self.ids)),
+            'name': name or 'goutte-{}-{}-{:05x}'.format(
+                resource['name'], created.strftime('%Y%m%d'),
+                self.random.getrandbits(20)),
+            'created_at': created.strftime('%Y-%m-%dT%H:%M:%SZ'),
+            'resource_id': str(resource['id']),
+            'resource_type': 'droplet' if 'snapshot_ids' in resource
+                             else 'volume',
+            'regions': ['sgp1'], 'min_disk_size': 10, 'size_gigabytes': 1,
+        }
+        self.snapshots[snapshot['id']] = snapshot
+        return snapshot
+
+    def handle(self, method: str, url: str,
+               body: Optional[Dict[str, Any]] = None) -> Answer:
+        """Answer a request with its status, headers and json body"""
+        parts = urlsplit(url)
+        path = parts.path.split('/v2/', 1)[1].strip('/').split('/')
+        query = dict(parse_qsl(parts.query))
+        endpoint = f'{method} {path[0]}' + ('/:id' if len(path) > 1 else '')
+        with self.lock:
+            self.calls += 1
+            self.endpoints[endpoint] = self.endpoints.get(endpoint, 0) + 1
+            headers = {'ratelimit-limit': '5000',
+                       'ratelimit-remaining': str(max(5000 - self.calls, 1)),
+                       'ratelimit-reset': str(int(time.time()) + 3600)}
+            if self.throttle and self.random.random() < self.throttle:
+                self.throttled += 1
+                return 429, headers, {'id': 'too_many_requests',
+                                      'message': 'API Rate limit exceeded.'}
+            status, data = self.route(method, path, query, body or {})
+        return status, headers, data
+
+    def route(self, method: str, path: List[str], query: Dict[str, str],
+              body: Dict[str, Any]) -> Tuple[int, Any]:
+        """Answer a request, the lock being held"""
+        if method == 'GET' and len(path) == 1:
+            items = getattr(self, path[0], None)
+            if path[0] == 'actions':
+                # Actions complete once they have been listed
+                items = [dict(action) for action in reversed(
+                    list(self.actions.values()))]
+                for action in self.actions.values():
+                    action['status'] = 'completed'
+            if isinstance(items, dict):
+                items = list(items.values())
+            if items is None:
+                return 404, {'id': 'not_found', 'message': 'Not found'}
+            if 'tag_name' in query:
+                items = [item for item in items
+                         if query['tag_name'] in item.get('tags', [])]
+            if 'resource_type' in query:
+                items = [item for item in items
+                         if item['resource_type'] == query['resource_type']]
+            return 200, self.page(path[0], items, query)
+        if method == 'GET' and path[0] == 'actions':
+            action = self.actions[int(path[1])]
+            action['status'] = 'completed'
+            return 200, {'action': dict(action)}
+        if method == 'POST' and path[0] == 'droplets':
+            droplet = self.find(self.droplets, path[1])
+            action = {'id': next(self.ids), 'status': 'in-progress',
+                      'type': 'snapshot', 'resource_id': droplet['id'],
+                      'resource_type': 'droplet'}
+            self.actions[action['id']] = action
+            self.add_snapshot(droplet, name=body['name'])
+            return 201, {'action': dict(action)}
+        if method == 'POST' and path[0] == 'volumes':
+            volume = self.find(self.volumes, path[1])
+            return 201, {'snapshot': self.add_snapshot(volume,
+                                                       name=body['name'])}
+        if method == 'DELETE' and path[0] == 'snapshots':
+            if self.snapshots.pop(path[1], None):
+                return 204, None
+        return 404, {'id': 'not_found', 'message': 'Not found'}
+
+    def page(self, key: str, items: List[Any],
+             query: Dict[str, str]) -> Dict[str, Any]:
+        """Return a page of a listing with its pagination links"""
+        page, per_page = int(query.get('page', 1)), int(
+            query.get('per_page', 20))
+        data = {key: items[(page - 1) * per_page:page * per_page],
+                'links': {}, 'meta': {'total': len(items)}}
+        if page * per_page < len(items):
+            data['links']['pages'] = {'next': API_URL + key + '?' + urlencode(
+                dict(query, page=page + 1, per_page=per_page))}
+        return data
+
+    @staticmethod
+    def find(resources: List[Dict[str, Any]],
+             resource_id: str) -> Dict[str, Any]:
+        """Return a resource by id"""
+        return next(resource for resource in resources
+                    if str(resource['id']) == resource_id)
+
+
+class FakeAdapter(requests.adapters.BaseAdapter):
+    """requests transport answering from the fake API"""
+
+    def __init__(self, api: FakeApi) -> None:
+        super().__init__()
+        self.api = api
+
+    def send(self, request: requests.PreparedRequest,
+             **kwargs: Any) -> requests.Response:
+        time.sleep(self.api.latency)
+        body = json.loads(request.body) if request.body else None
+        status, headers, data = self.api.handle(request.method, request.url,
+                                                body)
+        response = requests.Response()
+        response.status_code = status
+        response.headers.update(headers)
+        response._content = b'' if data is None else json.dumps(data).encode()
+        response.url = request.url
+        response.request = request
+        return response
+
+    def close(self) -> None:
+        pass
+
+
+class FakeAsyncResponse:
+    """aiohttp like response of the fake API"""
+
+    def __init__(self, api: FakeApi, method: str, url: str,
+                 body: Optional[Dict[str, Any]]) -> None:
+        self.api = api
+        self.args = (method, url, body)
+
+    async def __aenter__(self) -> 'FakeAsyncResponse':
+        await asyncio.sleep(self.api.latency)
+        self.status, self.headers, self.data = self.api.handle(*self.args)
+        return self
+
+    async def __aexit__(self, *args: Any) -> None:
+        pass
+
+    async def json(self) -> Any:
+        return self.data
+
+
+class FakeAsyncSession:
+    """aiohttp like session of the fake API"""
+
+    def __init__(self, api: FakeApi) -> None:
+        self.api = api
+
+    def request(self, method: str, url: str, params: Any = None,
+                json: Any = None, **kwargs: Any) -> FakeAsyncResponse:
+        if params:
+            url += ('&' if '?' in url else '?') + urlencode(params)
+        return FakeAsyncResponse(self.api, method, url, json)
+
+    async def close(self) -> None:
+        pass
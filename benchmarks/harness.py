@@ -0,0 +1,103 @@
+"""Run the goutte entrypoint against the fake API and measure it
+
+With the memory provider, the same account is served by the in-memory
+provider instead, without any HTTP nor JSON on the way.
+"""
+from typing import Any, Dict, List
+from unittest import mock
+import os
+import resource
+import sys
+import tempfile
+import time
+
+import requests
+import toml
+
+from benchmarks.fake_api import FakeAdapter, FakeApi, FakeAsyncSession
+from goutte import aio, logger, main
+from goutte.provider import Memory
+
+# Metrics compared against the baseline, with their default tolerance
+METRICS = {'api_calls': 0.0, 'calls_per_resource': 0.0, 'wall_time': None}
+
+
+def run(droplets: int = 100, volumes: int = 0, snapshots: int = 10,
+        retention: int = 5, latency: float = 0, throttle: float = 0,
+        concurrency: int = 1, engine: str = 'sync', wait: bool = False,
+        requests_per_minute: int = 10 ** 6, seed: int = 0,
+        provider: str = 'api', verbose: bool = False) -> Dict[str, Any]:
+    """Run goutte once against a fresh fake account, return the metrics"""
+    if provider == 'memory' and engine != 'sync':
+        raise ValueError('The memory provider only runs the sync engine')
+    api = FakeApi(droplets, volumes, snapshots, latency, throttle, seed)
+    conf = {'retention': retention, 'concurrency': concurrency,
+            'requests_per_minute': requests_per_minute,
+            'poll_interval': 0.05}
+    for kind in ('droplets', 'volumes'):
+        if api.names(kind):
+            conf[kind] = {'names': api.names(kind)}
+    main.inventory.clear()
+    main.cache = None
+    memory = None
+    if provider == 'memory':
+        memory = Memory(api.droplets, api.volumes, api.snapshots.values(),
+                        call=main._call)
+    main.shared_provider = memory
+    level = logger.level
+    if not verbose:
+        logger.setLevel('WARNING')
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, 'goutte.toml')
+        with open(path, 'w') as config:
+            toml.dump(conf, config)
+        args = [path, 'benchmark', '--engine', engine]
+        if wait:
+            args.append('--wait')
+        start = time.perf_counter()
+        try:
+            with mock.patch.object(requests.Session, 'get_adapter',
+                                   return_value=FakeAdapter(api)), \
+                    mock.patch.object(aio, '_session',
+                                      lambda limit: FakeAsyncSession(api)):
+                main.entrypoint(args, standalone_mode=False)
+            code = 0
+        except SystemExit as e:
+            code = e.code
+        finally:
+            logger.setLevel(level)
+        wall_time = time.perf_counter() - start
+        main.shared_provider = None
+    endpoints = dict(memory.calls) if memory else api.endpoints
+    calls = sum(endpoints.values())
+    # ru_maxrss is in kilobytes on Linux and in bytes on macOS
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    rss = rss / 1024 if sys.platform == 'darwin' else rss
+    return {
+        'params': {'droplets': droplets, 'volumes': volumes,
+                   'snapshots': snapshots, 'retention': retention,
+                   'latency': latency, 'throttle': throttle,
+                   'concurrency': concurrency, 'engine': engine,
+                   'wait': wait, 'seed': seed, 'provider': provider},
+        'exit_code': code,
+        'wall_time': round(wall_time, 3),
+        'api_calls': calls,
+        'throttled': api.throttled,
+        'calls_per_resource': round(calls / max(droplets + volumes, 1), 3),
+        'peak_rss_kb': int(rss),
+        'endpoints': dict(sorted(endpoints.items())),
+    }
+
+
+def compare(result: Dict[str, Any], baseline: Dict[str, Any],
+            tolerances: Dict[str, float]) -> List[str]:
+    """Return the metrics regressing past their tolerance"""
+    regressions = []
+    for metric, tolerance in tolerances.items():
+        if tolerance is None or metric not in baseline:
+            continue
+        limit = baseline[metric] * (1 + tolerance)
+        if result[metric] > limit:
+            regressions.append(f'{metric}: {result[metric]} > {limit:g} '
+                               f'(baseline {baseline[metric]})')
+    return regressions
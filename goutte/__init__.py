@@ -1,13 +1,58 @@
-import colorlog
+import json
+import logging
+import time
 
 __version__ = '1.0.1'
 
-handler = colorlog.StreamHandler()
-handler.setFormatter(colorlog.ColoredFormatter(
+
+class _ColoredFormatter(logging.Formatter):
+    """colorlog formatter, only imported once something is logged, prefixing
+    the messages with their account if any
+    """
+
+    def __init__(self, fmt: str, datefmt: str) -> None:
+        super().__init__(fmt, datefmt)
+        self.colored = None
+
+    def format(self, record: logging.LogRecord) -> str:
+        if self.colored is None:
+            import colorlog
+            self.colored = colorlog.ColoredFormatter(self._fmt, self.datefmt)
+        account = getattr(record, 'account', None)
+        record.account_prefix = f'[{account}] ' if account else ''
+        return self.colored.format(record)
+
+
+class _JsonFormatter(logging.Formatter):
+    """One json object per line, without the colour codes"""
+
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {
+            'time': time.strftime('%Y-%m-%dT%H:%M:%S',
+                                  time.gmtime(record.created)) +
+            f'.{int(record.msecs):03d}Z',
+            'level': record.levelname,
+            'logger': record.name,
+            'message': record.getMessage(),
+        }
+        if getattr(record, 'account', None):
+            entry['account'] = record.account
+        if record.exc_info:
+            entry['exception'] = self.formatException(record.exc_info)
+        return json.dumps(entry)
+
+
+handler = logging.StreamHandler()
+handler.setFormatter(_ColoredFormatter(
     '%(yellow)s%(asctime)s%(reset)s - %(log_color)s%(levelname)s%(reset)s'
-    ' - %(message)s',
+    ' - %(account_prefix)s%(message)s',
     '%H:%M:%S'
 ))
-logger = colorlog.getLogger(__name__)
+logger = logging.getLogger(__name__)
 logger.setLevel('INFO')
 logger.addHandler(handler)
+
+
+def use_json_logs() -> None:
+    """Log json lines instead of the coloured text"""
+    handler.setFormatter(_JsonFormatter())
@@ -0,0 +1,459 @@
+"""Asyncio engine talking directly to the DigitalOcean v2 API
+
+All the requests of a run go through a single pooled keep-alive session
+and a semaphore caps how many of them are in flight at once.
+"""
+from typing import (Any, AsyncIterator, Awaitable, Callable, Dict, List,
+                    Optional, Set, Tuple)
+import asyncio
+import logging
+import time
+
+from goutte import retention
+from goutte.main import (Taken, _account_name, _claimed, _defer,
+                         _frequencies, _in_shard, _journal, _journaled,
+                         _journaled_snapshot, _out_of_time, _policies,
+                         _priorities, _profiled, _prune, _record,
+                         _record_latest, _record_taken, _resolver,
+                         _snapshot_name, _taken, metrics, report)
+from goutte.provider import Resource
+from goutte.report import Record
+from goutte.retention import Snapshot
+from goutte.scheduler import RETRY_STATUSES, Scheduler
+
+log = logging.getLogger(__name__)
+
+API_URL = 'https://api.digitalocean.com/v2/'
+
+
+class ApiError(Exception):
+    """The API answered with an error status"""
+
+    def __init__(self, status: int, message: str) -> None:
+        super().__init__(f'{status} {message}')
+        self.status = status
+
+
+class Client:
+    """Minimal DigitalOcean v2 client sharing one session"""
+
+    def __init__(self, token: str, session: Any, max_requests: int,
+                 scheduler: Scheduler, api_url: str = API_URL) -> None:
+        self.session = session
+        self.scheduler = scheduler
+        self.api_url = api_url
+        self.headers = {'Authorization': f'Bearer {token}',
+                        'Content-Type': 'application/json'}
+        self.semaphore = asyncio.Semaphore(max_requests)
+
+    async def request(self, endpoint: str, method: str, url: str,
+                      record: Optional[Record] = None,
+                      **kwargs: Any) -> Dict[str, Any]:
+        """Perform a request and return its decoded json body
+
+        Throttled and server side failures are retried by the scheduler,
+        the call is recorded in the metrics under endpoint and counted in
+        the report on the record of its resource when given.
+        """
+        with metrics.request(endpoint), report.request(record):
+            return await self._request(method, url, **kwargs)
+
+    async def _request(self, method: str, url: str,
+                       **kwargs: Any) -> Dict[str, Any]:
+        """Perform a request, retrying it when the scheduler allows"""
+        if not url.startswith('http'):
+            url = self.api_url + url
+        attempt = 0
+        while True:
+            await asyncio.sleep(self.scheduler.reserve())
+            async with self.semaphore:
+                async with self.session.request(
+                        method, url, headers=self.headers,
+                        **kwargs) as response:
+                    self.scheduler.observe(
+                        response.headers.get('ratelimit-remaining'),
+                        response.headers.get('ratelimit-reset'))
+                    retry = (response.status in RETRY_STATUSES and
+                             attempt < self.scheduler.max_retries)
+                    if not retry:
+                        if response.status == 204:
+                            return {}
+                        data = await response.json()
+                        if response.status >= 400:
+                            raise ApiError(response.status,
+                                           data.get('message', ''))
+                        return data
+            delay = self.scheduler.delay(attempt)
+            log.debug(f'Retrying {method} {url} in {delay:.1f}s '
+                      f'({response.status})')
+            await asyncio.sleep(delay)
+            attempt += 1
+
+    async def pages(self, path: str, key: str,
+                    **params: Any) -> AsyncIterator[List[Dict[str, Any]]]:
+        """Yield the items of a paginated listing one page at a time"""
+        endpoint = f'list_{key}'
+        data = await self.request(endpoint, 'GET', path,
+                                  params=dict(params, per_page=200))
+        yield data[key]
+        while data.get('links', {}).get('pages', {}).get('next'):
+            data = await self.request(endpoint, 'GET',
+                                      data['links']['pages']['next'])
+            yield data[key]
+
+
+def run(conf: Dict[str, Any], only: Optional[str], token: str,
+        scheduler: Optional[Scheduler] = None,
+        session_factory: Optional[Callable[[int], Any]] = None) -> int:
+    """Run snapshot and pruning with the async engine, return the error code
+    """
+    loop = asyncio.new_event_loop()
+    try:
+        return loop.run_until_complete(
+            _run(conf, only, token, scheduler or Scheduler(),
+                 session_factory or _session))
+    except ImportError as e:
+        log.critical(f'The async engine requires aiohttp: {e}')
+        return 1
+    finally:
+        loop.close()
+
+
+def _session(limit: int) -> Any:
+    """Return an aiohttp session pooling keep-alive connections"""
+    import aiohttp
+    return aiohttp.ClientSession(connector=aiohttp.TCPConnector(limit=limit))
+
+
+async def _run(conf: Dict[str, Any], only: Optional[str], token: str,
+               scheduler: Scheduler,
+               session_factory: Callable[[int], Any]) -> int:
+    """Pipeline the listings then every resource as coroutines
+
+    The groups run by priority. With a deadline, their resources start the
+    most overdue first and the ones not started in time are deferred.
+    """
+    max_requests = int(conf.get('concurrency', 1))
+    deadline = (time.monotonic() + conf['deadline']
+                if conf.get('deadline') else None)
+    session = session_factory(max_requests)
+    try:
+        client = Client(token, session, max_requests, scheduler)
+        kinds = [group[:-1] for group in _priorities(conf) if group in conf]
+        listings = [_select(client, kind, conf[f'{kind}s'].get('names', []),
+                            conf[f'{kind}s'].get('tags', []))
+                    for kind in kinds]
+        policies = _policies(conf) if only != 'snapshot' else {}
+        frequencies = _frequencies(conf)
+        indexed = set(policies) | set(frequencies) | set(
+            kinds if deadline else [])
+        if indexed:
+            listings.append(_snapshots(client, indexed))
+        try:
+            results = await asyncio.gather(*listings)
+        except Exception as e:
+            log.error(f'Could not list resources: {e}')
+            return 1
+        expired = {}  # type: Dict[str, List[Snapshot]]
+        taken = set()  # type: Taken
+        kept = {}  # type: Dict[str, int]
+        latest = {}  # type: Dict[str, int]
+        if indexed:
+            with _profiled('order'):
+                expired = retention.plan(_record_latest(_record_taken(
+                    results.pop(), frequencies, taken), latest), policies,
+                    kept)
+        error = 0
+        deletions = []  # type: List[Tuple[str, Snapshot]]
+        actions = {}  # type: Dict[int, str]
+        for kind, resources in zip(kinds, results):
+            if not resources:
+                log.warning(f'No matching {kind} found')
+                continue
+            log.debug(f'Found {len(resources)} matching {kind}s')
+            if deadline:
+                resources.sort(key=lambda resource: latest.get(
+                    str(resource['id']), 0))
+
+            async def process(resource: Dict[str, Any]) -> int:
+                return await _process(
+                    client, kind, resource, only,
+                    expired.get(str(resource['id']), []), deletions,
+                    actions, _snapshot_name(resource['name'], frequencies[
+                        kind]) if kind in frequencies else None, taken)
+            errors = await _schedule(kind, resources, process, deadline,
+                                     max_requests)
+            failed = [resource['name'] for resource, error
+                      in zip(resources, errors) if error]
+            if failed:
+                log.warning(f'Failed {kind}s: {", ".join(failed)}')
+                error = 1
+        error |= await _delete(client, deletions, conf.get(
+            'delete_concurrency', max_requests), deadline)
+        if policies:
+            report.kept(_account_name(), kept)
+        if actions and conf.get('wait'):
+            timeout = conf.get('wait_timeout', 3600)
+            if deadline:
+                timeout = max(min(timeout, deadline - time.monotonic()), 0)
+            error |= await _wait(client, actions, timeout,
+                                 conf.get('poll_interval', 10))
+        return error
+    finally:
+        await session.close()
+
+
+async def _snapshots(client: Client, kinds: Set[str]) -> List[Snapshot]:
+    """List the goutte snapshots of the given resource types, of the
+    resources of the current shard only
+
+    The snapshots are filtered page by page so the rest of the account is
+    never kept in memory.
+    """
+    params = {'resource_type': next(iter(kinds))} if len(kinds) == 1 else {}
+    snapshots = []
+    async for page in client.pages('snapshots', 'snapshots', **params):
+        for snapshot in map(_resolver(), page):
+            if snapshot.owned and snapshot.resource_type in kinds and (
+                    _in_shard(snapshot.resource_type, snapshot.resource_id)):
+                snapshots.append(snapshot)
+    return snapshots
+
+
+async def _select(client: Client, kind: str, names: List[str],
+                  tags: List[str]) -> List[Dict[str, Any]]:
+    """List the resources matching the configured names or tags, the ones
+    of the current shard only
+
+    Droplets are filtered by tag on the API side unless they are also
+    selected by name, the whole inventory being then listed once. Volumes
+    can not be, and the listings are filtered page by page.
+    """
+    if not names and not tags:
+        return []
+    wanted, tagged = set(names), set(tags)
+
+    async def select(listing: AsyncIterator[List[Dict[str, Any]]],
+                     match: Callable[[Dict[str, Any]], bool]
+                     ) -> List[Dict[str, Any]]:
+        return [resource async for page in listing for resource in page
+                if match(resource)]
+    if kind == 'droplet' and not names:
+        listings = [select(client.pages('droplets', 'droplets', tag_name=tag),
+                           lambda droplet: True) for tag in tags]
+        listed = [droplet for droplets in await asyncio.gather(*listings)
+                  for droplet in droplets]
+    else:
+        listed = await select(
+            client.pages(f'{kind}s', f'{kind}s'),
+            lambda resource: resource['name'] in wanted or bool(
+                tagged.intersection(resource.get('tags') or [])))
+    resources, seen = [], set()
+    for resource in listed:
+        if resource['id'] not in seen:
+            seen.add(resource['id'])
+            resources.append(resource)
+    found = {resource['name'] for resource in resources}
+    missing = [name for name in names if name not in found]
+    if missing:
+        log.warning(f'Configured {kind}s not found: {", ".join(missing)}')
+    return [resource for resource in resources
+            if _in_shard(kind, resource['id'])]
+
+
+async def _schedule(kind: str, resources: List[Dict[str, Any]],
+                    process: Callable[[Dict[str, Any]], Awaitable[int]],
+                    deadline: Optional[float], concurrency: int
+                    ) -> List[int]:
+    """Process the resources concurrently and return their error codes
+
+    With a deadline, at most concurrency resources run at once, started in
+    order, and the ones which would likely end after it are deferred.
+    """
+    if deadline is None:
+        return await asyncio.gather(*map(process, resources))
+    gate = asyncio.Semaphore(concurrency)
+    durations = []  # type: List[float]
+    deferred = []  # type: List[Dict[str, Any]]
+
+    async def start(resource: Dict[str, Any]) -> int:
+        async with gate:
+            if _out_of_time(deadline, durations):
+                deferred.append(resource)
+                return 0
+            started = time.monotonic()
+            try:
+                return await process(resource)
+            finally:
+                durations.append(time.monotonic() - started)
+    errors = await asyncio.gather(*map(start, resources))
+    if deferred:
+        _defer(kind, [Resource(resource['id'], resource['name'])
+                      for resource in deferred])
+    return errors
+
+
+async def _process(client: Client, kind: str, resource: Dict[str, Any],
+                   only: Optional[str], expired: List[Snapshot],
+                   deletions: List[Tuple[str, Snapshot]],
+                   actions: Dict[int, str], name: Optional[str],
+                   taken: Taken) -> int:
+    """Prune then snapshot a resource unless its snapshot of the period
+    is already taken, return the error code
+    """
+    log.debug(f'Processing {resource["name"]}')
+    record = _record(kind, resource['id'], resource['name'])
+    error = 0
+    if only == 'prune' or not only:
+        with metrics.stage('prune', kind), report.stage(
+                record, 'prune', bind=False):
+            _prune(resource['name'], expired, deletions)
+    if (only == 'snapshot' or not only) and not _taken(
+            resource['id'], resource['name'], name, taken) and not _claimed(
+            kind, resource['id'], resource['name']):
+        with metrics.stage('snapshot', kind), report.stage(
+                record, 'snapshot', bind=False):
+            error |= await _snapshot(client, kind, resource, actions, name,
+                                     record)
+    if error:
+        report.update(record, failed=True)
+    return error
+
+
+async def _delete(client: Client, deletions: List[Tuple[str, Snapshot]],
+                  concurrency: int, deadline: Optional[float] = None) -> int:
+    """Delete the queued snapshots concurrently, return the error code
+
+    Snapshots already gone (404) count as deleted. The deletions not
+    started before the deadline are deferred, the next run plans them
+    again.
+    """
+    if not deletions:
+        return 0
+    loop = asyncio.get_event_loop()
+    started = loop.time()
+    semaphore = asyncio.Semaphore(int(concurrency))
+    deferred = []  # type: List[Tuple[str, Snapshot]]
+
+    async def delete(name: str, snapshot: Snapshot) -> int:
+        target = f'snapshot:{snapshot.id}'
+        if _journaled('destroy', target):
+            log.debug(f'{name} - Already deleted ({snapshot.name})')
+            return 0
+        record = _record(snapshot.resource_type, snapshot.resource_id, name)
+        async with semaphore:
+            if _out_of_time(deadline, []):
+                deferred.append((name, snapshot))
+                return 0
+            _journal('intent', 'destroy', target, name=name,
+                     snapshot=snapshot.name)
+            try:
+                with report.stage(record, 'prune', bind=False):
+                    await client.request('destroy_snapshot', 'DELETE',
+                                         f'snapshots/{snapshot.id}', record)
+            except ApiError as e:
+                if e.status != 404:
+                    log.error(f'{name} - Could not delete ({snapshot.name}): '
+                              f'{e}.')
+                    report.update(record, failed=True)
+                    return 1
+                log.debug(f'{name} - Already deleted ({snapshot.name})')
+            report.deleted(record)
+            _journal('done', 'destroy', target, name=name,
+                     snapshot=snapshot.name)
+            return 0
+    errors = await asyncio.gather(*(delete(name, snapshot)
+                                    for name, snapshot in deletions))
+    elapsed = loop.time() - started
+    deleted = len(errors) - sum(errors) - len(deferred)
+    log.info(f'Deleted {deleted}/{len(errors)} snapshots in {elapsed:.1f}s '
+             f'({deleted / max(elapsed, 0.001):.1f}/s)')
+    if deferred:
+        log.warning(f'Deadline reached, deferred {len(deferred)} snapshot '
+                    f'deletions to the next run')
+    return 1 if sum(errors) else 0
+
+
+async def _snapshot(client: Client, kind: str, resource: Dict[str, Any],
+                    actions: Dict[int, str], name: Optional[str],
+                    record: Optional[Record] = None) -> int:
+    """Snapshot a resource, recording the droplets snapshot actions and
+    counting its requests on its report record
+
+    The name of the snapshot of the period is given with a frequency, only a
+    snapshot journaled under that name counts as taken.
+    """
+    target = f'{kind}:{resource["id"]}'
+    done = _journaled_snapshot(target, name)
+    if done:
+        log.info(f'{resource["name"]} - Already snapshotted '
+                 f'({done["snapshot"]})')
+        if done.get('action_id'):
+            actions[done['action_id']] = resource['name']
+        return 0
+    name = name or _snapshot_name(resource['name'])
+    try:
+        _journal('intent', 'snapshot', target, name=resource['name'],
+                 snapshot=name)
+        action_id = None
+        if kind == 'droplet':
+            data = await client.request(
+                'snapshot_droplet', 'POST',
+                f'droplets/{resource["id"]}/actions', record,
+                json={'type': 'snapshot', 'name': name})
+            action_id = data['action']['id']
+            actions[action_id] = resource['name']
+        else:
+            await client.request('snapshot_volume', 'POST',
+                                 f'volumes/{resource["id"]}/snapshots',
+                                 record, json={'name': name})
+        _journal('done', 'snapshot', target, name=resource['name'],
+                 snapshot=name, action_id=action_id)
+        report.update(record, snapshot=name)
+        log.info(f'{resource["name"]} - Snapshot ({name})')
+        return 0
+    except ApiError as e:
+        log.error(f'API error: {e}.')
+        return 1
+    except Exception as e:
+        log.error(f'Unexpected exception: {e}.')
+        return 1
+
+
+async def _wait(client: Client, actions: Dict[int, str], timeout: float,
+                interval: float) -> int:
+    """Poll the snapshot actions together until they end or time out"""
+    loop = asyncio.get_event_loop()
+    deadline = loop.time() + timeout
+    pending = set(actions)
+    states = {}  # type: Dict[int, str]
+    while pending:
+        try:
+            data = await client.request(
+                'poll_actions', 'GET', 'actions',
+                params={'page': 1, 'per_page': 200})
+            listed = {action['id']: action for action in data['actions']}
+            missing = pending.difference(listed)
+            for data in await asyncio.gather(*(
+                    client.request('get_action', 'GET',
+                                   f'actions/{action_id}')
+                    for action_id in missing)):
+                listed[data['action']['id']] = data['action']
+            for action_id in list(pending):
+                if listed[action_id]['status'] != 'in-progress':
+                    states[action_id] = listed[action_id]['status']
+                    pending.discard(action_id)
+        except Exception as e:
+            log.error(f'Could not poll the snapshots actions: {e}')
+        if not pending or loop.time() + interval > deadline:
+            break
+        await asyncio.sleep(interval)
+    error = 0
+    for action_id, name in sorted(actions.items(), key=lambda x: x[1]):
+        state = states.get(action_id, 'timed-out')
+        if state == 'completed':
+            log.info(f'{name} - Snapshot completed')
+        else:
+            log.error(f'{name} - Snapshot {state}')
+            error = 1
+    return error
@@ -0,0 +1,59 @@
+"""On disk cache of the API listings between runs
+
+Listings are stored as json in a SQLite database and expire after a time
+to live. They are invalidated whenever goutte changes what they describe.
+"""
+from typing import Any, Callable, Optional
+import json
+import os
+import sqlite3
+import threading
+import time
+
+
+class Cache:
+    """SQLite store of the API listings with a time to live"""
+
+    def __init__(self, path: str, ttl: float,
+                 clock: Callable[[], float] = time.time) -> None:
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self.ttl = ttl
+        self.clock = clock
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        with self.db:
+            self.db.execute('CREATE TABLE IF NOT EXISTS listings ('
+                            'key TEXT PRIMARY KEY, '
+                            'stored REAL NOT NULL, '
+                            'value TEXT NOT NULL)')
+
+    def get(self, key: str) -> Optional[Any]:
+        """Return a stored value, None when missing or expired"""
+        with self.lock:
+            row = self.db.execute(
+                'SELECT stored, value FROM listings WHERE key = ?',
+                (key,)).fetchone()
+        if row is None or row[0] + self.ttl <= self.clock():
+            return None
+        return json.loads(row[1])
+
+    def set(self, key: str, value: Any) -> None:
+        """Store a json serializable value"""
+        with self.lock, self.db:
+            self.db.execute(
+                'INSERT OR REPLACE INTO listings VALUES (?, ?, ?)',
+                (key, self.clock(), json.dumps(value, default=str)))
+
+    def invalidate(self, prefix: str) -> None:
+        """Drop every value whose key starts with a prefix"""
+        with self.lock, self.db:
+            self.db.execute(
+                "DELETE FROM listings WHERE substr(key, 1, ?) = ?",
+                (len(prefix), prefix))
+
+    def close(self) -> None:
+        """Close the database"""
+        with self.lock:
+            self.db.close()
@@ -0,0 +1,132 @@
+"""Sharing of the requests repeated by the accounts of a run
+
+Accounts configured with the same token list the same droplets, volumes
+and snapshots and may select the same resources. Within a run, the first
+account to ask for a listing lists it and the others replay its pages,
+as they arrive when the listing is still in flight, and a resource is only
+snapshotted by the first account which claims it.
+"""
+from typing import Any, Callable, Dict, Iterable, Iterator, List, Optional
+import threading
+
+Page = List[Dict[str, Any]]
+
+
+class Coalescer:
+    """Per run registry of the listings and the snapshot claims
+
+    Listings are keyed by the token and the listing parameters. Failed and
+    abandoned listings are forgotten so the next caller lists them again,
+    and invalidated ones once the run changed what they describe.
+    """
+
+    def __init__(self) -> None:
+        self.lock = threading.Lock()
+        self.flights = {}  # type: Dict[str, _Flight]
+        self.claims = {}  # type: Dict[str, Optional[str]]
+        self.shared = 0
+
+    def listing(self, key: str, owner: Optional[str],
+                pages: Callable[[], Iterable[Page]]) -> Iterator[Page]:
+        """Yield the pages of a listing, listed by pages() unless another
+        owner listed or is listing it
+
+        An owner never waits for its own listing, it lists it again.
+        """
+        with self.lock:
+            flight = self.flights.get(key)
+            if flight is None or flight.owner == owner:
+                flight = self.flights[key] = _Flight(owner)
+                lead = True
+            else:
+                self.shared += 1
+                lead = False
+        if lead:
+            return self._lead(key, flight, pages)
+        return self._follow(flight, pages)
+
+    def claim(self, key: str, owner: Optional[str]) -> Optional[str]:
+        """Claim a resource for an owner, return the owner which has it"""
+        with self.lock:
+            return self.claims.setdefault(key, owner)
+
+    def invalidate(self, prefix: str) -> None:
+        """Forget the listings whose key starts with a prefix"""
+        with self.lock:
+            for key in [key for key in self.flights
+                        if key.startswith(prefix)]:
+                del self.flights[key]
+
+    def _lead(self, key: str, flight: '_Flight',
+              pages: Callable[[], Iterable[Page]]) -> Iterator[Page]:
+        """List the pages, handing them to the followers"""
+        try:
+            for page in pages():
+                flight.add(page)
+                yield page
+        except BaseException as e:
+            with self.lock:
+                if self.flights.get(key) is flight:
+                    del self.flights[key]
+            flight.end(None if isinstance(e, GeneratorExit) else e,
+                       abandoned=True)
+            raise
+        flight.end()
+
+    @staticmethod
+    def _follow(flight: '_Flight', pages: Callable[[], Iterable[Page]]
+                ) -> Iterator[Page]:
+        """Replay the pages of another owner, listing the rest when it gave
+        up
+        """
+        index = 0
+        for page in flight.replay():
+            index += 1
+            yield page
+        if flight.abandoned and flight.error is None:
+            for number, page in enumerate(pages()):
+                if number >= index:
+                    yield page
+
+
+class _Flight:
+    """Pages of a listing, appended by its owner as they arrive"""
+
+    def __init__(self, owner: Optional[str]) -> None:
+        self.owner = owner
+        self.condition = threading.Condition()
+        self.pages = []  # type: List[Page]
+        self.finished = False
+        self.abandoned = False
+        self.error = None  # type: Optional[BaseException]
+
+    def add(self, page: Page) -> None:
+        """Append a page and wake the followers up"""
+        with self.condition:
+            self.pages.append(page)
+            self.condition.notify_all()
+
+    def end(self, error: Optional[BaseException] = None,
+            abandoned: bool = False) -> None:
+        """Mark the listing over, failed or abandoned by its owner"""
+        with self.condition:
+            self.finished = True
+            self.abandoned = abandoned
+            self.error = error
+            self.condition.notify_all()
+
+    def replay(self) -> Iterator[Page]:
+        """Yield the pages as they arrive, raising the error of the owner"""
+        index = 0
+        while True:
+            with self.condition:
+                while index >= len(self.pages) and not self.finished:
+                    self.condition.wait()
+                if index < len(self.pages):
+                    page = self.pages[index]
+                elif self.error is not None:
+                    raise self.error
+                else:
+                    return
+            index += 1
+            yield page
@@ -0,0 +1,69 @@
+"""Minimal cron expressions for the daemon schedules"""
+from datetime import datetime, timedelta
+from typing import Set
+
+FIELDS = [(0, 59), (0, 23), (1, 31), (1, 12), (0, 7)]
+
+
+class Cron:
+    """Five fields cron expression (minute hour day month weekday)"""
+
+    def __init__(self, expression: str) -> None:
+        fields = expression.split()
+        if len(fields) != 5:
+            raise ValueError(f'Invalid cron expression: {expression}')
+        self.expression = expression
+        (self.minutes, self.hours, self.days, self.months,
+         weekdays) = [_parse(field, *bounds)
+                      for field, bounds in zip(fields, FIELDS)]
+        self.weekdays = {weekday % 7 for weekday in weekdays}
+        self.any_day = fields[2] == '*'
+        self.any_weekday = fields[4] == '*'
+
+    def __repr__(self) -> str:
+        return f'Cron({self.expression!r})'
+
+    def next(self, after: datetime) -> datetime:
+        """Return the first matching minute strictly after a given time"""
+        time = after.replace(second=0, microsecond=0) + timedelta(minutes=1)
+        limit = time + timedelta(days=366 * 5)
+        while time < limit:
+            if time.month not in self.months:
+                time = (time.replace(day=1, hour=0, minute=0) +
+                        timedelta(days=32)).replace(day=1)
+            elif not self._day_matches(time):
+                time = time.replace(hour=0, minute=0) + timedelta(days=1)
+            elif time.hour not in self.hours:
+                time = time.replace(minute=0) + timedelta(hours=1)
+            elif time.minute not in self.minutes:
+                time += timedelta(minutes=1)
+            else:
+                return time
+        raise ValueError(f'Cron expression never matches: {self.expression}')
+
+    def _day_matches(self, time: datetime) -> bool:
+        """Match the day of month and weekday the way cron does"""
+        day = time.day in self.days
+        weekday = (time.weekday() + 1) % 7 in self.weekdays
+        if self.any_day or self.any_weekday:
+            return day and weekday
+        return day or weekday
+
+
+def _parse(field: str, low: int, high: int) -> Set[int]:
+    """Return the values matched by a cron field"""
+    values = set()  # type: Set[int]
+    for item in field.split(','):
+        item, _, step = item.partition('/')
+        if item == '*':
+            start, end = low, high
+        elif '-' in item:
+            start, end = (int(value) for value in item.split('-', 1))
+        else:
+            start = end = int(item)
+            if step:
+                end = high
+        if not low <= start <= end <= high:
+            raise ValueError(f'Invalid cron field: {field}')
+        values.update(range(start, end + 1, int(step) if step else 1))
+    return values
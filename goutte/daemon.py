@@ -0,0 +1,162 @@
+"""Long running mode following a cron schedule per resource group
+
+The process, its API client and its inventory stay warm between ticks, the
+listings and deletions reusing the keep-alive connections of the client
+session.
+SIGHUP reloads the configuration and SIGTERM stops once the running tick
+is over.
+"""
+from datetime import datetime
+from typing import Any, Callable, Dict, Optional, Tuple
+import logging
+import signal
+import sys
+import threading
+
+import click
+
+from goutte import __version__, logger, use_json_logs
+from goutte import main, metrics
+from goutte.cron import Cron
+from goutte.provider import DigitalOcean
+from goutte.scheduler import Scheduler
+
+log = logging.getLogger(__name__)
+
+GROUPS = ('droplets', 'volumes')
+DEFAULT_SCHEDULE = '0 0 * * *'
+
+
+@click.command(help='Run goutte following the configured schedules.')
+@click.argument('config', envvar='GOUTTE_CONFIG',
+                type=click.Path(exists=True, dir_okay=False))
+@click.argument('do_token', envvar='GOUTTE_DO_TOKEN')
+@click.option('--debug', is_flag=True, help='Enable debug logging')
+@click.option('--log-json', is_flag=True,
+              help='Log json lines instead of coloured text')
+@click.version_option(version=__version__)
+def entrypoint(config: str, do_token: str, debug: bool,
+               log_json: bool) -> None:
+    """Daemon command line interface entrypoint"""
+    if debug:
+        logger.setLevel('DEBUG')
+    if log_json:
+        use_json_logs()
+    log.info(f'Starting goutte v{__version__} daemon')
+    main.token = do_token
+    main.shared_provider = DigitalOcean(do_token, main._call)
+    daemon = Daemon(config)
+    address = daemon.conf.get('metrics_address')
+    if address:
+        try:
+            metrics.serve(main.metrics, address)
+        except (OSError, ValueError) as e:
+            log.critical(f'Could not serve the metrics on {address}: {e}')
+            sys.exit(1)
+        log.info(f'Serving the metrics on {address}/metrics')
+    signal.signal(signal.SIGHUP, lambda *args: daemon.reload())
+    signal.signal(signal.SIGTERM, lambda *args: daemon.stop())
+    signal.signal(signal.SIGINT, lambda *args: daemon.stop())
+    sys.exit(daemon.run())
+
+
+class Daemon:
+    """Run each resource group when its schedule is due"""
+
+    def __init__(self, path: str,
+                 clock: Callable[[], datetime] = datetime.now) -> None:
+        self.path = path
+        self.clock = clock
+        self.wake = threading.Event()
+        self.stopping = False
+        self.reloading = False
+        self.conf, self.schedules = self.load()
+
+    def load(self) -> Tuple[Dict[str, Any], Dict[str, Cron]]:
+        """Load the configuration and the schedules of its groups
+
+        Exit when the configuration is not valid.
+        """
+        with open(self.path) as config:
+            conf = main._load_config(config)
+        if 'accounts' in conf:
+            log.critical('The daemon runs a single account, [[accounts]] '
+                         'are not supported')
+            sys.exit(1)
+        try:
+            schedules = {
+                group: Cron(conf[group].get(
+                    'schedule', conf.get('schedule', DEFAULT_SCHEDULE)))
+                for group in GROUPS if group in conf}
+        except ValueError as e:
+            log.critical(f'Malformated configuration: {e}')
+            sys.exit(1)
+        main.scheduler = Scheduler(conf.get('requests_per_minute', 250))
+        main.inventory_ttl = conf.get('inventory_ttl', 3600)
+        main.inventory.clear()
+        if main.cache:
+            main.cache.close()
+        main.cache = main._open_cache(conf) if conf.get('cache_dir') else None
+        if main.journal:
+            main.journal.close()
+        main.journal = (main._open_journal(conf) if conf.get('journal_file')
+                        else None)
+        for group, cron in schedules.items():
+            log.debug(f'{group} scheduled at {cron.expression}')
+        return conf, schedules
+
+    def reload(self) -> None:
+        """Ask for the configuration to be reloaded"""
+        self.reloading = True
+        self.wake.set()
+
+    def stop(self) -> None:
+        """Ask to stop once the running tick is over"""
+        self.stopping = True
+        self.wake.set()
+
+    def run(self) -> int:
+        """Run the due groups until stopped, return the error code"""
+        now = self.clock()
+        due = {group: cron.next(now) for group, cron in self.schedules.items()}
+        while not self.stopping:
+            if self.reloading:
+                self.reloading = False
+                try:
+                    self.conf, self.schedules = self.load()
+                    log.info(f'Reloaded configuration from {self.path}')
+                except SystemExit:
+                    log.error('Keeping the previous configuration')
+                now = self.clock()
+                due = {group: cron.next(now)
+                       for group, cron in self.schedules.items()}
+            if not due:
+                log.warning('No droplets or volumes to schedule')
+                self.wait(None)
+                continue
+            group = min(due, key=lambda group: due[group])
+            delay = (due[group] - self.clock()).total_seconds()
+            if delay > 0:
+                self.wait(delay)
+                continue
+            self.tick(group)
+            due[group] = self.schedules[group].next(
+                max(due[group], self.clock()))
+        log.info('Stopped')
+        return 0
+
+    def wait(self, delay: Optional[float]) -> None:
+        """Sleep until the delay expires or a signal is received"""
+        self.wake.wait(delay)
+        self.wake.clear()
+
+    def tick(self, group: str) -> int:
+        """Snapshot and prune a group, return the error code"""
+        conf = {key: value for key, value in self.conf.items()
+                if key not in GROUPS}
+        conf[group] = self.conf[group]
+        log.info(f'Processing scheduled {group}')
+        error = main._run(conf, None, self.conf.get('engine', 'sync'))
+        if error:
+            log.warning(f'Scheduled {group} run failed')
+        return error
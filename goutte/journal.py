@@ -0,0 +1,125 @@
+"""Crash safe journal of the snapshots and deletions
+
+Every snapshot and deletion is appended as a json line when it is intended
+and once it is done, each line being flushed and fsync'd before goutte
+goes on. A run killed halfway can then be resumed without taking the same
+snapshots again nor calling the API for what is already done.
+"""
+from typing import Any, Callable, Dict, List, Optional, Tuple
+import json
+import logging
+import os
+import threading
+import time
+
+log = logging.getLogger(__name__)
+
+Key = Tuple[str, str, str, str]
+
+
+class Journal:
+    """Append-only json lines journal of the operations of the day
+
+    Operations are identified by their account, action (snapshot or
+    destroy) and target, and done operations are looked up for the current
+    day only. Entries of the previous days are dropped when the journal is
+    opened.
+    """
+
+    def __init__(self, path: str,
+                 clock: Callable[[], float] = time.time) -> None:
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self.path = path
+        self.clock = clock
+        self.lock = threading.Lock()
+        self.done = {}  # type: Dict[Key, Dict[str, Any]]
+        self.intended = {}  # type: Dict[Key, Dict[str, Any]]
+        entries = self._read()
+        today = [entry for entry in entries
+                 if entry.get('period') == self.period()]
+        if len(today) != len(entries):
+            self._rewrite(today)
+        for entry in today:
+            self._index(entry)
+        self.file = open(path, 'a')
+
+    def period(self) -> str:
+        """Return the current period, the local day as in snapshot names"""
+        return time.strftime('%Y%m%d', time.localtime(self.clock()))
+
+    def intend(self, account: str, action: str, target: str,
+               **details: Any) -> None:
+        """Record an operation about to be sent to the API"""
+        self._append('intent', account, action, target, details)
+
+    def complete(self, account: str, action: str, target: str,
+                 **details: Any) -> None:
+        """Record an operation the API acknowledged"""
+        self._append('done', account, action, target, details)
+
+    def completed(self, account: str, action: str,
+                  target: str) -> Optional[Dict[str, Any]]:
+        """Return the entry of an operation done today, None otherwise"""
+        with self.lock:
+            return self.done.get((self.period(), account, action, target))
+
+    def interrupted(self, account: str) -> List[Dict[str, Any]]:
+        """Return the operations of today intended but never done"""
+        with self.lock:
+            return [entry for key, entry in self.intended.items()
+                    if key[:2] == (self.period(), account)]
+
+    def close(self) -> None:
+        """Close the journal file"""
+        with self.lock:
+            self.file.close()
+
+    def _append(self, event: str, account: str, action: str, target: str,
+                details: Dict[str, Any]) -> None:
+        """Durably append an entry"""
+        entry = dict(details, time=round(self.clock(), 3),
+                     period=self.period(), event=event, account=account,
+                     action=action, target=target)
+        line = json.dumps(entry, sort_keys=True, default=str) + '\n'
+        with self.lock:
+            self.file.write(line)
+            self.file.flush()
+            os.fsync(self.file.fileno())
+            self._index(entry)
+
+    def _index(self, entry: Dict[str, Any]) -> None:
+        """Track the intended and done operations, the lock being held"""
+        key = (entry['period'], entry['account'], entry['action'],
+               entry['target'])
+        if entry['event'] == 'done':
+            self.done[key] = entry
+            self.intended.pop(key, None)
+        elif key not in self.done:
+            self.intended[key] = entry
+
+    def _read(self) -> List[Dict[str, Any]]:
+        """Return the entries on disk, skipping a line cut by a crash"""
+        entries = []
+        try:
+            with open(self.path) as journal_file:
+                for number, line in enumerate(journal_file, 1):
+                    try:
+                        entries.append(json.loads(line))
+                    except ValueError:
+                        log.debug(f'Skipping the unreadable line {number} '
+                                  f'of {self.path}')
+        except FileNotFoundError:
+            pass
+        return entries
+
+    def _rewrite(self, entries: List[Dict[str, Any]]) -> None:
+        """Atomically replace the journal with some of its entries"""
+        temporary = f'{self.path}.{os.getpid()}.tmp'
+        with open(temporary, 'w') as journal_file:
+            for entry in entries:
+                journal_file.write(json.dumps(entry, sort_keys=True) + '\n')
+            journal_file.flush()
+            os.fsync(journal_file.fileno())
+        os.replace(temporary, self.path)
@@ -1,51 +1,553 @@
-from datetime import date
-from typing import Dict, List, Union
+from collections import namedtuple
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from contextlib import contextmanager
+from datetime import date, datetime
+from typing import (TYPE_CHECKING, Any, Callable, ContextManager, Dict,
+                    Iterable, Iterator, List, Optional, Set, Tuple, Union)
+import hashlib
+import json
+import logging
+import os
 import sys
+import threading
+import time
 import uuid
 
 import click
-import colorlog
-import digitalocean
-import toml
 
-from goutte import __version__
+from goutte import (__version__, handler, logger, retention, sharding,
+                    use_json_logs)
+from goutte.coalesce import Coalescer
+from goutte.metrics import Metrics
+from goutte.profiling import IDLE, Profiler
+from goutte.provider import DigitalOcean, Provider, Resource
+from goutte.report import Record, Report
+from goutte.scheduler import Scheduler
 
-log = colorlog.getLogger(__name__)
+if TYPE_CHECKING:
+    # The cache and the journal are only imported once a run needs them
+    from goutte.cache import Cache
+    from goutte.journal import Journal
+
+Deletion = Tuple[str, retention.Snapshot]
+# Resource id and name of the goutte snapshots of the current period
+Taken = Set[Tuple[str, str]]
+_Planned = namedtuple('_Planned', ['kind', 'id', 'name', 'snapshot'])
+
+log = logging.getLogger(__name__)
 token = None
-error = 0
+scheduler = Scheduler()
+shared_provider = None  # type: Optional[Provider]
+inventory_ttl = 0
+inventory = {}  # type: Dict[Tuple[str, ...], Tuple[float, Any]]
+cache = None  # type: Optional[Cache]
+journal = None  # type: Optional[Journal]
+coalescer = None  # type: Optional[Coalescer]
+resuming = False
+shard = None  # type: Optional[sharding.Shard]
+profiler = None  # type: Optional[Profiler]
+metrics = Metrics()
+report = Report()
+_local = threading.local()
+
+# Name suffix of the snapshots of each period, so that a resource has a
+# single snapshot name per period
+FREQUENCIES = {'hourly': '%Y%m%d%H', 'daily': '%Y%m%d', 'weekly': '%GW%V'}
+
+
+def cli() -> None:
+    """Console script, dispatching goutte daemon to the daemon command"""
+    if sys.argv[1:2] == ['daemon']:
+        from goutte import daemon
+        daemon.entrypoint(sys.argv[2:], prog_name='goutte daemon')
+    else:
+        entrypoint()
 
 
 @click.command(help='DigitalOcean snapshots automation.')
 @click.argument('config', envvar='GOUTTE_CONFIG', type=click.File('r'))
-@click.argument('do_token', envvar='GOUTTE_DO_TOKEN')
+@click.argument('do_token', envvar='GOUTTE_DO_TOKEN', required=False)
 @click.option('--only', type=click.Choice(['snapshot', 'prune']),
               help='Only snapshot or only prune')
+@click.option('--concurrency', type=click.IntRange(min=1),
+              help='Number of resources processed in parallel')
+@click.option('--engine', type=click.Choice(['sync', 'async']),
+              default='sync', help='API engine to use')
+@click.option('--wait', is_flag=True,
+              help='Wait for the droplets snapshots to complete')
+@click.option('--wait-timeout', type=click.IntRange(min=0),
+              help='Seconds to wait for the snapshots')
+@click.option('--no-cache', is_flag=True,
+              help='Ignore the configured on disk cache')
+@click.option('--plan', type=click.File('w'),
+              help='Write the planned snapshots and deletions as json '
+                   'without changing anything (- for stdout)')
+@click.option('--dry-run', is_flag=True, help='Same as --plan -')
+@click.option('--apply', type=click.File('r'),
+              help='Apply a plan written by --plan without listing again')
+@click.option('--resume', is_flag=True,
+              help='Skip what the journal records as done today')
+@click.option('--deadline', type=click.IntRange(min=1),
+              help='Seconds after which no new snapshot or deletion is '
+                   'started')
+@click.option('--shard', 'shard_spec', metavar='I/N',
+              help='Only handle the resources of shard I among N')
+@click.option('--report-json', type=click.File('w'),
+              help='Write a json report of every droplet and volume at the '
+                   'end of the run (- for stdout)')
+@click.option('--profile', type=click.Path(file_okay=False),
+              help='Profile the time and memory of the pipeline stages into '
+                   'a directory')
 @click.option('--debug', is_flag=True, help='Enable debug logging')
+@click.option('--log-json', is_flag=True,
+              help='Log json lines instead of coloured text')
 @click.version_option(version=__version__)
 def entrypoint(config: click.File, do_token: str, only: str,
-               debug: bool) -> None:
+               concurrency: int, engine: str, wait: bool, wait_timeout: int,
+               no_cache: bool, plan: click.File, dry_run: bool,
+               apply: click.File, resume: bool, deadline: int,
+               shard_spec: str, report_json: click.File, profile: str,
+               debug: bool, log_json: bool) -> None:
     """Command line interface entrypoint"""
-    global token
+    global token, scheduler, cache, journal, resuming, shard, profiler
+    if (plan or dry_run) and apply:
+        raise click.UsageError('--apply can not be used with --plan')
+    if shard_spec and apply:
+        raise click.UsageError('--apply can not be used with --shard')
+    try:
+        shard = sharding.parse(shard_spec) if shard_spec else None
+    except ValueError as e:
+        raise click.BadParameter(str(e), param_hint='--shard')
     if debug:
-        log.setLevel('DEBUG')
+        logger.setLevel('DEBUG')
+    if log_json:
+        use_json_logs()
     log.info('Starting goutte v{}'.format(__version__))
     token = do_token
     conf = _load_config(config)
-    log.debug(f'Retention is set to {conf["retention"]} snapshots')
+    if 'accounts' in conf and (plan or dry_run or apply):
+        raise click.UsageError('--plan and --apply need a single account')
+    if 'accounts' not in conf and not do_token:
+        raise click.UsageError('Missing argument "DO_TOKEN".')
+    if resume and not conf.get('journal_file'):
+        raise click.UsageError('--resume needs a journal_file')
+    if concurrency:
+        conf['concurrency'] = concurrency
+    if wait:
+        conf['wait'] = wait
+    if wait_timeout is not None:
+        conf['wait_timeout'] = wait_timeout
+    if deadline:
+        conf['deadline'] = deadline
+    scheduler = Scheduler(conf.get('requests_per_minute', 250))
+    if conf.get('cache_dir') and not no_cache:
+        cache = _open_cache(conf)
+    if conf.get('journal_file') and not (plan or dry_run):
+        journal = _open_journal(conf)
+        resuming = resume
+    if 'accounts' not in conf:
+        for kind, policy in _policies(conf).items():
+            log.debug(f'Retention of the {kind}s: ' + ', '.join(
+                f'{rule} {value}' for rule, value in policy._asdict().items()
+                if value))
     if only:
         log.debug(f'Will only {only}')
-    _process_droplets(conf, only)
-    _process_volumes(conf, only)
+    if shard:
+        log.debug(f'Will only handle shard {shard_spec}')
+    if plan or dry_run:
+        with _kept_provider():
+            error = _write_plan(conf, only, plan or click.get_text_stream(
+                'stdout'))
+        sys.exit(error)
+    started = time.time()
+    if profile:
+        profiler = Profiler()
+        profiler.start()
+    try:
+        if apply:
+            with _kept_provider():
+                error = _apply(conf, apply)
+        elif 'accounts' in conf:
+            error = _run_accounts(conf, only, engine)
+        else:
+            error = _run(conf, only, engine)
+    finally:
+        if profile:
+            _write_profile(profile)
+    if report_json:
+        report.write(report_json, version=__version__, engine=engine,
+                     only=only, shard=shard_spec, error=error,
+                     started_at=retention.isoformat(int(started)),
+                     duration_seconds=round(time.time() - started, 3))
     sys.exit(error)
 
 
+def _run(conf: Dict[str, Any], only: Optional[str],
+         engine: str = 'sync') -> int:
+    """Snapshot and prune the configured resources, return the error code"""
+    started = time.monotonic()
+    _log_interrupted()
+    if engine == 'async':
+        from goutte import aio
+        with _profiled('async'):
+            error = aio.run(conf, only, _token(), _scheduler())
+    else:
+        with _kept_provider():
+            error = _run_sync(conf, only)
+    _log_scheduler_summary()
+    account = getattr(_local, 'account', None)
+    labels = {'account': account.name} if account else {}
+    metrics.set('goutte_run_duration_seconds', time.monotonic() - started,
+                **labels)
+    metrics.set('goutte_last_run_timestamp_seconds', time.time(), **labels)
+    metrics.set('goutte_last_run_success', 0 if error else 1, **labels)
+    if conf.get('metrics_file') and not account:
+        _write_metrics(conf['metrics_file'])
+    return error
+
+
+def _run_sync(conf: Dict[str, Any], only: Optional[str]) -> int:
+    """Run the pipeline with the thread pools, return the error code
+
+    The groups run by priority. With a deadline, their resources run the
+    most overdue first and the ones not started in time are deferred.
+    """
+    deadline = (time.monotonic() + conf['deadline']
+                if conf.get('deadline') else None)
+    taken = set()  # type: Taken
+    # Snapshots kept per resource id, for the report
+    kept = None if only == 'snapshot' else {}  # type: Optional[Dict]
+    # Creation of the last goutte snapshot per resource id, for the order
+    latest = {} if deadline else None  # type: Optional[Dict]
+    error, expired = _expired(conf, only, taken, kept, latest)
+    unlisted = _unlisted(conf, only, error)
+    deletions = []  # type: List[Deletion]
+    actions = {}  # type: Dict[int, str]
+    for group in _priorities(conf):
+        if group[:-1] in unlisted:
+            continue
+        if group == 'droplets':
+            error |= _process_droplets(
+                conf, only, expired, deletions,
+                actions if conf.get('wait') else None, taken,
+                deadline, latest)
+        else:
+            error |= _process_volumes(conf, only, expired, deletions, taken,
+                                      deadline, latest)
+    error |= _delete_snapshots(deletions, conf.get(
+        'delete_concurrency', conf.get('concurrency', 1)), deadline)
+    if kept is not None:
+        report.kept(_account_name(), kept)
+    if actions:
+        timeout = conf.get('wait_timeout', 3600)
+        if deadline:
+            timeout = max(min(timeout, deadline - time.monotonic()), 0)
+        error |= _wait_actions(actions, timeout,
+                               conf.get('poll_interval', 10))
+    return error
+
+
+def _run_accounts(conf: Dict[str, Any], only: Optional[str],
+                  engine: str = 'sync') -> int:
+    """Run every configured account in parallel, return the combined error
+    code
+
+    The accounts sharing a token share their listings and snapshot each
+    resource once.
+    """
+    global coalescer
+    accounts = _accounts(conf)
+    tokens = [os.environ.get(account['token_env']) for account in accounts]
+    if len(set(tokens)) < len(tokens):
+        coalescer = Coalescer()
+    # The accounts sharing a token share its rate limit, and so a scheduler
+    # paced at the lowest of their rates
+    schedulers = {account_token: Scheduler(min(
+        account_conf.get('requests_per_minute', 250)
+        for account_conf, other in zip(accounts, tokens)
+        if other == account_token)) for account_token in tokens
+        if account_token}
+    try:
+        with ThreadPoolExecutor(max_workers=len(accounts)) as executor:
+            results = list(executor.map(
+                lambda account_conf: _run_account(account_conf, only,
+                                                  engine, schedulers),
+                accounts))
+    finally:
+        if coalescer:
+            log.debug(f'Shared {coalescer.shared} listings between the '
+                      f'accounts with the same token')
+        coalescer = None
+    # The accounts share the registry, it is written once they all ran
+    for path in sorted({account_conf['metrics_file'] for account_conf
+                        in accounts if account_conf.get('metrics_file')}):
+        _write_metrics(path)
+    for account_conf, (error, summary) in zip(accounts, results):
+        if error:
+            log.error(f'{account_conf["name"]} - Failed, {summary}')
+        else:
+            log.info(f'{account_conf["name"]} - Done, {summary}')
+    return 1 if any(error for error, _ in results) else 0
+
+
+def _run_account(conf: Dict[str, Any], only: Optional[str], engine: str,
+                 schedulers: Dict[str, Scheduler]) -> Tuple[int, str]:
+    """Run one account with its own token and the scheduler of its token
+
+    Return the error code and a summary of the run.
+    """
+    account_token = os.environ.get(conf['token_env'])
+    if not account_token:
+        log.error(f'{conf["name"]} - {conf["token_env"]} is not set')
+        return 1, 'no token'
+    account = Account(conf['name'], account_token,
+                      schedulers[account_token])
+    _local.account = account
+    started = time.monotonic()
+    try:
+        error = _run(conf, only, engine)
+    except Exception as e:
+        log.error(f'Unexpected exception: {e}')
+        error = 1
+    finally:
+        _local.account = None
+    return error, (f'{account.scheduler.summary()} in '
+                   f'{time.monotonic() - started:.1f}s')
+
+
+def _expired(conf: Dict[str, Any], only: Optional[str],
+             taken: Optional[Taken] = None,
+             kept: Optional[Dict[str, int]] = None,
+             latest: Optional[Dict[str, int]] = None
+             ) -> Tuple[int, Dict[str, List[retention.Snapshot]]]:
+    """Return the error code and the snapshots expired per resource id
+
+    The snapshots are planned page by page as they are listed, only the
+    goutte ones being kept until the plan is done. When given, taken is
+    filled with the snapshots of the current period of the groups with a
+    frequency, kept with the number of snapshots kept per resource id and
+    latest with the creation of the last goutte snapshot per resource id.
+    Taken and latest need the snapshots to be listed even when only
+    snapshotting.
+    """
+    import digitalocean
+    frequencies = _frequencies(conf) if taken is not None else {}
+    if only == 'snapshot' and not frequencies and latest is None:
+        return 0, {}
+    policies = _policies(conf) if only != 'snapshot' else {}
+    kinds = set(policies) | set(frequencies)
+    if latest is not None:
+        kinds |= {group[:-1] for group in ('droplets', 'volumes')
+                  if group in conf}
+    try:
+        snapshots = _get_snapshots(
+            next(iter(kinds)) if len(kinds) == 1 else None)
+        if frequencies:
+            snapshots = _record_taken(snapshots, frequencies, taken)
+        if latest is not None:
+            snapshots = _record_latest(snapshots, latest)
+        with _profiled('order'):
+            return 0, retention.plan(snapshots, policies, kept)
+    except digitalocean.baseapi.TokenError as e:
+        log.error(f'Token not valid: {e}')
+    except digitalocean.baseapi.DataReadError as e:
+        log.error(f'Could not read response: {e}')
+    except digitalocean.baseapi.JSONReadError as e:
+        log.error(f'Could not parse json: {e}')
+    except digitalocean.baseapi.NotFoundError as e:
+        log.error(f'Ressource not found: {e}')
+    except Exception as e:
+        log.error(f'Unexpected exception: {e}')
+    return 1, {}
+
+
+def _unlisted(conf: Dict[str, Any], only: Optional[str],
+              error: int) -> Set[str]:
+    """Return the resource types with a frequency not to snapshot when
+    the snapshots could not be listed, those of the current period being
+    unknown
+    """
+    if not error or only == 'prune':
+        return set()
+    unlisted = set(_frequencies(conf))
+    for kind in sorted(unlisted):
+        log.error(f'Not snapshotting the {kind}s, their snapshots of this '
+                  f'period could not be listed')
+    return unlisted
+
+
+def _plan(conf: Dict[str, Any], only: Optional[str]
+          ) -> Tuple[int, Dict[str, Any]]:
+    """List the resources and plan a run without changing anything
+
+    Return the error code and the plan of the snapshots to take, the
+    snapshots to delete and an estimate of the requests and time needed.
+    """
+    started, requests = time.monotonic(), _scheduler().requests
+    taken = set()  # type: Taken
+    error, expired = _expired(conf, only, taken)
+    unlisted = _unlisted(conf, only, error)
+    frequencies = _frequencies(conf)
+    snapshots, deletions = [], []
+    for kind, get_resources in (('droplet', _get_droplets),
+                                ('volume', _get_volumes)):
+        group = conf.get(f'{kind}s')
+        if group is None or kind in unlisted:
+            continue
+        try:
+            for resource in get_resources(group.get('names', []),
+                                          group.get('tags', [])):
+                for snapshot in expired.get(str(resource.id), []):
+                    deletions.append({
+                        'kind': kind, 'resource': resource.name,
+                        'id': snapshot.id, 'name': snapshot.name,
+                        'created_at': retention.isoformat(
+                            snapshot.created_at)})
+                name = _snapshot_name(resource.name, frequencies.get(kind))
+                if only != 'prune' and not _taken(
+                        resource.id, resource.name, name, taken):
+                    snapshots.append({
+                        'kind': kind, 'id': resource.id,
+                        'name': resource.name, 'snapshot': name})
+        except Exception as e:
+            log.error(f'Could not list the {kind}s: {e}')
+            error = 1
+    listing = _scheduler().requests - requests
+    latency = (time.monotonic() - started) / max(listing, 1)
+    planned = len(snapshots) + len(deletions)
+    return error, {
+        'account': _cache_key(()),
+        'created_at': datetime.utcnow().strftime('%Y-%m-%dT%H:%M:%SZ'),
+        'snapshots': snapshots,
+        'deletions': deletions,
+        'requests': {'listing': listing, 'snapshot': len(snapshots),
+                     'delete': len(deletions)},
+        'estimated_seconds': round(max(
+            _scheduler().estimate(planned),
+            latency * planned / int(conf.get('concurrency', 1))), 1),
+    }
+
+
+def _write_plan(conf: Dict[str, Any], only: Optional[str],
+                output: click.File) -> int:
+    """Write the plan of a run as json, return the error code"""
+    error, plan = _plan(conf, only)
+    json.dump(plan, output, indent=2, sort_keys=True)
+    output.write('\n')
+    log.info(f'Planned {len(plan["snapshots"])} snapshots and '
+             f'{len(plan["deletions"])} deletions, '
+             f'{sum(plan["requests"].values())} API requests, '
+             f'about {plan["estimated_seconds"]}s')
+    return error
+
+
+def _apply(conf: Dict[str, Any], plan_file: click.File) -> int:
+    """Take and delete the snapshots of a plan, return the error code
+
+    Nothing is listed again, the plan must come from the same account.
+    """
+    try:
+        plan = json.load(plan_file)
+        if plan['account'] != _cache_key(()):
+            log.critical('The plan was made with another token')
+            return 1
+        snapshots = [_Planned(**entry) for entry in plan['snapshots']]
+        deletions = [(entry['resource'], retention.Snapshot(
+            entry['id'], entry['name'],
+            retention.epoch(entry['created_at']), None, entry['kind'], True))
+            for entry in plan['deletions']]
+    except (ValueError, KeyError, TypeError) as e:
+        log.critical(f'Malformated plan {plan_file.name}: {e}')
+        return 1
+    log.info(f'Applying the plan of {plan["created_at"]}')
+    actions = {}  # type: Dict[int, str]
+
+    def process(planned: _Planned) -> int:
+        record = _record(planned.kind, planned.id, planned.name)
+        with report.stage(record, 'snapshot'):
+            if planned.kind == 'droplet':
+                error = _snapshot_droplet(
+                    Resource(planned.id, planned.name),
+                    actions if conf.get('wait') else None, planned.snapshot)
+            else:
+                error = _snapshot_volume(Resource(planned.id, planned.name),
+                                         planned.snapshot)
+        if error:
+            report.update(record, failed=True)
+        return error
+    error = _run_pool('snapshots', snapshots, process,
+                      conf.get('concurrency', 1)) if snapshots else 0
+    error |= _delete_snapshots(deletions, conf.get(
+        'delete_concurrency', conf.get('concurrency', 1)))
+    if actions:
+        error |= _wait_actions(actions, conf.get('wait_timeout', 3600),
+                               conf.get('poll_interval', 10))
+    _log_scheduler_summary()
+    return error
+
+
+def _open_cache(conf: Dict[str, Any]) -> 'Cache':
+    """Open the on disk cache configured by cache_dir and cache_ttl"""
+    from goutte.cache import Cache
+    path = os.path.join(os.path.expanduser(conf['cache_dir']),
+                        'goutte.sqlite')
+    log.debug(f'Using the cache in {path}')
+    return Cache(path, conf.get('cache_ttl', 3600))
+
+
+def _open_journal(conf: Dict[str, Any]) -> 'Journal':
+    """Open the run journal configured by journal_file"""
+    from goutte.journal import Journal
+    path = os.path.expanduser(conf['journal_file'])
+    log.debug(f'Journaling the snapshots and deletions in {path}')
+    return Journal(path)
+
+
+def _write_metrics(path: str) -> None:
+    """Write the metrics for the node exporter textfile collector"""
+    try:
+        metrics.write(os.path.expanduser(path))
+    except OSError as e:
+        log.error(f'Could not write the metrics: {e}')
+
+
+def _write_profile(directory: str) -> None:
+    """Stop profiling and write the profiles of the stages"""
+    global profiler
+    try:
+        profiler.stop()
+        for line in profiler.write(directory):
+            log.info(line)
+        log.info(f'Wrote the profiles of the stages in {directory}')
+    except OSError as e:
+        log.error(f'Could not write the profiles: {e}')
+    finally:
+        profiler = None
+
+
+def _log_scheduler_summary() -> None:
+    """Report the API requests, retries and wait time of the run"""
+    if _scheduler().retries:
+        log.info(f'Rate limited: {_scheduler().summary()}')
+    else:
+        log.debug(_scheduler().summary())
+
+
 def _load_config(config: click.File) -> Dict[str, Dict]:
     """Return a config dict from a toml config file"""
+    import toml
     try:
-        # TODO check minimum validity (retention)
         log.debug('Loading config from {}'.format(config.name))
         conf = toml.load(config)
-        assert conf['retention']
+        for account_conf in (_accounts(conf) if 'accounts' in conf
+                             else [conf]):
+            _policies(account_conf)
+            _frequencies(account_conf)
+            _priorities(account_conf)
+            for key in ('concurrency', 'delete_concurrency', 'deadline'):
+                if key in account_conf and int(account_conf[key]) < 1:
+                    raise ValueError(f'{key} must be at least 1')
+        conf.setdefault('concurrency', 1)
         return conf
     except TypeError as e:
         log.critical('Could not read conf {}: {}'.format(config.name, e))
@@ -57,58 +559,253 @@ def _load_config(config: click.File) -> Dict[str, Dict]:
     except KeyError as e:
         log.critical('Malformated configuration: {} is missing'.format(e))
         sys.exit(1)
+    except ValueError as e:
+        log.critical('Malformated configuration: {}'.format(e))
+        sys.exit(1)
+
+
+def _accounts(conf: Dict[str, Any]) -> List[Dict[str, Any]]:
+    """Return the configuration of each [[accounts]] block
+
+    The top level keys apply to every account unless overridden, except the
+    droplets and volumes groups. Raise ValueError when an account is not
+    valid.
+    """
+    defaults = {key: value for key, value in conf.items()
+                if key not in ('accounts', 'droplets', 'volumes')}
+    accounts = []
+    for number, account in enumerate(conf['accounts'], 1):
+        account = dict(defaults, **account)
+        account.setdefault('name', f'account{number}')
+        if 'token_env' not in account:
+            raise ValueError(f'token_env of {account["name"]} is missing')
+        accounts.append(account)
+    names = [account['name'] for account in accounts]
+    if not names or len(set(names)) != len(names):
+        raise ValueError('accounts need distinct names')
+    return accounts
+
+
+def _policies(conf: Dict[str, Any]) -> Dict[str, retention.Policy]:
+    """Return the retention policies per resource type of the configured
+    groups, raise ValueError when one of them is not valid
+    """
+    groups = [group for group in ('droplets', 'volumes') if group in conf]
+    return {group[:-1]: retention.policy(conf, group)
+            for group in groups or ['droplets']}
+
+
+def _frequencies(conf: Dict[str, Any]) -> Dict[str, str]:
+    """Return the snapshot frequency per resource type of the configured
+    groups which have one, raise ValueError when one of them is not valid
+    """
+    frequencies = {}
+    for group in ('droplets', 'volumes'):
+        if group not in conf:
+            continue
+        frequency = conf[group].get('frequency', conf.get('frequency'))
+        if frequency is None:
+            continue
+        if frequency not in FREQUENCIES:
+            raise ValueError(f'frequency of {group} must be one of '
+                             f'{", ".join(FREQUENCIES)}')
+        frequencies[group[:-1]] = frequency
+    return frequencies
+
+
+def _priorities(conf: Dict[str, Any]) -> List[str]:
+    """Return the resource groups, the highest priority first, raise
+    ValueError when a priority is not an integer
+    """
+    groups = ['droplets', 'volumes']
+    for group in groups:
+        priority = conf.get(group, {}).get('priority', 0)
+        if not isinstance(priority, int):
+            raise ValueError(f'priority of {group} must be an integer')
+    return sorted(groups, key=lambda group: -conf.get(group, {}).get(
+        'priority', 0))
+
+
+def _record_latest(snapshots: Iterable[retention.Snapshot],
+                   latest: Dict[str, int]) -> Iterator[retention.Snapshot]:
+    """Yield the snapshots, recording the creation of the last goutte
+    snapshot per resource id in latest
+    """
+    for snapshot in snapshots:
+        if snapshot.owned and snapshot.created_at > latest.get(
+                snapshot.resource_id, 0):
+            latest[snapshot.resource_id] = snapshot.created_at
+        yield snapshot
+
+
+def _overdue_first(resources: Iterable[Resource], latest: Dict[str, int]
+                   ) -> List[Resource]:
+    """Return the resources, the ones snapshotted the longest ago first and
+    never snapshotted ones before them
+    """
+    return sorted(resources,
+                  key=lambda resource: latest.get(str(resource.id), 0))
+
+
+def _out_of_time(deadline: Optional[float], durations: List[float]) -> bool:
+    """Tell if work started now would likely end after the deadline, from
+    the mean duration of the work done so far
+    """
+    if deadline is None:
+        return False
+    margin = sum(durations) / len(durations) if durations else 0
+    return time.monotonic() + margin >= deadline
+
+
+def _defer(kind: str, resources: List[Resource]) -> None:
+    """Report the resources left for the next run"""
+    log.warning(f'Deadline reached, deferred {len(resources)} {kind}s to '
+                f'the next run: '
+                f'{", ".join(resource.name for resource in resources)}')
+    for resource in resources:
+        report.update(_record(kind, resource.id, resource.name),
+                      deferred=True)
+
+
+def _record_taken(snapshots: Iterable[retention.Snapshot],
+                  frequencies: Dict[str, str],
+                  taken: Taken) -> Iterator[retention.Snapshot]:
+    """Pass the listed snapshots through, recording in taken the goutte
+    ones named after the current period of their resource type
+    """
+    suffixes = {kind: '-' + time.strftime(FREQUENCIES[frequency])
+                for kind, frequency in frequencies.items()}
+    for snapshot in snapshots:
+        suffix = suffixes.get(snapshot.resource_type)
+        if suffix and snapshot.owned and snapshot.name.endswith(suffix):
+            taken.add((snapshot.resource_id, snapshot.name))
+        yield snapshot
+
+
+def _taken(resource_id: Any, resource_name: str, name: str,
+           taken: Optional[Taken]) -> bool:
+    """Tell if the snapshot of the current period was already taken"""
+    if not taken or (str(resource_id), name) not in taken:
+        return False
+    log.info(f'{resource_name} - Already snapshotted this period ({name})')
+    return True
 
 
 def _process_droplets(conf: Dict[str, Union[Dict[str, str], str]],
-                      only: str) -> None:
-    """Execute snapshot and pruning on the droplets"""
+                      only: str,
+                      expired: Dict[str, List[retention.Snapshot]],
+                      deletions: List[Deletion],
+                      actions: Optional[Dict[int, str]] = None,
+                      taken: Optional[Taken] = None,
+                      deadline: Optional[float] = None,
+                      latest: Optional[Dict[str, int]] = None) -> int:
+    """Execute snapshot and pruning on the droplets, return the error code
+
+    Droplets are processed as their listing pages arrive, or once listed
+    the most overdue first when given the latest snapshots. The snapshots
+    expired by the retention plan are queued in deletions and the snapshot
+    actions are recorded in actions when given. Droplets which already have
+    their snapshot of the period in taken are not snapshotted again, and
+    the ones not started before the deadline are deferred.
+    """
+    import digitalocean
+    if 'droplets' not in conf:
+        return 0
+    frequency = _frequencies(conf).get('droplet')
     try:
-        droplets = _get_droplets(conf['droplets']['names'])
-        if droplets:
-            log.debug(f'Found {len(droplets)} matching droplets')
-            for droplet in droplets:
-                log.debug(f'Processing {droplet.name}')
-                if only == 'prune' or not only:
-                    _prune_droplet_snapshots(droplet, conf['retention'])
-                if only == 'snapshot' or not only:
-                    _snapshot_droplet(droplet)
-        else:
-            log.warning('No matching droplet found')
-    except KeyError:
-        droplets = None
+        droplets = _get_droplets(conf['droplets'].get('names', []),
+                                 conf['droplets'].get('tags', []))
+        if latest is not None:
+            droplets = _overdue_first(droplets, latest)
+
+        def process(droplet: Resource) -> int:
+            log.debug(f'Processing {droplet.name}')
+            record = _record('droplet', droplet.id, droplet.name)
+            error = 0
+            if only == 'prune' or not only:
+                with metrics.stage('prune', 'droplet'), report.stage(
+                        record, 'prune'):
+                    _prune(droplet.name, expired.get(str(droplet.id), []),
+                           deletions)
+            name = _snapshot_name(droplet.name, frequency) if (
+                frequency) else None
+            if (only == 'snapshot' or not only) and not _taken(
+                    droplet.id, droplet.name, name, taken) and not _claimed(
+                    'droplet', droplet.id, droplet.name):
+                with metrics.stage('snapshot', 'droplet'), report.stage(
+                        record, 'snapshot'), _profiled('create'):
+                    error |= _snapshot_droplet(droplet, actions, name)
+            if error:
+                report.update(record, failed=True)
+            return error
+        return _run_pool('droplets', droplets, process,
+                         conf.get('concurrency', 1), deadline)
     except KeyboardInterrupt:
         log.critical('Received interuption signal')
         sys.exit(1)
+    except digitalocean.baseapi.TokenError as e:
+        log.error(f'Token not valid: {e}')
+    except digitalocean.baseapi.DataReadError as e:
+        log.error(f'Could not read response: {e}')
+    except digitalocean.baseapi.JSONReadError as e:
+        log.error(f'Could not parse json: {e}')
+    except digitalocean.baseapi.NotFoundError as e:
+        log.error(f'Ressource not found: {e}')
+    except Exception as e:
+        log.error(f'Unexpected exception: {e}')
+    return 1
 
 
 def _process_volumes(conf: Dict[str, Union[Dict[str, str], str]],
-                     only: str) -> None:
-    """Execute snapshot and pruning on the volumes"""
+                     only: str,
+                     expired: Dict[str, List[retention.Snapshot]],
+                     deletions: List[Deletion],
+                     taken: Optional[Taken] = None,
+                     deadline: Optional[float] = None,
+                     latest: Optional[Dict[str, int]] = None) -> int:
+    """Execute snapshot and pruning on the volumes, return the error code
+
+    Volumes are processed as their listing pages arrive, or once listed
+    the most overdue first when given the latest snapshots. The snapshots
+    expired by the retention plan are queued in deletions. Volumes which
+    already have their snapshot of the period in taken are not snapshotted
+    again, and the ones not started before the deadline are deferred.
+    """
+    import digitalocean
+    if 'volumes' not in conf:
+        return 0
+    frequency = _frequencies(conf).get('volume')
     try:
-        volumes = _get_volumes(conf['volumes']['names'])
-        if volumes:
-            log.debug(f'Found {len(volumes)} matching volumes')
-            for volume in volumes:
-                log.debug(f'Processing {volume.name}')
-                if only == 'prune' or not only:
-                    _prune_volume_snapshots(volume, conf['retention'])
-                if only == 'snapshot' or not only:
-                    _snapshot_volume(volume)
-        else:
-            log.warning('No matching volume found')
-    except KeyError:
-        pass
+        volumes = _get_volumes(conf['volumes'].get('names', []),
+                               conf['volumes'].get('tags', []))
+        if latest is not None:
+            volumes = _overdue_first(volumes, latest)
+
+        def process(volume: Resource) -> int:
+            log.debug(f'Processing {volume.name}')
+            record = _record('volume', volume.id, volume.name)
+            error = 0
+            if only == 'prune' or not only:
+                with metrics.stage('prune', 'volume'), report.stage(
+                        record, 'prune'):
+                    _prune(volume.name, expired.get(str(volume.id), []),
+                           deletions)
+            name = _snapshot_name(volume.name, frequency) if (
+                frequency) else None
+            if (only == 'snapshot' or not only) and not _taken(
+                    volume.id, volume.name, name, taken) and not _claimed(
+                    'volume', volume.id, volume.name):
+                with metrics.stage('snapshot', 'volume'), report.stage(
+                        record, 'snapshot'), _profiled('create'):
+                    error |= _snapshot_volume(volume, name)
+            if error:
+                report.update(record, failed=True)
+            return error
+        return _run_pool('volumes', volumes, process,
+                         conf.get('concurrency', 1), deadline)
     except KeyboardInterrupt:
         log.critical('Received interuption signal')
         sys.exit(1)
-
-
-def _get_droplets(names: List[str]) -> List[digitalocean.Droplet]:
-    """Get the droplets objects from the configuration doplets names"""
-    try:
-        manager = digitalocean.Manager(token=token)
-        droplets = manager.get_all_droplets()
-        return [droplet for droplet in droplets if droplet.name in names]
     except digitalocean.baseapi.TokenError as e:
         log.error(f'Token not valid: {e}')
     except digitalocean.baseapi.DataReadError as e:
@@ -119,147 +816,598 @@ def _get_droplets(names: List[str]) -> List[digitalocean.Droplet]:
         log.error(f'Ressource not found: {e}')
     except Exception as e:
         log.error(f'Unexpected exception: {e}')
+    return 1
 
 
-def _snapshot_droplet(droplet: digitalocean.Droplet) -> None:
-    """Take a snapshot of a given droplet"""
-    global error
-    name = 'goutte-{}-{}-{}'.format(
-        droplet.name,
-        date.today().strftime('%Y%m%d'),
-        uuid.uuid4().hex[:5])
+def _run_pool(kind: str, resources: Iterable[Any],
+              process: Callable[[Any], int], concurrency: int,
+              deadline: Optional[float] = None) -> int:
+    """Run the per resource pipeline on a fixed size thread pool
+
+    Resources are submitted as they are listed, at most twice as many as
+    the workers being queued so the listing does not run ahead of them.
+    Failures are reported in the resources order so the summary does not
+    depend on which worker finished first. Once a resource would likely
+    end after the deadline, the remaining ones are deferred.
+    """
+    durations = []  # type: List[float]
+    deferred = []  # type: List[Any]
+
+    def timed(resource: Any) -> int:
+        if _out_of_time(deadline, durations):
+            deferred.append(resource)
+            return 0
+        started = time.monotonic()
+        try:
+            return process(resource)
+        finally:
+            durations.append(time.monotonic() - started)
+    bound = _bind(timed)
+    pending = {}  # type: Dict[Any, Tuple[int, str]]
+    failed = []  # type: List[Tuple[int, str]]
+
+    def collect(futures: Iterable[Any]) -> None:
+        for future in futures:
+            if future.result():
+                failed.append(pending[future])
+            del pending[future]
+    count = 0
+    with ThreadPoolExecutor(max_workers=int(concurrency)) as executor:
+        for count, resource in enumerate(resources, 1):
+            if len(pending) >= 2 * int(concurrency):
+                collect(wait(pending, return_when=FIRST_COMPLETED).done)
+            pending[executor.submit(bound, resource)] = (count,
+                                                         resource.name)
+        collect(list(pending))
+    if not count:
+        log.warning(f'No matching {kind} found')
+        return 0
+    if deferred:
+        _defer(kind[:-1], deferred)
+    log.debug(f'Processed {count - len(failed) - len(deferred)}/{count} '
+              f'{kind}')
+    if failed:
+        log.warning(f'Failed {kind}: '
+                    f'{", ".join(name for _, name in sorted(failed))}')
+        return 1
+    return 0
+
+
+def _get_snapshots(resource_type: Optional[str] = None
+                   ) -> Iterator[retention.Snapshot]:
+    """Yield the records of the account snapshots, of a resource type when
+    given, as their pages arrive
+
+    A shard only keeps, and caches, the goutte snapshots of its resources.
+    """
+    key = ('snapshots', resource_type) if resource_type else ('snapshots',)
+    params = {'resource_type': resource_type} if resource_type else {}
+    if shard:
+        listing = _listing(
+            key + (f'shard{shard.index}of{shard.count}',),
+            lambda attributes: attributes['name'].startswith(
+                retention.MARKER) and _in_shard(
+                attributes['resource_type'], attributes['resource_id']),
+            **params)
+    else:
+        listing = _listing(key, **params)
+    return map(_resolver(), listing)
+
+
+def _resolver() -> Callable[[Dict[str, Any]], retention.Snapshot]:
+    """Return the function recording the listed snapshots, profiling each
+    record only when --profile is given as entering a stage costs about
+    half of a record
+    """
+    return _resolve if profiler else retention.record
+
+
+def _resolve(attributes: Dict[str, Any]) -> retention.Snapshot:
+    """Return the record of a listed snapshot"""
+    with _profiled('resolve'):
+        return retention.record(attributes)
+
+
+def _get_droplets(names: List[str], tags: Optional[List[str]] = None
+                  ) -> Iterator[Resource]:
+    """Yield the droplets matching the configuration names and tags as their
+    pages arrive, the ones of the current shard only
+
+    Tagged droplets are filtered by the API. When droplets are also
+    selected by name, the whole inventory is listed once and matched on
+    both instead, the tagged listings being part of it.
+    """
+    wanted, tagged = set(names), set(tags or [])
+    if names:
+        listings = [(_listing(('droplets',)), True)]
+    else:
+        listings = [(_listing(('droplets', tag), tag_name=tag), False)
+                    for tag in tagged]
+    seen, found = set(), set()  # type: Set[Any], Set[str]
+    for listing, match in listings:
+        for attributes in listing:
+            if attributes['id'] in seen or match and not (
+                    attributes['name'] in wanted or
+                    tagged.intersection(attributes.get('tags') or [])):
+                continue
+            seen.add(attributes['id'])
+            found.add(attributes['name'])
+            if _in_shard('droplet', attributes['id']):
+                yield Resource(attributes['id'], attributes['name'])
+    _warn_missing('droplets', names, found)
+
+
+def _snapshot_droplet(droplet: Resource,
+                      actions: Optional[Dict[int, str]] = None,
+                      name: Optional[str] = None) -> int:
+    """Take a snapshot of a given droplet, return the error code
+
+    The snapshot is not waited for, its action id is recorded in actions
+    when given. A name is given for the snapshots of a period or of a plan,
+    only a snapshot journaled under that name counts as taken.
+    """
+    import digitalocean
+    target = f'droplet:{droplet.id}'
+    done = _journaled_snapshot(target, name)
+    if done:
+        log.info(f'{droplet.name} - Already snapshotted ({done["snapshot"]})')
+        if actions is not None and done.get('action_id'):
+            actions[done['action_id']] = droplet.name
+        return 0
+    name = name or _snapshot_name(droplet.name)
     try:
-        droplet.take_snapshot(name)
+        _journal('intent', 'snapshot', target, name=droplet.name,
+                 snapshot=name)
+        result = _provider().take_snapshot('droplet', droplet.id, name)
+        if result.error:
+            raise result.error
+        _journal('done', 'snapshot', target, name=droplet.name,
+                 snapshot=name, action_id=result.value)
+        _invalidate('snapshots')
+        report.update(snapshot=name)
         log.info(f'{droplet.name} - Snapshot ({name})')
+        if actions is not None:
+            actions[result.value] = droplet.name
+        return 0
     except digitalocean.baseapi.TokenError as e:
         log.error(f'Token not valid: {e}.')
-        error = 1
+        return 1
     except digitalocean.baseapi.DataReadError as e:
         log.error(f'Could not read response: {e}.')
-        error = 1
+        return 1
     except digitalocean.baseapi.JSONReadError as e:
         log.error(f'Could not parse json: {e}.')
-        error = 1
+        return 1
     except digitalocean.baseapi.NotFoundError as e:
         log.error(f'Ressource not found: {e}.')
-        error = 1
+        return 1
     except Exception as e:
         log.error(f'Unexpected exception: {e}.')
-        error = 1
+        return 1
+
+
+def _wait_actions(actions: Dict[int, str], timeout: float,
+                  interval: float) -> int:
+    """Poll the snapshot actions together until they end or time out
+
+    Each round lists the most recent account actions in one request, which
+    covers the actions just submitted. Return the error code.
+    """
+    deadline = time.monotonic() + timeout
+    pending = set(actions)
+    states = {}  # type: Dict[int, str]
+    provider = _provider()
+    log.debug(f'Waiting for {len(pending)} snapshots')
+    while pending:
+        try:
+            for action_id, status in provider.poll_actions(pending).items():
+                if status != 'in-progress':
+                    states[action_id] = status
+                    pending.discard(action_id)
+        except Exception as e:
+            log.error(f'Could not poll the snapshots actions: {e}')
+        if not pending or time.monotonic() + interval > deadline:
+            break
+        time.sleep(interval)
+    error = 0
+    for action_id, name in sorted(actions.items(), key=lambda x: x[1]):
+        state = states.get(action_id, 'timed-out')
+        if state == 'completed':
+            log.info(f'{name} - Snapshot completed')
+        else:
+            log.error(f'{name} - Snapshot {state}')
+            error = 1
+    return error
+
+
+def _prune(name: str, expired: List[retention.Snapshot],
+           deletions: List[Deletion]) -> None:
+    """Queue the snapshots of a resource expired by the retention plan for
+    deletion
+    """
+    if expired:
+        log.debug(f'{name} - Exceed retention policy by {len(expired)}')
+    for snapshot in expired:
+        log.info(f'{name} - Prune ({snapshot.name})')
+        deletions.append((name, snapshot))
+
 
+def _get_volumes(names: List[str], tags: Optional[List[str]] = None
+                 ) -> Iterator[Resource]:
+    """Yield the volumes matching the configuration names and tags as their
+    pages arrive, the ones of the current shard only
 
-def _prune_droplet_snapshots(droplet: digitalocean.Droplet,
-                             retention: int) -> None:
-    """Prune goutte snapshots if tmore than the configured retention time"""
-    global error
+    The API can not filter volumes by tag, they are matched on our side.
+    """
+    if not names and not tags:
+        return
+    wanted, tagged = set(names), set(tags or [])
+    found = set()  # type: Set[str]
+    for attributes in _listing(('volumes',)):
+        if (attributes['name'] in wanted or
+                tagged.intersection(attributes.get('tags') or [])):
+            found.add(attributes['name'])
+            if _in_shard('volume', attributes['id']):
+                yield Resource(attributes['id'], attributes['name'])
+    _warn_missing('volumes', names, found)
+
+
+def _snapshot_volume(volume: Resource,
+                     name: Optional[str] = None) -> int:
+    """Take a snapshot of a given volume, return the error code
+
+    A name is given for the snapshots of a period or of a plan, only a
+    snapshot journaled under that name counts as taken.
+    """
+    import digitalocean
+    target = f'volume:{volume.id}'
+    done = _journaled_snapshot(target, name)
+    if done:
+        log.info(f'{volume.name} - Already snapshotted ({done["snapshot"]})')
+        return 0
+    name = name or _snapshot_name(volume.name)
     try:
-        all_snapshots = _order_snapshots([
-            digitalocean.Snapshot.get_object(
-                api_token=token, snapshot_id=snapshot_id
-             ) for snapshot_id in droplet.snapshot_ids
-        ])
-        snapshots = [snapshot for snapshot in all_snapshots
-                     if snapshot.name[:6] == 'goutte']
-        if len(snapshots) > retention:
-            log.debug(f'{droplet.name} - Exceed retention policy by '
-                      f'{len(snapshots) - retention}')
-            for snapshot in snapshots[:len(snapshots)-retention]:
-                log.info(f'{droplet.name} - Prune ({snapshot.name})')
-                snapshot.destroy()
+        _journal('intent', 'snapshot', target, name=volume.name,
+                 snapshot=name)
+        result = _provider().take_snapshot('volume', volume.id, name)
+        if result.error:
+            raise result.error
+        _journal('done', 'snapshot', target, name=volume.name, snapshot=name)
+        _invalidate('snapshots')
+        report.update(snapshot=name)
+        log.info(f'{volume.name} - Snapshot ({name})')
+        return 0
     except digitalocean.baseapi.TokenError as e:
         log.error(f'Token not valid: {e}.')
-        error = 1
+        return 1
     except digitalocean.baseapi.DataReadError as e:
         log.error(f'Could not read response: {e}.')
-        error = 1
+        return 1
     except digitalocean.baseapi.JSONReadError as e:
         log.error(f'Could not parse json: {e}.')
-        error = 1
+        return 1
     except digitalocean.baseapi.NotFoundError as e:
         log.error(f'Ressource not found: {e}.')
-        error = 1
+        return 1
     except Exception as e:
         log.error(f'Unexpected exception: {e}.')
-        error = 1
+        return 1
+
+
+class Account:
+    """Token, request pacing and listings of one of the accounts"""
+
+    def __init__(self, name: str, token: str, scheduler: Scheduler) -> None:
+        self.name = name
+        self.token = token
+        self.scheduler = scheduler
+        self.inventory = {}  # type: Dict[Tuple[str, ...], Tuple[float, Any]]
+        self.provider = None  # type: Optional[Provider]
+
+
+class _AccountFilter(logging.Filter):
+    """Tag the log records with the account of the running thread"""
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        account = getattr(_local, 'account', None)
+        if account and not hasattr(record, 'account'):
+            record.account = account.name
+        return True
 
 
-def _get_volumes(names: List[str]) -> List[digitalocean.Volume]:
-    """Get the volumes objects from the configuration volume names"""
+handler.addFilter(_AccountFilter())
+
+
+def _token() -> Optional[str]:
+    """Return the token of the running account"""
+    account = getattr(_local, 'account', None)
+    return account.token if account else token
+
+
+def _scheduler() -> Scheduler:
+    """Return the scheduler of the running account"""
+    account = getattr(_local, 'account', None)
+    return account.scheduler if account else scheduler
+
+
+def _inventory() -> Dict[Tuple[str, ...], Tuple[float, Any]]:
+    """Return the in memory listings of the running account"""
+    account = getattr(_local, 'account', None)
+    return account.inventory if account else inventory
+
+
+def _bind(func: Callable[..., Any]) -> Callable[..., Any]:
+    """Return func running with the account of the calling thread, for the
+    thread pools workers
+    """
+    account = getattr(_local, 'account', None)
+
+    def bound(*args: Any) -> Any:
+        _local.account = account
+        try:
+            return func(*args)
+        finally:
+            _local.account = None
+    return bound
+
+
+def _provider() -> Provider:
+    """Return the provider of the current account, kept for the run of an
+    account, for a run and by the daemon to reuse its session
+    """
+    account = getattr(_local, 'account', None)
+    if account:
+        if account.provider is None:
+            account.provider = DigitalOcean(account.token, _call)
+        return account.provider
+    return shared_provider or DigitalOcean(token, _call)
+
+
+@contextmanager
+def _kept_provider() -> Iterator[None]:
+    """Keep a single provider, and its session, for a run outside of the
+    accounts and of the daemon which keep their own
+    """
+    global shared_provider
+    if shared_provider or getattr(_local, 'account', None):
+        yield
+        return
+    shared_provider = DigitalOcean(token, _call)
     try:
-        manager = digitalocean.Manager(token=token)
-        volumes = manager.get_all_volumes()
-        return [volume for volume in volumes if volume.name in names]
-    except digitalocean.baseapi.TokenError as e:
-        log.error(f'Token not valid: {e}')
-    except digitalocean.baseapi.DataReadError as e:
-        log.error(f'Could not read response: {e}')
-    except digitalocean.baseapi.JSONReadError as e:
-        log.error(f'Could not parse json: {e}')
-    except digitalocean.baseapi.NotFoundError as e:
-        log.error(f'Ressource not found: {e}')
-    except Exception as e:
-        log.error(f'Unexpected exception: {e}')
+        yield
+    finally:
+        shared_provider = None
+
+
+def _call(endpoint: str, func: Callable[..., Any], *args: Any,
+          **kwargs: Any) -> Any:
+    """Call the API through the scheduler, recording the call metrics,
+    counting it in the report and profiling the listings pages
+    """
+    with metrics.request(endpoint), report.request(), (
+            _profiled('list') if endpoint.startswith('list_') else IDLE):
+        return _scheduler().call(func, *args, **kwargs)
+
+
+def _listing(key: Tuple[str, ...],
+             select: Optional[Callable[[Dict[str, Any]], bool]] = None,
+             **params: Any) -> Iterator[Dict[str, Any]]:
+    """Yield the attributes of the resources of a listing as its pages
+    arrive, the ones matching select when given
+
+    Every page goes through the scheduler, so a throttled page is retried
+    instead of truncating the listing. The listing is cached for
+    inventory_ttl and in the on disk cache when one is configured, which
+    keeps it whole in memory while it is listed. A selected listing must
+    have its own key, only the selected resources being cached.
+    """
+    items = None
+    if inventory_ttl:
+        cached = _inventory().get(key)
+        if cached and time.monotonic() - cached[0] < inventory_ttl:
+            log.debug(f'Using cached {" ".join(key)} inventory')
+            items = cached[1]
+    if items is None and cache:
+        items = cache.get(_cache_key(key))
+        if items is not None:
+            log.debug(f'Using on disk cached {" ".join(key)} listing')
+    if items is None:
+        kept = [] if inventory_ttl or cache else None
+        for page in _pages(key, **params):
+            if select:
+                page = [attributes for attributes in page
+                        if select(attributes)]
+            if kept is not None:
+                kept += page
+            yield from page
+        if cache:
+            cache.set(_cache_key(key), kept)
+        items = kept
+    else:
+        yield from items
+    if inventory_ttl:
+        _inventory()[key] = (time.monotonic(), items)
+
+
+def _pages(key: Tuple[str, ...], **params: Any
+           ) -> Iterable[List[Dict[str, Any]]]:
+    """Return the pages of a listing, shared with the other accounts of the
+    run using the same token
+    """
+    if coalescer is None:
+        return _provider().pages(key[0], **params)
+    provider = _provider()
+    return coalescer.listing(_cache_key(key), _account_name(),
+                             lambda: provider.pages(key[0], **params))
 
 
-def _snapshot_volume(volume: digitalocean.Volume) -> None:
-    """Take a snapshot of a given volume"""
-    global error
-    name = 'goutte-{}-{}-{}'.format(
-        volume.name,
+def _invalidate(kind: str) -> None:
+    """Forget the cached listings of a kind of resources"""
+    listings = _inventory()
+    for key in [key for key in listings if key[0] == kind]:
+        listings.pop(key, None)
+    if cache:
+        cache.invalidate(_cache_key((kind,)))
+    if coalescer:
+        coalescer.invalidate(_cache_key((kind,)))
+
+
+def _in_shard(kind: str, resource_id: Any) -> bool:
+    """Tell if a resource belongs to the shard of the run, if any"""
+    return shard is None or sharding.owns(shard, kind, resource_id)
+
+
+def _profiled(stage: str) -> ContextManager[None]:
+    """Profile a stage of the pipeline when --profile is given"""
+    return profiler.stage(stage) if profiler else IDLE
+
+
+def _claimed(kind: str, resource_id: Any, resource_name: str) -> bool:
+    """Tell if another account of the run with the same token already
+    snapshots a resource
+    """
+    if coalescer is None:
+        return False
+    owner = coalescer.claim(_cache_key((kind, str(resource_id))),
+                            _account_name())
+    if owner == _account_name():
+        return False
+    log.info(f'{resource_name} - Already snapshotted by {owner}')
+    return True
+
+
+def _cache_key(key: Tuple[str, ...]) -> str:
+    """Return the on disk cache key of a listing for the current token"""
+    account = hashlib.sha256(str(_token()).encode()).hexdigest()[:16]
+    return ':'.join((account,) + key)
+
+
+def _account_name() -> Optional[str]:
+    """Return the name of the running account, None for a single one"""
+    account = getattr(_local, 'account', None)
+    return account.name if account else None
+
+
+def _record(kind: str, resource_id: Any,
+            name: Optional[str] = None) -> Record:
+    """Return the report record of a resource of the running account"""
+    return report.record(_account_name(), kind, resource_id, name)
+
+
+def _journaled(action: str, target: str) -> Optional[Dict[str, Any]]:
+    """Return the journal entry of an operation done today when resuming"""
+    if not (resuming and journal):
+        return None
+    return journal.completed(_cache_key(()), action, target)
+
+
+def _journaled_snapshot(target: str, name: Optional[str]
+                        ) -> Optional[Dict[str, Any]]:
+    """Return the journal entry of the snapshot of a resource taken today
+    when resuming, and named name when given
+    """
+    done = _journaled('snapshot', target)
+    if done and name and done.get('snapshot') != name:
+        return None
+    return done
+
+
+def _journal(event: str, action: str, target: str, **details: Any) -> None:
+    """Durably record an intended or done operation when journaling"""
+    if journal:
+        append = journal.intend if event == 'intent' else journal.complete
+        append(_cache_key(()), action, target, **details)
+
+
+def _log_interrupted() -> None:
+    """Warn about the operations a previous run started but did not finish"""
+    if not (resuming and journal):
+        return
+    for entry in journal.interrupted(_cache_key(())):
+        if entry['action'] == 'snapshot':
+            log.warning(f'{entry["name"]} - Interrupted snapshot '
+                        f'({entry["snapshot"]}), it may be taken twice')
+        else:
+            log.debug(f'{entry["name"]} - Interrupted deletion '
+                      f'({entry["snapshot"]}), deleting again')
+
+
+def _warn_missing(kind: str, names: List[str], found: Set[str]) -> None:
+    """Report the configured names which did not match any resource"""
+    missing = [name for name in names if name not in found]
+    if missing:
+        log.warning(f'Configured {kind} not found: {", ".join(missing)}')
+
+
+def _snapshot_name(resource_name: str,
+                   frequency: Optional[str] = None) -> str:
+    """Return a new goutte snapshot name for a given resource name
+
+    With a frequency, the name is the same for the whole current period.
+    """
+    if frequency:
+        return '{}{}-{}'.format(retention.MARKER, resource_name,
+                                time.strftime(FREQUENCIES[frequency]))
+    return '{}{}-{}-{}'.format(
+        retention.MARKER, resource_name,
         date.today().strftime('%Y%m%d'),
         uuid.uuid4().hex[:5])
-    try:
-        volume.snapshot(name)
-        log.info(f'{volume.name} - Snapshot ({name})')
-    except digitalocean.baseapi.TokenError as e:
-        log.error(f'Token not valid: {e}.')
-        error = 1
-    except digitalocean.baseapi.DataReadError as e:
-        log.error(f'Could not read response: {e}.')
-        error = 1
-    except digitalocean.baseapi.JSONReadError as e:
-        log.error(f'Could not parse json: {e}.')
-        error = 1
-    except digitalocean.baseapi.NotFoundError as e:
-        log.error(f'Ressource not found: {e}.')
-        error = 1
-    except Exception as e:
-        log.error(f'Unexpected exception: {e}.')
-        error = 1
 
 
-def _prune_volume_snapshots(volume: digitalocean.Volume,
-                            retention: int) -> None:
-    """Prune goutte snapshots if tmore than the configured retention time"""
-    global error
-    try:
-        all_snapshots = _order_snapshots(volume.get_snapshots())
-        snapshots = [snapshot for snapshot in all_snapshots
-                     if snapshot.name[:6] == 'goutte']
-        if len(snapshots) > retention:
-            log.debug(f'{volume.name} - Exceed retention policy by '
-                      f'{len(snapshots) - retention}')
-            for snapshot in snapshots[:len(snapshots)-retention]:
-                log.info(f'{volume.name} - Prune ({snapshot.name})')
-                snapshot.destroy()
-    except digitalocean.baseapi.TokenError as e:
-        log.error(f'Token not valid: {e}.')
-        error = 1
-    except digitalocean.baseapi.DataReadError as e:
-        log.error(f'Could not read response: {e}.')
-        error = 1
-    except digitalocean.baseapi.JSONReadError as e:
-        log.error(f'Could not parse json: {e}.')
-        error = 1
-    except digitalocean.baseapi.NotFoundError as e:
-        log.error(f'Ressource not found: {e}.')
-        error = 1
-    except Exception as e:
-        log.error(f'Unexpected exception: {e}.')
-        error = 1
+def _delete_snapshots(deletions: List[Deletion], concurrency: int,
+                      deadline: Optional[float] = None) -> int:
+    """Delete the queued snapshots in parallel, return the error code
 
+    Snapshots already gone (404) count as deleted. The deletions not
+    started before the deadline are deferred, the next run plans them
+    again.
+    """
+    if not deletions:
+        return 0
+    provider = _provider()
+    started = time.monotonic()
+    deferred = []  # type: List[Deletion]
 
-def _order_snapshots(snapshots: List[digitalocean.Snapshot]
-                     ) -> List[digitalocean.Snapshot]:
-    """Order snapshots by creation date"""
-    return sorted(snapshots, key=lambda x: x.created_at)
+    def delete(deletion: Deletion) -> int:
+        name, snapshot = deletion
+        target = f'snapshot:{snapshot.id}'
+        if _journaled('destroy', target):
+            log.debug(f'{name} - Already deleted ({snapshot.name})')
+            return 0
+        if _out_of_time(deadline, []):
+            deferred.append(deletion)
+            return 0
+        _journal('intent', 'destroy', target, name=name,
+                 snapshot=snapshot.name)
+        record = _record(snapshot.resource_type, snapshot.resource_id,
+                         name) if snapshot.resource_id else None
+        with _profiled('destroy'):
+            if record is None:
+                result = provider.delete_snapshot(snapshot.id)
+            else:
+                with report.stage(record, 'prune'):
+                    result = provider.delete_snapshot(snapshot.id)
+        if result.error:
+            log.error(f'{name} - Could not delete ({snapshot.name}): '
+                      f'{result.error}.')
+            if record is not None:
+                report.update(record, failed=True)
+            return 1
+        if not result.value:
+            log.debug(f'{name} - Already deleted ({snapshot.name})')
+        if record is not None:
+            report.deleted(record)
+        _journal('done', 'destroy', target, name=name,
+                 snapshot=snapshot.name)
+        return 0
+    with ThreadPoolExecutor(max_workers=int(concurrency)) as executor:
+        errors = list(executor.map(_bind(delete), deletions))
+    _invalidate('snapshots')
+    elapsed = time.monotonic() - started
+    deleted = len(errors) - sum(errors) - len(deferred)
+    log.info(f'Deleted {deleted}/{len(errors)} snapshots in {elapsed:.1f}s '
+             f'({deleted / max(elapsed, 0.001):.1f}/s)')
+    if deferred:
+        log.warning(f'Deadline reached, deferred {len(deferred)} snapshot '
+                    f'deletions to the next run')
+    return 1 if sum(errors) else 0
@@ -0,0 +1,180 @@
+"""Prometheus metrics of the API calls and the pipeline stages
+
+Metrics are rendered in the Prometheus text format. One-shot runs write
+them for the node exporter textfile collector and the daemon serves them
+over HTTP on /metrics.
+"""
+from contextlib import contextmanager
+from typing import TYPE_CHECKING, Any, Callable, Dict, Iterator, Tuple
+import os
+import tempfile
+import threading
+import time
+
+if TYPE_CHECKING:
+    from http.server import HTTPServer
+
+BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+
+METRICS = {
+    'goutte_api_requests_total': (
+        'counter', 'API calls, retries included'),
+    'goutte_api_errors_total': (
+        'counter', 'API calls that failed'),
+    'goutte_api_request_duration_seconds': (
+        'histogram', 'API calls latency, retries included'),
+    'goutte_stage_duration_seconds': (
+        'histogram', 'Time spent per resource in a pipeline stage'),
+    'goutte_run_duration_seconds': (
+        'gauge', 'Duration of the last run'),
+    'goutte_last_run_timestamp_seconds': (
+        'gauge', 'End time of the last run'),
+    'goutte_last_run_success': (
+        'gauge', 'Whether the last run ended without error'),
+}
+
+Labels = Tuple[Tuple[str, str], ...]
+
+
+class Metrics:
+    """Thread safe registry of counters, gauges and histograms"""
+
+    def __init__(self, clock: Callable[[], float] = time.perf_counter
+                 ) -> None:
+        self.clock = clock
+        self.lock = threading.Lock()
+        self.values = {name: {} for name in METRICS
+                       }  # type: Dict[str, Dict[Labels, Any]]
+
+    def inc(self, name: str, value: float = 1, **labels: str) -> None:
+        """Increase a counter"""
+        key = _labels(labels)
+        with self.lock:
+            self.values[name][key] = self.values[name].get(key, 0) + value
+
+    def set(self, name: str, value: float, **labels: str) -> None:
+        """Set a gauge"""
+        with self.lock:
+            self.values[name][_labels(labels)] = value
+
+    def observe(self, name: str, value: float, **labels: str) -> None:
+        """Record a value in a histogram"""
+        key = _labels(labels)
+        with self.lock:
+            buckets, total, count = self.values[name].get(
+                key, ([0] * len(BUCKETS), 0, 0))
+            buckets = [bucket + (value <= bound)
+                       for bucket, bound in zip(buckets, BUCKETS)]
+            self.values[name][key] = (buckets, total + value, count + 1)
+
+    @contextmanager
+    def request(self, endpoint: str) -> Iterator[None]:
+        """Count and time an API call"""
+        started = self.clock()
+        self.inc('goutte_api_requests_total', endpoint=endpoint)
+        try:
+            yield
+        except Exception as e:
+            self.inc('goutte_api_errors_total', endpoint=endpoint,
+                     error=type(e).__name__)
+            raise
+        finally:
+            self.observe('goutte_api_request_duration_seconds',
+                         self.clock() - started, endpoint=endpoint)
+
+    @contextmanager
+    def stage(self, stage: str, kind: str) -> Iterator[None]:
+        """Time a pipeline stage for one resource"""
+        started = self.clock()
+        try:
+            yield
+        finally:
+            self.observe('goutte_stage_duration_seconds',
+                         self.clock() - started, stage=stage, kind=kind)
+
+    def render(self) -> str:
+        """Return the metrics in the Prometheus text format"""
+        lines = []
+        with self.lock:
+            for name, (kind, description) in METRICS.items():
+                if not self.values[name]:
+                    continue
+                lines += [f'# HELP {name} {description}',
+                          f'# TYPE {name} {kind}']
+                for key, value in sorted(self.values[name].items()):
+                    if kind != 'histogram':
+                        lines.append(f'{name}{_render(key)} {value:g}')
+                        continue
+                    buckets, total, count = value
+                    for bound, bucket in zip(BUCKETS, buckets):
+                        lines.append(f'{name}_bucket'
+                                     f'{_render(key, le=f"{bound:g}")} '
+                                     f'{bucket}')
+                    lines += [
+                        f'{name}_bucket{_render(key, le="+Inf")} {count}',
+                        f'{name}_sum{_render(key)} {total:g}',
+                        f'{name}_count{_render(key)} {count}']
+        return '\n'.join(lines) + '\n'
+
+    def write(self, path: str) -> None:
+        """Atomically write the metrics for the textfile collector"""
+        descriptor, temporary = tempfile.mkstemp(
+            dir=os.path.dirname(path) or '.', suffix='.tmp')
+        try:
+            with os.fdopen(descriptor, 'w') as metrics_file:
+                metrics_file.write(self.render())
+            os.chmod(temporary, 0o644)
+            os.replace(temporary, path)
+        except BaseException:
+            os.unlink(temporary)
+            raise
+
+
+def serve(metrics: Metrics, address: str) -> 'HTTPServer':
+    """Serve the metrics on /metrics from a background thread
+
+    The address is host:port, the host defaulting to every interface.
+    """
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+    from socketserver import ThreadingMixIn
+
+    class Server(ThreadingMixIn, HTTPServer):
+        daemon_threads = True
+
+    host, _, port = address.rpartition(':')
+
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self) -> None:
+            if self.path.split('?')[0] != '/metrics':
+                self.send_error(404)
+                return
+            body = metrics.render().encode()
+            self.send_response(200)
+            self.send_header('Content-Type',
+                             'text/plain; version=0.0.4; charset=utf-8')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args: Any) -> None:
+            pass
+
+    server = Server((host, int(port)), Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def _labels(labels: Dict[str, str]) -> Labels:
+    """Return hashable labels"""
+    return tuple(sorted((key, str(value)) for key, value in labels.items()))
+
+
+def _render(key: Labels, **extra: str) -> str:
+    """Return the labels in the Prometheus text format"""
+    labels = list(key) + list(extra.items())
+    if not labels:
+        return ''
+    return '{' + ','.join(
+        '{}="{}"'.format(name, value.replace('\\', '\\\\')
+                         .replace('"', '\\"').replace('\n', '\\n'))
+        for name, value in labels) + '}'
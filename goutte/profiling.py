@@ -0,0 +1,219 @@
+"""Profiles of the pipeline stages, written by --profile
+
+Each stage (the listings, the resolution of the listed snapshots, their
+ordering by the retention, the deletions and the snapshots) gets a cProfile
+profile, its time and the memory tracemalloc saw it allocate, and the top
+allocation sites of its first run. A stage running inside another one, like
+the listing pulled page by page by the retention, is only counted in the
+inner one. Before Python 3.12 a profile only sees the thread it runs in,
+from 3.12 it sees every thread and a single one runs at once: the profiles
+are exact with --concurrency 1.
+"""
+from collections import defaultdict
+from contextlib import contextmanager
+from typing import Any, Dict, Iterator, List, Optional, Tuple
+import os
+import threading
+import time
+
+TOP = 10
+
+# Frames kept per allocation, the allocation sites being single lines
+FRAMES = 1
+
+# Stage and cProfile profile of one of the threads
+Profile = Tuple[str, Any]
+
+
+class Profiler:
+    """Thread safe collection of the profiles of the stages of a run"""
+
+    def __init__(self, top: int = TOP) -> None:
+        self.top = top
+        self.lock = threading.Lock()
+        self.local = threading.local()
+        self.profiles = []  # type: List[Profile]
+        self.runs = defaultdict(int)  # type: Dict[str, int]
+        self.seconds = defaultdict(float)  # type: Dict[str, float]
+        self.allocated = defaultdict(int)  # type: Dict[str, int]
+        self.sites = {}  # type: Dict[str, List[Any]]
+
+    def start(self) -> None:
+        """Start tracing the allocations"""
+        import tracemalloc
+        tracemalloc.start(FRAMES)
+
+    def stop(self) -> None:
+        """Stop tracing the allocations"""
+        import tracemalloc
+        tracemalloc.stop()
+
+    @contextmanager
+    def stage(self, name: str) -> Iterator[None]:
+        """Profile a stage, pausing the profile of the stage it runs in"""
+        import tracemalloc
+        stack = self.local.__dict__.setdefault('stack', [])
+        if stack and stack[-1].name == name:
+            yield
+            return
+        if stack:
+            stack[-1].profile.disable()
+        entered = time.perf_counter()
+        entered_memory = tracemalloc.get_traced_memory()[0]
+        frame = _Frame(name, self._profile(name))
+        with self.lock:
+            first = name not in self.sites
+            if first:
+                self.sites[name] = []
+        # The allocations of the first run are compared, the snapshots
+        # being left out of the time and memory of the stages
+        before = tracemalloc.take_snapshot() if first else None
+        stack.append(frame)
+        memory = tracemalloc.get_traced_memory()[0]
+        started = time.perf_counter()
+        enabled = _enable(frame.profile)
+        try:
+            yield
+        finally:
+            if enabled:
+                frame.profile.disable()
+            elapsed = time.perf_counter() - started
+            allocated = tracemalloc.get_traced_memory()[0] - memory
+            stack.pop()
+            with self.lock:
+                self.runs[name] += 1
+                self.seconds[name] += elapsed - frame.children
+                self.allocated[name] += allocated - frame.allocated
+            if before is not None:
+                self.sites[name] = _sites(before, self.top)
+                del before
+            if stack:
+                stack[-1].children += time.perf_counter() - entered
+                stack[-1].allocated += (tracemalloc.get_traced_memory()[0] -
+                                        entered_memory)
+                _enable(stack[-1].profile)
+
+    def write(self, directory: str) -> List[str]:
+        """Write the profile of each stage and of the whole run as pstats
+        files with a summary of the stages, return the summary lines
+        """
+        import pstats
+        os.makedirs(directory, exist_ok=True)
+        merged = self._merged()
+        for name, stats in merged.items():
+            stats.dump_stats(os.path.join(directory, f'{name}.pstats'))
+        run = pstats.Stats()
+        run.add(*merged.values())
+        run.dump_stats(os.path.join(directory, 'goutte.pstats'))
+        summary = self.summary()
+        lines = []
+        for name in sorted(self.runs):
+            lines += ['', f'{name}: top {self.top} functions by own time']
+            lines += _functions(merged.get(name), self.top)
+            lines += ['', f'{name}: top {self.top} allocation sites of its '
+                          f'first run']
+            lines += [f'  {_kib(site.size_diff):>10} KiB '
+                      f'{site.count_diff:>7} blocks  '
+                      f'{site.traceback[0].filename}:'
+                      f'{site.traceback[0].lineno}'
+                      for site in self.sites[name] if site.size_diff > 0]
+        with open(os.path.join(directory, 'summary.txt'), 'w') as output:
+            output.write('\n'.join(summary + lines) + '\n')
+        return summary
+
+    def summary(self) -> List[str]:
+        """Return the runs, time and allocations of every stage"""
+        lines = [f'{"stage":<10} {"runs":>7} {"seconds":>10} '
+                 f'{"allocated KiB":>14}']
+        for name in sorted(self.runs, key=lambda name: -self.seconds[name]):
+            lines.append(f'{name:<10} {self.runs[name]:>7} '
+                         f'{self.seconds[name]:>10.3f} '
+                         f'{_kib(self.allocated[name]):>14}')
+        return lines
+
+    def _merged(self) -> Dict[str, Any]:
+        """Return the pstats of each stage, its threads profiles merged"""
+        import pstats
+        merged = {}  # type: Dict[str, pstats.Stats]
+        for name, profile in self.profiles:
+            # The profile of a thread which never got to be enabled, another
+            # one running, has no stats and pstats refuses it
+            profile.create_stats()
+            if not profile.stats:
+                continue
+            if name in merged:
+                merged[name].add(profile)
+            else:
+                merged[name] = pstats.Stats(profile)
+        return merged
+
+    def _profile(self, name: str) -> Any:
+        """Return the profile of a stage for the running thread"""
+        import cProfile
+        profiles = self.local.__dict__.setdefault('profiles', {})
+        if name not in profiles:
+            profiles[name] = cProfile.Profile()
+            with self.lock:
+                self.profiles.append((name, profiles[name]))
+        return profiles[name]
+
+
+class _Idle:
+    """Context of the stages when not profiling, doing nothing"""
+
+    def __enter__(self) -> None:
+        pass
+
+    def __exit__(self, *args: Any) -> None:
+        pass
+
+
+IDLE = _Idle()
+
+
+class _Frame:
+    """Stage running in a thread, with the time and memory of the stages
+    which ran inside it
+    """
+
+    def __init__(self, name: str, profile: Any) -> None:
+        self.name = name
+        self.profile = profile
+        self.children = 0.0
+        self.allocated = 0
+
+
+def _enable(profile: Any) -> bool:
+    """Enable a profile, tell if it could be while another one runs"""
+    try:
+        profile.enable()
+        return True
+    except ValueError:
+        return False
+
+
+def _sites(before: Any, top: int) -> List[Any]:
+    """Return the lines which allocated the most since a snapshot, those of
+    the profiling and of tracemalloc aside
+    """
+    import tracemalloc
+    ignored = (tracemalloc.__file__, __file__)
+    return [statistic for statistic in tracemalloc.take_snapshot().compare_to(
+        before, 'lineno') if statistic.traceback[0].filename not in ignored
+            ][:top]
+
+
+def _functions(stats: Optional[Any], top: int) -> List[str]:
+    """Return the functions of a profile taking the most own time"""
+    if stats is None:
+        return []
+    entries = sorted(stats.stats.items(), key=lambda item: -item[1][2])
+    return [f'  {own:>9.3f}s {cumulative:>9.3f}s {calls:>8} calls  '
+            f'{os.path.basename(filename)}:{line}({function})'
+            for (filename, line, function), (_, calls, own, cumulative, _)
+            in entries[:top]]
+
+
+def _kib(size: int) -> str:
+    """Format a size in bytes as KiB"""
+    return f'{size / 1024:.1f}'
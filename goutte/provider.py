@@ -0,0 +1,240 @@
+"""Backends goutte takes and deletes the snapshots with
+
+The engine only talks to its provider through the Provider interface:
+listing pages of droplets, volumes and snapshots, taking a snapshot,
+deleting a snapshot and polling the snapshot actions. A snapshot or a
+deletion returns its result, holding its error instead of raising it.
+"""
+from collections import Counter, namedtuple
+from typing import (Any, Callable, Dict, Iterable, Iterator, List, Optional,
+                    Set)
+import itertools
+import threading
+import time
+
+from goutte import retention
+
+# Resources are only kept with the attributes goutte uses
+Resource = namedtuple('Resource', ['id', 'name'])
+
+# Outcome of a snapshot or a deletion, value being the snapshot action id of
+# a droplet or whether a snapshot was deleted (False when already gone)
+Result = namedtuple('Result', ['value', 'error'])
+
+Call = Callable[..., Any]
+
+PER_PAGE = 200
+
+
+def direct(endpoint: str, func: Callable[..., Any], *args: Any,
+           **kwargs: Any) -> Any:
+    """Call func without pacing nor retrying it"""
+    return func(*args, **kwargs)
+
+
+class Provider:
+    """Interface of the snapshot backends
+
+    Every request goes through call(endpoint, func, *args), which the
+    engine uses to pace, retry and measure them.
+    """
+
+    def __init__(self, call: Call = direct) -> None:
+        self.call = call
+
+    def pages(self, kind: str, **params: Any
+              ) -> Iterator[List[Dict[str, Any]]]:
+        """Yield the attributes of the droplets, volumes or snapshots one
+        page at a time, filtered by tag_name or resource_type
+        """
+        raise NotImplementedError
+
+    def take_snapshot(self, kind: str, resource_id: Any, name: str
+                      ) -> Result:
+        """Snapshot a droplet or a volume"""
+        raise NotImplementedError
+
+    def delete_snapshot(self, snapshot_id: Any) -> Result:
+        """Delete a snapshot, one already gone is not an error"""
+        raise NotImplementedError
+
+    def poll_actions(self, ids: Set[int]) -> Dict[int, str]:
+        """Return the status of the given snapshot actions"""
+        raise NotImplementedError
+
+
+class DigitalOcean(Provider):
+    """DigitalOcean v2 API provider
+
+    The API has no bulk endpoint, the items of a batch are sent one request
+    each. The manager and its session are kept for the provider lifetime,
+    every request going through it.
+    """
+
+    def __init__(self, token: str, call: Call = direct) -> None:
+        import digitalocean
+        super().__init__(call)
+        self.token = token
+        self.manager = digitalocean.Manager(token=token)
+
+    def pages(self, kind: str, **params: Any
+              ) -> Iterator[List[Dict[str, Any]]]:
+        page = 1
+        while True:
+            data = self.call(f'list_{kind}', self.manager.get_data,
+                             f'{kind}/', params=dict(params, page=page,
+                                                     per_page=PER_PAGE))
+            yield data[kind]
+            if not data.get('links', {}).get('pages', {}).get('next'):
+                return
+            page += 1
+
+    def take_snapshot(self, kind: str, resource_id: Any, name: str
+                      ) -> Result:
+        import digitalocean
+        try:
+            if kind == 'droplet':
+                data = self.call(
+                    'snapshot_droplet', self.manager.get_data,
+                    f'droplets/{resource_id}/actions/',
+                    type=digitalocean.baseapi.POST,
+                    params={'type': 'snapshot', 'name': name})
+                return Result(data['action']['id'], None)
+            self.call('snapshot_volume', self.manager.get_data,
+                      f'volumes/{resource_id}/snapshots/',
+                      type=digitalocean.baseapi.POST, params={'name': name})
+            return Result(None, None)
+        except Exception as e:
+            return Result(None, e)
+
+    def delete_snapshot(self, snapshot_id: Any) -> Result:
+        import digitalocean
+        try:
+            self.call('destroy_snapshot', self.manager.get_data,
+                      f'snapshots/{snapshot_id}/',
+                      type=digitalocean.baseapi.DELETE)
+            return Result(True, None)
+        except digitalocean.baseapi.NotFoundError:
+            return Result(False, None)
+        except Exception as e:
+            return Result(None, e)
+
+    def poll_actions(self, ids: Set[int]) -> Dict[int, str]:
+        """Return the status of the given actions, mostly from the listing
+        of the most recent account actions
+        """
+        data = self.call('poll_actions', self.manager.get_data, 'actions/',
+                         params={'page': 1, 'per_page': PER_PAGE})
+        statuses = {action['id']: action['status']
+                    for action in data['actions'] if action['id'] in ids}
+        for action_id in ids.difference(statuses):
+            statuses[action_id] = self.call(
+                'get_action', self.manager.get_action, action_id).status
+        return statuses
+
+
+class Memory(Provider):
+    """In-memory provider, for the tests and offline load tests
+
+    Droplets, volumes and snapshots are kept as API attributes dicts, the
+    snapshots indexed by id. Snapshot actions complete once polled, and the
+    ids of errors fail with the given exception. The requests are counted
+    per endpoint in calls. It is safe to use from several threads.
+    """
+
+    def __init__(self, droplets: Iterable[Dict[str, Any]] = (),
+                 volumes: Iterable[Dict[str, Any]] = (),
+                 snapshots: Iterable[Dict[str, Any]] = (),
+                 call: Call = direct,
+                 errors: Optional[Dict[Any, Exception]] = None,
+                 clock: Callable[[], float] = time.time) -> None:
+        super().__init__(call)
+        self.droplets = list(droplets)
+        self.volumes = list(volumes)
+        self.snapshots = {snapshot['id']: snapshot
+                          for snapshot in snapshots}  # type: Dict[Any, Any]
+        self.resources = {(kind, str(resource['id']))
+                          for kind, resources in (('droplet', self.droplets),
+                                                  ('volume', self.volumes))
+                          for resource in resources}
+        self.actions = {}  # type: Dict[int, str]
+        self.errors = errors or {}
+        self.clock = clock
+        self.ids = itertools.count(1)
+        self.lock = threading.Lock()
+        self.calls = Counter()  # type: Counter
+
+    def pages(self, kind: str, **params: Any
+              ) -> Iterator[List[Dict[str, Any]]]:
+        tag, resource_type = params.get('tag_name'), params.get(
+            'resource_type')
+        with self.lock:
+            items = [item for item in (self.snapshots.values()
+                                       if kind == 'snapshots'
+                                       else getattr(self, kind))
+                     if (tag is None or tag in (item.get('tags') or [])) and
+                     resource_type in (None, item.get('resource_type'))]
+        for start in range(0, max(len(items), 1), PER_PAGE):
+            yield self.call(f'list_{kind}', self._request, f'list_{kind}',
+                            items[start:start + PER_PAGE])
+
+    def take_snapshot(self, kind: str, resource_id: Any, name: str
+                      ) -> Result:
+        try:
+            return self.call(f'snapshot_{kind}', self._snapshot, kind,
+                             resource_id, name)
+        except Exception as e:
+            return Result(None, e)
+
+    def delete_snapshot(self, snapshot_id: Any) -> Result:
+        try:
+            return self.call('destroy_snapshot', self._delete, snapshot_id)
+        except Exception as e:
+            return Result(None, e)
+
+    def poll_actions(self, ids: Set[int]) -> Dict[int, str]:
+        return self.call('poll_actions', self._poll, ids)
+
+    def _request(self, endpoint: str, answer: Any) -> Any:
+        """Count a request and return its answer"""
+        with self.lock:
+            self.calls[endpoint] += 1
+        return answer
+
+    def _poll(self, ids: Set[int]) -> Dict[int, str]:
+        """Return the status of actions, completing them"""
+        self._request('poll_actions', None)
+        with self.lock:
+            statuses = {action_id: self.actions.get(action_id, 'errored')
+                        for action_id in ids}
+            for action_id in ids.intersection(self.actions):
+                self.actions[action_id] = 'completed'
+        return statuses
+
+    def _snapshot(self, kind: str, resource_id: Any, name: str) -> Result:
+        """Add the snapshot of a resource"""
+        self._request(f'snapshot_{kind}', None)
+        if resource_id in self.errors:
+            raise self.errors[resource_id]
+        if (kind, str(resource_id)) not in self.resources:
+            raise LookupError(f'{kind} {resource_id} not found')
+        snapshot_id = f'snapshot-{next(self.ids)}'
+        with self.lock:
+            self.snapshots[snapshot_id] = {
+                'id': snapshot_id, 'name': name,
+                'created_at': retention.isoformat(int(self.clock())),
+                'resource_id': str(resource_id), 'resource_type': kind}
+            if kind != 'droplet':
+                return Result(None, None)
+            action_id = len(self.actions) + 1
+            self.actions[action_id] = 'in-progress'
+        return Result(action_id, None)
+
+    def _delete(self, snapshot_id: Any) -> Result:
+        """Remove a snapshot"""
+        self._request('destroy_snapshot', None)
+        if snapshot_id in self.errors:
+            raise self.errors[snapshot_id]
+        with self.lock:
+            deleted = self.snapshots.pop(snapshot_id, None) is not None
+        return Result(deleted, None)
@@ -0,0 +1,162 @@
+"""Json report of a run, one record per droplet and volume
+
+Each record holds the time spent pruning (deletions included) and
+snapshotting the resource, its API calls, the snapshot taken, its
+snapshots kept and deleted and the class of its last API error. The run
+totals and the percentiles of the records come along, so a pipeline can
+find the slow or failed resources without reading the logs.
+"""
+from contextlib import contextmanager
+from typing import (IO, Any, Callable, Dict, Iterator, List, Optional,
+                    Tuple)
+import json
+import math
+import threading
+import time
+
+PERCENTILES = (50, 90, 99)
+
+# Record fields summarised by percentiles
+MEASURES = ('prune_seconds', 'snapshot_seconds', 'api_calls')
+
+Record = Dict[str, Any]
+
+# Account, resource type and resource id of a record
+Key = Tuple[Optional[str], str, str]
+
+
+class Report:
+    """Thread safe collection of the resource records of a run
+
+    Stages bind their record to the running thread, so the API calls made
+    by the thread are counted on it without passing it around.
+    """
+
+    def __init__(self, clock: Callable[[], float] = time.perf_counter
+                 ) -> None:
+        self.clock = clock
+        self.lock = threading.Lock()
+        self.local = threading.local()
+        self.records = {}  # type: Dict[Key, Record]
+        self.requests = 0
+
+    def record(self, account: Optional[str], kind: str, resource_id: Any,
+               name: Optional[str] = None) -> Record:
+        """Return the record of a resource, created on first use"""
+        key = (account, kind, str(resource_id))
+        with self.lock:
+            if key not in self.records:
+                self.records[key] = {
+                    'account': account, 'kind': kind, 'id': resource_id,
+                    'name': name, 'prune_seconds': None,
+                    'snapshot_seconds': None, 'api_calls': 0,
+                    'snapshot': None, 'kept': None, 'deleted': 0,
+                    'error': None, 'failed': False, 'deferred': False}
+            elif name and not self.records[key]['name']:
+                self.records[key]['name'] = name
+            return self.records[key]
+
+    @contextmanager
+    def stage(self, record: Record, stage: str,
+              bind: bool = True) -> Iterator[None]:
+        """Time a stage of a resource, adding up when it runs several times,
+        and bind the record to the thread meanwhile unless told otherwise
+        (coroutines share their thread and pass their record instead)
+        """
+        previous = getattr(self.local, 'record', None)
+        if bind:
+            self.local.record = record
+        started = self.clock()
+        try:
+            yield
+        finally:
+            elapsed = self.clock() - started
+            if bind:
+                self.local.record = previous
+            field = f'{stage}_seconds'
+            with self.lock:
+                record[field] = (record[field] or 0) + elapsed
+
+    @contextmanager
+    def request(self, record: Optional[Record] = None) -> Iterator[None]:
+        """Count an API call on the given record or the one bound to the
+        thread, keeping the class of its error if it fails
+        """
+        record = record or getattr(self.local, 'record', None)
+        with self.lock:
+            self.requests += 1
+            if record is not None:
+                record['api_calls'] += 1
+        try:
+            yield
+        except Exception as e:
+            if record is not None:
+                with self.lock:
+                    record['error'] = type(e).__name__
+            raise
+
+    def update(self, record: Optional[Record] = None, **fields: Any) -> None:
+        """Set fields of the given record or the one bound to the thread"""
+        record = record or getattr(self.local, 'record', None)
+        if record is not None:
+            with self.lock:
+                record.update(fields)
+
+    def deleted(self, record: Record) -> None:
+        """Count a snapshot of a resource as deleted"""
+        with self.lock:
+            record['deleted'] += 1
+
+    def kept(self, account: Optional[str], kept: Dict[str, int]) -> None:
+        """Set the number of snapshots the retention kept per resource id on
+        the records of an account
+        """
+        with self.lock:
+            for (record_account, _, resource_id), record in (
+                    self.records.items()):
+                if record_account == account:
+                    record['kept'] = kept.get(resource_id, 0)
+
+    def render(self, **run: Any) -> Dict[str, Any]:
+        """Return the records, the totals and the percentiles with the given
+        run attributes
+        """
+        with self.lock:
+            records = sorted(
+                (dict(record) for record in self.records.values()),
+                key=lambda record: (record['account'] or '', record['kind'],
+                                    record['name'] or '', str(record['id'])))
+            requests = self.requests
+        for record in records:
+            for field in ('prune_seconds', 'snapshot_seconds'):
+                if record[field] is not None:
+                    record[field] = round(record[field], 6)
+        totals = {
+            'resources': len(records),
+            'failed': sum(record['failed'] for record in records),
+            'deferred': sum(record['deferred'] for record in records),
+            'api_calls': requests,
+            'snapshots': sum(record['snapshot'] is not None
+                             for record in records),
+            'kept': sum(record['kept'] or 0 for record in records),
+            'deleted': sum(record['deleted'] for record in records),
+        }
+        return dict(run, totals=totals, percentiles={
+            measure: percentiles([record[measure] for record in records
+                                  if record[measure] is not None])
+            for measure in MEASURES}, resources=records)
+
+    def write(self, output: IO[str], **run: Any) -> None:
+        """Write the report as json"""
+        json.dump(self.render(**run), output, indent=2, sort_keys=True)
+        output.write('\n')
+
+
+def percentiles(values: List[float]) -> Dict[str, Optional[float]]:
+    """Return the nearest-rank percentiles and the maximum of values"""
+    values = sorted(values)
+    summary = {f'p{rank}': values[max(math.ceil(rank / 100 * len(values)),
+                                      1) - 1] if values else None
+               for rank in PERCENTILES}
+    summary['max'] = values[-1] if values else None
+    return summary
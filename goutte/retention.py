@@ -0,0 +1,131 @@
+"""Grandfather-father-son retention of the goutte snapshots
+
+Snapshots are listed as compact records, their timestamp parsed once to
+epoch seconds and their ownership decided once from their name. Every
+goutte snapshot of the account is then planned in one pass: the snapshots
+are sorted newest first per resource, then each resource keeps its last
+snapshots and the newest one of its most recent days, weeks and months.
+"""
+from collections import namedtuple
+from operator import attrgetter
+from typing import Any, Dict, Iterable, List, Optional
+import calendar
+import time
+
+RULES = ('keep_last', 'keep_daily', 'keep_weekly', 'keep_monthly')
+
+Policy = namedtuple('Policy', RULES)
+
+# Snapshot fields used by the pruning, created_at in epoch seconds and
+# owned telling if goutte took it
+Snapshot = namedtuple('Snapshot', ['id', 'name', 'created_at', 'resource_id',
+                                   'resource_type', 'owned'])
+
+# Prefix of the names of the snapshots taken by goutte
+MARKER = 'goutte-'
+
+TIMESTAMP = '%Y-%m-%dT%H:%M:%SZ'
+
+DAY = 86400
+
+# Period a snapshot falls in for the daily, weekly and monthly rules, the
+# epoch being a Thursday weeks start 3 days later on Monday
+PERIODS = {
+    'keep_daily': lambda created_at: created_at // DAY,
+    'keep_weekly': lambda created_at: (created_at // DAY + 3) // 7,
+    'keep_monthly': lambda created_at: time.gmtime(created_at)[:2],
+}
+
+
+def policy(conf: Dict[str, Any], group: str) -> Policy:
+    """Return the retention policy of a resource group
+
+    The group rules override the top level ones and retention is kept as
+    an alias of keep_last. Raise ValueError when nothing would be kept.
+    """
+    rules = {}
+    for scope in (conf, conf.get(group, {})):
+        if 'retention' in scope:
+            rules['keep_last'] = scope['retention']
+        rules.update({rule: scope[rule] for rule in RULES if rule in scope})
+    for rule, value in rules.items():
+        if not isinstance(value, int) or isinstance(value, bool) or (
+                value < 0):
+            raise ValueError(
+                f'{rule} of {group} must be a non-negative integer')
+    if not any(rules.values()):
+        raise ValueError(f'No retention rule for {group}')
+    return Policy(*(rules.get(rule, 0) for rule in RULES))
+
+
+def record(attributes: Dict[str, Any]) -> Snapshot:
+    """Return the record of a snapshot listed by the API"""
+    return Snapshot(attributes['id'], attributes['name'],
+                    epoch(attributes['created_at']),
+                    str(attributes['resource_id']),
+                    attributes['resource_type'],
+                    attributes['name'].startswith(MARKER))
+
+
+def epoch(timestamp: str) -> int:
+    """Parse an API timestamp to epoch seconds"""
+    if len(timestamp) != 20:
+        return calendar.timegm(time.strptime(timestamp, TIMESTAMP))
+    return calendar.timegm((
+        int(timestamp[:4]), int(timestamp[5:7]), int(timestamp[8:10]),
+        int(timestamp[11:13]), int(timestamp[14:16]), int(timestamp[17:19])))
+
+
+def isoformat(created_at: int) -> str:
+    """Format epoch seconds as an API timestamp"""
+    return time.strftime(TIMESTAMP, time.gmtime(created_at))
+
+
+def plan(snapshots: Iterable[Snapshot], policies: Dict[str, Policy],
+         kept: Optional[Dict[str, int]] = None) -> Dict[str, List[Snapshot]]:
+    """Return the goutte snapshots to delete per resource id, oldest first
+
+    The policy of a snapshot is picked by its resource type, snapshots of
+    resources without policy are left alone. When given, kept is filled
+    with the number of snapshots kept per resource id.
+    """
+    owned = [snapshot for snapshot in snapshots
+             if snapshot.owned and snapshot.resource_type in policies]
+    owned.sort(key=attrgetter('resource_id', 'created_at'), reverse=True)
+    expired = {}  # type: Dict[str, List[Snapshot]]
+    resource_id = None
+    for snapshot in owned:
+        if snapshot.resource_id != resource_id:
+            resource_id, rules = snapshot.resource_id, _Kept(
+                policies[snapshot.resource_type])
+        if not rules.keep(snapshot.created_at):
+            expired.setdefault(resource_id, []).append(snapshot)
+        elif kept is not None:
+            kept[resource_id] = kept.get(resource_id, 0) + 1
+    for resource_snapshots in expired.values():
+        resource_snapshots.reverse()
+    return expired
+
+
+class _Kept:
+    """Snapshots kept so far for one resource, fed newest first"""
+
+    def __init__(self, policy: Policy) -> None:
+        self.policy = policy
+        self.counts = dict.fromkeys(RULES, 0)
+        self.periods = {}  # type: Dict[str, Any]
+
+    def keep(self, created_at: int) -> bool:
+        """Tell if a snapshot is kept by any of the rules"""
+        keep = False
+        if self.counts['keep_last'] < self.policy.keep_last:
+            self.counts['keep_last'] += 1
+            keep = True
+        for rule, period_of in PERIODS.items():
+            period = period_of(created_at)
+            if (self.counts[rule] < getattr(self.policy, rule) and
+                    self.periods.get(rule) != period):
+                self.counts[rule] += 1
+                self.periods[rule] = period
+                keep = True
+        return keep
@@ -0,0 +1,142 @@
+"""Pacing and retrying of the DigitalOcean API requests
+
+DigitalOcean allows 5000 requests per hour and 250 per minute. Requests
+take a token from a bucket refilled at the per minute rate, slowed down to
+spread what is left of the hourly budget until its reset once the ratelimit
+headers show it can no longer cover a minute at that rate.
+Throttled and server side failures are retried with jittered exponential
+backoff.
+"""
+from typing import Any, Callable, Optional, Union
+import logging
+import random
+import re
+import threading
+import time
+
+log = logging.getLogger(__name__)
+
+RETRY_STATUSES = {429, 500, 502, 503, 504}
+RETRY_MESSAGE = re.compile(
+    r'rate limit|too many requests|server|unavailable|try again', re.I)
+
+
+class RetryableError(Exception):
+    """A request was throttled or failed on the server side"""
+
+
+class Scheduler:
+    """Token bucket pacing API requests and retrying the throttled ones"""
+
+    def __init__(self, per_minute: int = 250, retries: int = 5,
+                 backoff: float = 1, max_backoff: float = 60,
+                 clock: Callable[[], float] = time.time,
+                 sleep: Callable[[float], None] = time.sleep) -> None:
+        self.rate = per_minute / 60
+        self.burst = per_minute
+        self.max_retries = retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.clock = clock
+        self.sleep = sleep
+        self.lock = threading.Lock()
+        self.tokens = float(per_minute)
+        self.updated = clock()
+        self.budget_rate = self.rate
+        self.reset_at = 0.0
+        self.requests = 0
+        self.retries = 0
+        self.waited = 0.0
+
+    def reserve(self) -> float:
+        """Take a token and return how long to wait before sending"""
+        with self.lock:
+            now = self.clock()
+            rate = self.rate if now >= self.reset_at else self.budget_rate
+            self.tokens = min(self.burst,
+                              self.tokens + (now - self.updated) * rate)
+            self.updated = now
+            self.tokens -= 1
+            if self.tokens >= 0:
+                delay = 0.0
+            elif rate > 0:
+                delay = -self.tokens / rate
+            else:
+                delay = self.reset_at - now
+            self.requests += 1
+            self.waited += delay
+            return delay
+
+    def observe(self, remaining: Optional[Union[str, int]],
+                reset: Optional[Union[str, float]]) -> None:
+        """Spread what is left of the hourly budget until its reset, once
+        it can no longer cover the per minute rate for the next minute
+        """
+        if remaining is None or reset is None:
+            return
+        with self.lock:
+            now = self.clock()
+            self.reset_at = float(reset)
+            left = max(self.reset_at - now, 1)
+            if int(remaining) >= self.rate * min(left, 60):
+                self.budget_rate = self.rate
+            else:
+                self.budget_rate = int(remaining) / left
+            if int(remaining) <= 0 and self.reset_at > now:
+                self.tokens = min(self.tokens, 0)
+
+    def delay(self, attempt: int) -> float:
+        """Return the jittered backoff delay of a retry attempt"""
+        delay = random.uniform(
+            0, min(self.max_backoff, self.backoff * 2 ** attempt))
+        with self.lock:
+            self.retries += 1
+            self.waited += delay
+        return delay
+
+    def call(self, func: Callable[..., Any], *args: Any,
+             **kwargs: Any) -> Any:
+        """Call an API function, pacing and retrying it as needed"""
+        attempt = 0
+        while True:
+            self.sleep(self.reserve())
+            try:
+                result = func(*args, **kwargs)
+            except Exception as e:
+                if attempt >= self.max_retries or not retryable(e):
+                    raise
+                delay = self.delay(attempt)
+                log.debug(f'Retrying in {delay:.1f}s: {e}')
+                self.sleep(delay)
+                attempt += 1
+                continue
+            source = getattr(func, '__self__', None)
+            self.observe(getattr(source, 'ratelimit_remaining', None),
+                         getattr(source, 'ratelimit_reset', None))
+            return result
+
+    def estimate(self, requests: int) -> float:
+        """Return the pacing time of a number of requests from a full bucket
+        at the last known rate
+        """
+        with self.lock:
+            rate = min(self.rate, self.budget_rate)
+        return max(requests - self.burst, 0) / rate if rate > 0 else 0.0
+
+    def summary(self) -> str:
+        """Return the requests, retries and wait time of the run"""
+        return (f'{self.requests} API requests, {self.retries} retries, '
+                f'waited {self.waited:.1f}s')
+
+
+def retryable(e: Exception) -> bool:
+    """Tell if a failed request is worth retrying"""
+    import digitalocean
+    import requests
+    if isinstance(e, (RetryableError, digitalocean.baseapi.JSONReadError,
+                      requests.exceptions.ConnectionError,
+                      requests.exceptions.Timeout)):
+        return True
+    if isinstance(e, digitalocean.baseapi.DataReadError):
+        return bool(RETRY_MESSAGE.search(str(e)))
+    return False
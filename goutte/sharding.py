@@ -0,0 +1,47 @@
+"""Split of the selected resources between the shards of a run
+
+A run given --shard i/N only handles the droplets and volumes of shard i
+among N, so one configuration can be run by N jobs without coordinating.
+A resource belongs to the shard scoring the highest hash with it
+(rendezvous hashing): every job computes the same split from the resource
+alone, and going from N to N + 1 shards only moves the resources won by
+the new shard, about one in N + 1.
+"""
+from collections import namedtuple
+from typing import Any
+import hashlib
+
+# Shard index, from 1 to count
+Shard = namedtuple('Shard', ['index', 'count'])
+
+
+def parse(spec: str) -> Shard:
+    """Return the shard of an i/N specification, raise ValueError when it
+    is not valid
+    """
+    index, _, count = spec.partition('/')
+    try:
+        shard = Shard(int(index), int(count))
+    except ValueError:
+        raise ValueError(f'Invalid shard {spec}, expected i/N') from None
+    if not 1 <= shard.index <= shard.count:
+        raise ValueError(f'Invalid shard {spec}, i must be between 1 and N')
+    return shard
+
+
+def owner(kind: str, resource_id: Any, count: int) -> int:
+    """Return the shard of a resource among count shards"""
+    key = f'{kind}:{resource_id}'
+    return max(range(1, count + 1), key=lambda index: _score(key, index))
+
+
+def owns(shard: Shard, kind: str, resource_id: Any) -> bool:
+    """Tell if a resource belongs to a shard"""
+    return shard.count == 1 or owner(kind, resource_id,
+                                     shard.count) == shard.index
+
+
+def _score(key: str, index: int) -> int:
+    """Return the hash of a resource key with a shard"""
+    digest = hashlib.sha256(f'{index}:{key}'.encode()).digest()
+    return int.from_bytes(digest[:8], 'big')
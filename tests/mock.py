@@ -1,63 +1,259 @@
+import asyncio
+import urllib.parse
+
+from goutte import retention
+from goutte.provider import Memory
+
+
 def nothing(*args, **kwargs):
     pass
 
 
+def success(*args, **kwargs):
+    return 0
+
+
+def failure(*args, **kwargs):
+    return 1
+
+
+def empty(*args, **kwargs):
+    return iter(())
+
+
+class Clock:
+    """Fake time, moving by tick at each reading and when slept"""
+
+    def __init__(self, now=1000.0, tick=0):
+        self.now = now
+        self.tick = tick
+
+    def __call__(self):
+        if self.tick:
+            self.now += self.tick
+        return self.now
+
+    def sleep(self, seconds):
+        self.now += seconds
+
+
 class Snapshot:
-    def __init__(self, created_at=None, name=None, id=None):
+    def __init__(self, created_at=None, name=None, id=None, resource_id=None,
+                 resource_type='droplet'):
         self.created_at = created_at
         self.name = name
         self.id = id
+        self.resource_id = resource_id
+        self.resource_type = resource_type
 
-    def destroy(self):
-        pass
 
-    @staticmethod
-    def get_object(api_token=None, snapshot_id=None):
-        if snapshot_id == '1337':
-            return Snapshot(name=f'snapshot{snapshot_id}', id=snapshot_id,
-                            created_at=f'{snapshot_id}')
-        else:
-            return Snapshot(name=f'goutte-snapshot{snapshot_id}',
-                            id=snapshot_id, created_at=f'{snapshot_id}')
+def record(name=None, id=None, resource_id=1,
+           created_at='2019-01-01T00:00:00Z', resource_type='droplet'):
+    return retention.record({'name': name, 'id': id,
+                             'resource_id': resource_id,
+                             'created_at': created_at,
+                             'resource_type': resource_type})
 
 
 class Volume:
-    def __init__(self, name=None, snapshots=None, throw=None):
+    def __init__(self, name=None, id=None):
         self.name = name
-        self.snapshots = snapshots
-        self.throw = throw
-
-    def get_snapshots(self):
-        return self.snapshots
-
-    def snapshot(self, name):
-        pass
+        self.id = id
 
 
 class Droplet:
-    def __init__(self, name=None, snapshot_ids=None):
+    def __init__(self, name=None, id=None):
         self.name = name
-        self.snapshot_ids = snapshot_ids
+        self.id = id
 
-    def take_snapshot(self, name):
-        pass
+
+class Action:
+    def __init__(self, id=None, status=None):
+        self.id = id
+        self.status = status
 
 
 class Manager:
+    actions = []
+    droplets = [
+        {'name': 'testdroplet', 'id': 1},
+        {'name': 'taggeddroplet', 'id': 2, 'tags': ['backup']},
+    ]
+    volumes = [
+        {'name': 'testvol', 'id': 'vol-1'},
+        {'name': 'taggedvol', 'id': 'vol-2', 'tags': ['backup']},
+    ]
+    snapshots = [
+        {'name': 'goutte-snapshot1', 'id': '1', 'resource_id': 1,
+         'resource_type': 'droplet', 'created_at': '2019-01-01T00:00:00Z'},
+        {'name': 'goutte-snapshot2', 'id': '2', 'resource_id': 1,
+         'resource_type': 'droplet', 'created_at': '2019-01-02T00:00:00Z'},
+        {'name': 'goutte-snapshot3', 'id': '3', 'resource_id': 'vol-1',
+         'resource_type': 'volume', 'created_at': '2019-01-01T00:00:00Z'},
+    ]
+
     def __init__(self, token=None):
         self.token = token
 
-    def get_all_volumes(self):
-        return [
-            Volume(name='testvol')
-        ]
+    def get_data(self, url, type='GET', params=None):
+        if type == 'POST':
+            return self.post(url, params)
+        if type == 'DELETE':
+            return self.delete(url)
+        kind, params = url.strip('/'), params or {}
+        if kind == 'actions':
+            return {'actions': [dict(action) for action in self.actions]}
+        items = [dict(item) for item in getattr(self, kind)
+                 if params.get('tag_name', 'all') in
+                 item.get('tags', []) + ['all'] and
+                 params.get('resource_type', 'all') in
+                 (item.get('resource_type'), 'all')]
+        page, per_page = params.get('page', 1), params.get('per_page', 200)
+        data = {kind: items[(page - 1) * per_page:page * per_page],
+                'links': {}}
+        if page * per_page < len(items):
+            data['links']['pages'] = {
+                'next': f'https://api.digitalocean.com/v2/{kind}/'
+                        f'?page={page + 1}&per_page={per_page}'}
+        return data
+
+    def post(self, url, params):
+        kind, resource_id = url.strip('/').split('/')[:2]
+        if kind == 'droplets':
+            return {'action': {'id': int(resource_id),
+                               'status': 'in-progress'}}
+        return {'snapshot': {'name': params['name'], 'id': resource_id}}
+
+    def delete(self, url):
+        return True
 
-    def get_all_droplets(self):
-        return [
-            Droplet(name='testdroplet')
-        ]
+    def get_action(self, action_id):
+        return Action(id=action_id, status='completed')
+
+
+def memory(**kwargs):
+    """Return an in-memory provider holding the Manager account"""
+    return Memory([dict(droplet) for droplet in Manager.droplets],
+                  [dict(volume) for volume in Manager.volumes],
+                  [dict(snapshot) for snapshot in Manager.snapshots],
+                  **kwargs)
 
 
 class File:
     def __init__(self, name=None):
         self.name = name
+
+
+class AsyncResponse:
+    def __init__(self, server, status, data, headers=None):
+        self.server = server
+        self.status = status
+        self.data = data
+        self.headers = headers or {}
+
+    async def __aenter__(self):
+        self.server.in_flight += 1
+        self.server.max_in_flight = max(self.server.max_in_flight,
+                                        self.server.in_flight)
+        await asyncio.sleep(self.server.latency)
+        self.server.in_flight -= 1
+        return self
+
+    async def __aexit__(self, *args):
+        pass
+
+    async def json(self):
+        return self.data
+
+
+class AsyncSession:
+    def __init__(self, server):
+        self.server = server
+        self.closed = False
+
+    def request(self, method, url, headers=None, params=None, json=None):
+        return self.server.handle(method, url, params or {}, json or {})
+
+    async def close(self):
+        self.closed = True
+
+
+class AsyncServer:
+    """In-process fake of the DigitalOcean v2 API for the async engine"""
+
+    def __init__(self, droplets=None, volumes=None, snapshots=None,
+                 latency=0, per_page=2):
+        self.droplets = droplets or []
+        self.volumes = volumes or []
+        self.snapshots = snapshots or []
+        self.actions = {}
+        self.created = 0
+        self.latency = latency
+        self.per_page = per_page
+        self.calls = []
+        self.in_flight = 0
+        self.max_in_flight = 0
+        self.sessions = []
+
+    def session(self, limit):
+        session = AsyncSession(self)
+        self.sessions.append(session)
+        return session
+
+    def handle(self, method, url, params, body):
+        url = urllib.parse.urlsplit(url)
+        path = url.path.split('/v2/', 1)[1].strip('/').split('/')
+        params = dict(params, **dict(urllib.parse.parse_qsl(url.query)))
+        self.calls.append((method, '/'.join(path)))
+        if method == 'GET' and path == ['actions']:
+            listed = [dict(action) for action in self.actions.values()]
+            for action in self.actions.values():
+                action['status'] = 'completed'
+            return AsyncResponse(self, 200, {'actions': listed[::-1]})
+        if method == 'GET' and len(path) == 1:
+            return self.page(path[0], int(params.get('page', 1)),
+                             params.get('tag_name'))
+        if method == 'GET' and path[0] == 'actions':
+            action = self.actions[int(path[1])]
+            action['status'] = 'completed'
+            return AsyncResponse(self, 200, {'action': dict(action)})
+        if method == 'POST' and path[0] == 'droplets':
+            action = {'id': len(self.actions) + 1, 'status': 'in-progress'}
+            self.actions[action['id']] = action
+            self.snapshots.append(self.snapshot(body['name'], path[1]))
+            return AsyncResponse(self, 201, {'action': dict(action)})
+        if method == 'POST' and path[0] == 'volumes':
+            snapshot = self.snapshot(body['name'], path[1])
+            self.snapshots.append(snapshot)
+            return AsyncResponse(self, 201, {'snapshot': snapshot})
+        if method == 'DELETE' and path[0] == 'snapshots':
+            for snapshot in self.snapshots:
+                if str(snapshot['id']) == path[1]:
+                    self.snapshots.remove(snapshot)
+                    return AsyncResponse(self, 204, None)
+        return AsyncResponse(self, 404, {'id': 'not_found',
+                                         'message': 'Not found'})
+
+    def page(self, key, page, tag_name=None):
+        items = getattr(self, key)
+        if tag_name:
+            items = [item for item in items
+                     if tag_name in item.get('tags', [])]
+        start = (page - 1) * self.per_page
+        data = {key: items[start:start + self.per_page], 'links': {}}
+        if start + self.per_page < len(items):
+            query = {'page': page + 1, 'per_page': self.per_page}
+            if tag_name:
+                query['tag_name'] = tag_name
+            data['links']['pages'] = {
+                'next': f'https://api.digitalocean.com/v2/{key}'
+                        f'?{urllib.parse.urlencode(query)}'}
+        return AsyncResponse(self, 200, data)
+
+    def snapshot(self, name, resource_id):
+        self.created += 1
+        return {'id': f'new-{self.created}', 'name': name,
+                'created_at': '9999-01-01T00:00:00Z',
+                'resource_id': resource_id,
+                'resource_type': 'volume' if resource_id.startswith('v')
+                                 else 'droplet'}
@@ -0,0 +1,270 @@
+from goutte import aio
+from goutte import main
+from goutte import sharding
+from goutte.journal import Journal
+from goutte.metrics import Metrics
+from goutte.profiling import Profiler
+from goutte.report import Report
+from goutte.scheduler import Scheduler
+from tests import mock
+
+
+def server():
+    return mock.AsyncServer(
+        droplets=[{'id': 1, 'name': 'd1'}, {'id': 2, 'name': 'd2'},
+                  {'id': 3, 'name': 'other'},
+                  {'id': 4, 'name': 'tagged', 'tags': ['backup']}],
+        volumes=[{'id': 'v1', 'name': 'vol1'},
+                 {'id': 'v2', 'name': 'vol2', 'tags': ['backup']}],
+        snapshots=[
+            {'id': 's1', 'name': 'goutte-d1-1',
+             'created_at': '2018-01-01T00:00:00Z', 'resource_id': '1',
+             'resource_type': 'droplet'},
+            {'id': 's2', 'name': 'goutte-d1-2',
+             'created_at': '2017-01-01T00:00:00Z', 'resource_id': '1',
+             'resource_type': 'droplet'},
+            {'id': 's3', 'name': 'manual-d1',
+             'created_at': '2016-01-01T00:00:00Z', 'resource_id': '1',
+             'resource_type': 'droplet'},
+            {'id': 's4', 'name': 'goutte-vol1-1',
+             'created_at': '2016-01-01T00:00:00Z', 'resource_id': 'v1',
+             'resource_type': 'volume'},
+        ])
+
+
+def conf(**kwargs):
+    return dict({'retention': 1, 'concurrency': 2, 'poll_interval': 0,
+                 'droplets': {'names': ['d1', 'd2']},
+                 'volumes': {'names': ['vol1']}}, **kwargs)
+
+
+def run(conf, only, session_factory, scheduler=None):
+    return aio.run(conf, only, 'token', scheduler=scheduler,
+                   session_factory=session_factory)
+
+
+def test_run(caplog):
+    fake = server()
+    with caplog.at_level('INFO'):
+        assert run(conf(), None, fake.session) == 0
+    ids = [snapshot['id'] for snapshot in fake.snapshots]
+    assert 's1' in ids and 's3' in ids and 's4' in ids
+    assert 's2' not in ids
+    assert len(fake.snapshots) == 6
+    assert not [call for call in fake.calls if call[1].startswith('actions')]
+    assert fake.sessions[0].closed
+    assert len([r for r in caplog.records if 'Prune' in r.message]) == 1
+
+
+def test_run_wait(caplog):
+    fake = server()
+    with caplog.at_level('INFO'):
+        assert run(conf(wait=True), 'snapshot', fake.session) == 0
+    assert fake.calls.count(('GET', 'actions')) == 2
+    assert [r.message for r in caplog.records[-2:]] == [
+        'd1 - Snapshot completed',
+        'd2 - Snapshot completed',
+    ]
+
+
+def test_run_wait_timeout(caplog):
+    fake = server()
+    with caplog.at_level('INFO'):
+        assert run(conf(wait=True, wait_timeout=0), 'snapshot',
+                   fake.session) == 1
+    assert fake.calls.count(('GET', 'actions')) == 1
+    assert caplog.records[-1].message == 'd2 - Snapshot timed-out'
+
+
+def test_run_paginates():
+    fake = server()
+    run(conf(), 'prune', fake.session)
+    assert fake.calls.count(('GET', 'droplets')) == 2
+    assert fake.calls.count(('GET', 'snapshots')) == 2
+
+
+def test_run_tags(caplog):
+    fake = server()
+    config = conf(droplets={'names': ['d1', 'missing'], 'tags': ['backup']},
+                  volumes={'tags': ['backup']})
+    with caplog.at_level('INFO'):
+        assert run(config, 'snapshot', fake.session) == 0
+    created = sorted(snapshot['resource_id'] for snapshot in fake.snapshots
+                     if snapshot['id'].startswith('new'))
+    assert created == ['1', '4', 'v2']
+    assert fake.calls.count(('GET', 'droplets')) == 2
+    assert caplog.records[0].levelname == 'WARNING'
+    assert caplog.records[0].message.endswith(': missing')
+
+
+def test_run_caps_in_flight_requests():
+    fake = server()
+    fake.latency = 0.01
+    run(conf(concurrency=2), None, fake.session)
+    assert fake.max_in_flight == 2
+
+
+def test_run_snapshot_only_skips_snapshot_listing():
+    fake = server()
+    assert run(conf(), 'snapshot', fake.session) == 0
+    assert ('GET', 'snapshots') not in fake.calls
+    assert not [call for call in fake.calls if call[0] == 'DELETE']
+
+
+def test_run_delete_errors(caplog, monkeypatch):
+    fake = server()
+    fake.snapshots.append({'id': 's5', 'name': 'goutte-d1-0',
+                           'created_at': '2015-01-01T00:00:00Z',
+                           'resource_id': '1', 'resource_type': 'droplet'})
+    handle = fake.handle
+
+    def delete(method, url, params, body):
+        if url.endswith('/s5'):
+            return mock.AsyncResponse(fake, 403, {'message': 'Forbidden'})
+        if url.endswith('/s2'):
+            return mock.AsyncResponse(fake, 404, {'message': 'Not found'})
+        return handle(method, url, params, body)
+    monkeypatch.setattr(fake, 'handle', delete)
+    with caplog.at_level('INFO'):
+        assert run(conf(), 'prune', fake.session) == 1
+    assert 'goutte-d1-0' in caplog.records[-2].message
+    assert caplog.records[-1].message.startswith('Deleted 1/2 snapshots in ')
+
+
+def test_run_no_aiohttp(caplog):
+    def session(limit):
+        raise ImportError('No module named aiohttp')
+    with caplog.at_level('INFO'):
+        assert run(conf(), None, session) == 1
+    assert caplog.records[0].levelname == 'CRITICAL'
+
+
+def test_run_retries_throttled_requests():
+    fake = server()
+    handle = fake.handle
+    throttled = []
+
+    def rate_limit(method, url, params, body):
+        if not throttled:
+            throttled.append(url)
+            return mock.AsyncResponse(fake, 429, {'message': 'Slow down'},
+                                      {'ratelimit-remaining': '0',
+                                       'ratelimit-reset': '0'})
+        return handle(method, url, params, body)
+    fake.handle = rate_limit
+    scheduler = Scheduler(backoff=0)
+    assert run(conf(), None, fake.session, scheduler) == 0
+    assert scheduler.retries == 1
+    assert len(fake.snapshots) == 6
+
+
+def test_run_records_metrics(monkeypatch):
+    monkeypatch.setattr(aio, 'metrics', Metrics())
+    fake = server()
+    assert run(conf(), None, fake.session) == 0
+    text = aio.metrics.render()
+    assert 'goutte_api_requests_total{endpoint="list_snapshots"} 2' in text
+    assert 'goutte_api_requests_total{endpoint="snapshot_droplet"} 2' in text
+    assert 'goutte_api_requests_total{endpoint="destroy_snapshot"} 1' in text
+    assert ('goutte_stage_duration_seconds_count{kind="volume",'
+            'stage="prune"} 1') in text
+
+
+def test_run_reports_resources(monkeypatch):
+    report = Report()
+    monkeypatch.setattr(main, 'report', report)
+    monkeypatch.setattr(aio, 'report', report)
+    fake = server()
+    assert run(conf(), None, fake.session) == 0
+    records = {record['name']: record
+               for record in report.render()['resources']}
+    assert sorted(records) == ['d1', 'd2', 'vol1']
+    assert (records['d1']['api_calls'], records['d1']['kept'],
+            records['d1']['deleted']) == (2, 1, 1)
+    assert records['vol1']['snapshot'].startswith('goutte-vol1-')
+    assert report.requests == len(fake.calls)
+
+
+def test_run_deadline():
+    fake = server()
+    config = conf(deadline=3600, volumes={'names': ['vol1'], 'priority': 1},
+                  concurrency=1)
+    assert run(config, 'snapshot', fake.session) == 0
+    assert [call for call in fake.calls if call[0] == 'POST'] == [
+        ('POST', 'volumes/v1/snapshots'), ('POST', 'droplets/2/actions'),
+        ('POST', 'droplets/1/actions')]
+
+
+def test_run_deadline_reached(caplog):
+    fake = server()
+    fake.latency = 0.05
+    with caplog.at_level('INFO'):
+        assert run(conf(deadline=0.05), 'snapshot', fake.session) == 0
+    assert not [call for call in fake.calls if call[0] == 'POST']
+    assert [record.message for record in caplog.records] == [
+        'Deadline reached, deferred 2 droplets to the next run: d2, d1',
+        'Deadline reached, deferred 1 volumes to the next run: vol1']
+
+
+def test_run_shard(monkeypatch):
+    calls = []
+    for index in (1, 2):
+        monkeypatch.setattr(main, 'shard', sharding.Shard(index, 2))
+        fake = server()
+        assert run(conf(), None, fake.session) == 0
+        calls.append(sorted(call for call in fake.calls
+                            if call[0] != 'GET'))
+    assert calls == [
+        [('POST', 'droplets/2/actions'), ('POST', 'volumes/v1/snapshots')],
+        [('DELETE', 'snapshots/s2'), ('POST', 'droplets/1/actions')]]
+
+
+def test_run_profile(monkeypatch):
+    profiler = Profiler()
+    monkeypatch.setattr(main, 'profiler', profiler)
+    profiler.start()
+    try:
+        with main._profiled('async'):
+            assert run(conf(), None, server().session) == 0
+    finally:
+        profiler.stop()
+    assert dict(profiler.runs) == {'async': 1, 'resolve': 4, 'order': 1}
+
+
+def test_run_resumed(tmpdir, monkeypatch):
+    monkeypatch.setattr(main, 'journal',
+                        Journal(str(tmpdir.join('journal.jsonl'))))
+    monkeypatch.setattr(main, 'resuming', True)
+    fake = server()
+    assert run(conf(wait=True), 'snapshot', fake.session) == 0
+    calls = len(fake.calls)
+    assert run(conf(wait=True), 'snapshot', fake.session) == 0
+    assert len(fake.snapshots) == 7
+    assert not [call for call in fake.calls[calls:] if call[0] != 'GET']
+    assert fake.calls[calls:].count(('GET', 'actions')) == 1
+
+
+def test_run_resumed_hourly(tmpdir, monkeypatch):
+    monkeypatch.setattr(main, 'journal',
+                        Journal(str(tmpdir.join('journal.jsonl'))))
+    monkeypatch.setattr(main, 'resuming', True)
+    fake = server()
+    posts = []
+    for hour in ('01', '02', '02'):
+        monkeypatch.setitem(main.FREQUENCIES, 'hourly', f'%Y%m%d{hour}')
+        assert run(conf(frequency='hourly'), 'snapshot', fake.session) == 0
+        posts.append(len([call for call in fake.calls if call[0] == 'POST']))
+    assert posts == [3, 6, 6]
+
+
+def test_run_once_per_period():
+    fake = server()
+    fake.snapshots.append({
+        'id': 's5', 'name': main._snapshot_name('d1', 'daily'),
+        'created_at': '2019-01-01T00:00:00Z', 'resource_id': '1',
+        'resource_type': 'droplet'})
+    assert run(conf(frequency='daily'), 'snapshot', fake.session) == 0
+    created = sorted(snapshot['name'] for snapshot in fake.snapshots
+                     if snapshot['id'].startswith('new'))
+    assert created == [main._snapshot_name('d2', 'daily'),
+                       main._snapshot_name('vol1', 'daily')]
@@ -0,0 +1,39 @@
+from benchmarks import harness
+
+
+def test_run():
+    result = harness.run(droplets=3, volumes=2, snapshots=3, retention=2,
+                         concurrency=2, wait=True)
+    assert result['exit_code'] == 0
+    assert result['endpoints']['DELETE snapshots/:id'] == 5
+    assert result['endpoints']['POST droplets/:id'] == 3
+    assert result['endpoints']['POST volumes/:id'] == 2
+    assert result['api_calls'] == sum(result['endpoints'].values())
+    assert result['calls_per_resource'] == result['api_calls'] / 5
+    assert result['peak_rss_kb'] > 0
+
+
+def test_run_async():
+    result = harness.run(droplets=3, snapshots=3, retention=2,
+                         engine='async')
+    assert result['exit_code'] == 0
+    assert result['endpoints']['DELETE snapshots/:id'] == 3
+
+
+def test_compare():
+    baseline = {'api_calls': 100, 'calls_per_resource': 2, 'wall_time': 1}
+    result = {'api_calls': 101, 'calls_per_resource': 2, 'wall_time': 1.4}
+    assert harness.compare(result, baseline, {'api_calls': 0.05,
+                                              'wall_time': 0.5}) == []
+    assert harness.compare(result, baseline, dict(harness.METRICS)) == [
+        'api_calls: 101 > 100 (baseline 100)']
+
+
+def test_run_memory():
+    result = harness.run(droplets=3, volumes=2, snapshots=3, retention=2,
+                         concurrency=2, wait=True, provider='memory')
+    assert result['exit_code'] == 0
+    assert result['endpoints']['destroy_snapshot'] == 5
+    assert result['endpoints']['snapshot_droplet'] == 3
+    assert result['endpoints']['snapshot_volume'] == 2
+    assert result['api_calls'] == sum(result['endpoints'].values())
@@ -0,0 +1,41 @@
+from goutte.cache import Cache
+from tests.mock import Clock
+
+
+def test_get_set(tmpdir):
+    cache = Cache(str(tmpdir.join('sub', 'goutte.sqlite')), 60)
+    assert cache.get('a:droplets') is None
+    cache.set('a:droplets', [{'id': 1, 'name': 'd1'}])
+    assert cache.get('a:droplets') == [{'id': 1, 'name': 'd1'}]
+    cache.close()
+
+
+def test_persistent(tmpdir):
+    path = str(tmpdir.join('goutte.sqlite'))
+    cache = Cache(path, 60)
+    cache.set('a:volumes', [])
+    cache.close()
+    assert Cache(path, 60).get('a:volumes') == []
+
+
+def test_ttl(tmpdir):
+    clock = Clock()
+    cache = Cache(str(tmpdir.join('goutte.sqlite')), 60, clock)
+    cache.set('a:snapshots', [1])
+    clock.now += 59
+    assert cache.get('a:snapshots') == [1]
+    clock.now += 1
+    assert cache.get('a:snapshots') is None
+
+
+def test_invalidate(tmpdir):
+    cache = Cache(str(tmpdir.join('goutte.sqlite')), 60)
+    cache.set('a:droplets', [1])
+    cache.set('a:droplets:backup', [2])
+    cache.set('a:snapshots', [3])
+    cache.set('b:droplets', [4])
+    cache.invalidate('a:droplets')
+    assert cache.get('a:droplets') is None
+    assert cache.get('a:droplets:backup') is None
+    assert cache.get('a:snapshots') == [3]
+    assert cache.get('b:droplets') == [4]
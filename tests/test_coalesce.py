@@ -0,0 +1,83 @@
+import threading
+
+import pytest
+
+from goutte.coalesce import Coalescer
+
+
+def pages(listed, count=3):
+    def listing():
+        listed.append(None)
+        for number in range(count):
+            yield [{'id': number}]
+    return listing
+
+
+def test_listing_shared():
+    coalescer, listed = Coalescer(), []
+    leader = coalescer.listing('droplets', 'a', pages(listed))
+    assert next(leader) == [{'id': 0}]
+    follower = coalescer.listing('droplets', 'b', pages(listed))
+    assert next(follower) == [{'id': 0}]
+    replayed = []
+    thread = threading.Thread(target=lambda: replayed.extend(follower))
+    thread.start()
+    assert list(leader) == [[{'id': 1}], [{'id': 2}]]
+    thread.join(1)
+    assert replayed == [[{'id': 1}], [{'id': 2}]]
+    assert list(coalescer.listing('droplets', 'c', pages(listed))) == [
+        [{'id': 0}], [{'id': 1}], [{'id': 2}]]
+    assert len(listed) == 1
+    assert coalescer.shared == 2
+
+
+def test_listing_same_owner_lists_again():
+    coalescer, listed = Coalescer(), []
+    for _ in range(2):
+        assert len(list(coalescer.listing('droplets', 'a',
+                                          pages(listed)))) == 3
+    assert len(listed) == 2
+
+
+def test_listing_abandoned():
+    coalescer, listed = Coalescer(), []
+    leader = coalescer.listing('droplets', 'a', pages(listed))
+    next(leader)
+    follower = coalescer.listing('droplets', 'b', pages(listed))
+    assert next(follower) == [{'id': 0}]
+    leader.close()
+    assert list(follower) == [[{'id': 1}], [{'id': 2}]]
+    assert len(listed) == 2
+    assert list(coalescer.listing('droplets', 'c', pages(listed)))
+    assert len(listed) == 3
+
+
+def test_listing_error():
+    def failing():
+        yield [{'id': 0}]
+        raise KeyError('gone')
+    coalescer = Coalescer()
+    leader = coalescer.listing('droplets', 'a', failing)
+    next(leader)
+    follower = coalescer.listing('droplets', 'b', failing)
+    with pytest.raises(KeyError):
+        next(leader)
+    assert next(follower) == [{'id': 0}]
+    with pytest.raises(KeyError):
+        next(follower)
+    assert 'droplets' not in coalescer.flights
+
+
+def test_invalidate():
+    coalescer, listed = Coalescer(), []
+    list(coalescer.listing('t:snapshots:droplet', 'a', pages(listed)))
+    list(coalescer.listing('t:droplets', 'a', pages(listed)))
+    coalescer.invalidate('t:snapshots')
+    assert list(coalescer.flights) == ['t:droplets']
+
+
+def test_claim():
+    coalescer = Coalescer()
+    assert coalescer.claim('t:droplet:1', 'a') == 'a'
+    assert coalescer.claim('t:droplet:1', 'b') == 'a'
+    assert coalescer.claim('t:droplet:2', 'b') == 'b'
@@ -0,0 +1,35 @@
+from datetime import datetime
+
+import pytest
+
+from goutte.cron import Cron
+
+
+def test_next_daily():
+    cron = Cron('30 3 * * *')
+    assert cron.next(datetime(2019, 1, 1, 3, 29)) == \
+        datetime(2019, 1, 1, 3, 30)
+    assert cron.next(datetime(2019, 1, 1, 3, 30)) == \
+        datetime(2019, 1, 2, 3, 30)
+
+
+def test_next_steps_and_ranges():
+    cron = Cron('*/15 8-10 * * *')
+    assert cron.next(datetime(2019, 1, 1, 10, 50)) == datetime(2019, 1, 2, 8)
+    assert cron.next(datetime(2019, 1, 1, 9, 1)) == datetime(2019, 1, 1, 9, 15)
+
+
+def test_next_weekday_and_month():
+    assert Cron('0 0 * * 0').next(datetime(2019, 1, 1)) == \
+        datetime(2019, 1, 6)
+    assert Cron('0 0 1 3 *').next(datetime(2019, 3, 2)) == \
+        datetime(2020, 3, 1)
+    assert Cron('0 0 13 * 5').next(datetime(2019, 1, 1)) == \
+        datetime(2019, 1, 4)
+
+
+@pytest.mark.parametrize('expression', [
+    '* * * *', '60 * * * *', '* * 0 * *', 'a * * * *', '0 0 31 2 *'])
+def test_invalid(expression):
+    with pytest.raises(ValueError):
+        Cron(expression).next(datetime(2019, 1, 1))
@@ -0,0 +1,125 @@
+from datetime import datetime, timedelta
+
+from click.testing import CliRunner
+import digitalocean
+import pytest
+
+from goutte import daemon
+from goutte import main
+from tests import mock
+
+CONFIG = '''
+retention = 2
+schedule = "0 3 * * *"
+inventory_ttl = 60
+
+[droplets]
+names = ["testdroplet"]
+schedule = "*/10 * * * *"
+
+[volumes]
+names = ["testvol"]
+'''
+START = datetime(2019, 1, 1, 2, 55)
+
+
+@pytest.fixture
+def config(tmpdir, monkeypatch):
+    monkeypatch.setattr(main, 'scheduler', main.scheduler)
+    monkeypatch.setattr(main, 'inventory_ttl', 0)
+    path = tmpdir.join('goutte.toml')
+    path.write(CONFIG)
+    return str(path)
+
+
+def test_load(config):
+    d = daemon.Daemon(config)
+    assert d.schedules['droplets'].expression == '*/10 * * * *'
+    assert d.schedules['volumes'].expression == '0 3 * * *'
+    assert main.inventory_ttl == 60
+
+
+def test_run_ticks_due_groups(config, monkeypatch):
+    clock = mock.Clock(START)
+    ticks = []
+    d = daemon.Daemon(config, clock)
+
+    def wait(delay):
+        clock.now += timedelta(seconds=delay)
+
+    def run(conf, only, engine):
+        ticks.append((clock.now, [group for group in daemon.GROUPS
+                                  if group in conf], conf['retention']))
+        if len(ticks) == 3:
+            d.stop()
+        return 0
+    monkeypatch.setattr(d, 'wait', wait)
+    monkeypatch.setattr(main, '_run', run)
+    assert d.run() == 0
+    assert ticks == [
+        (datetime(2019, 1, 1, 3, 0), ['droplets'], 2),
+        (datetime(2019, 1, 1, 3, 0), ['volumes'], 2),
+        (datetime(2019, 1, 1, 3, 10), ['droplets'], 2),
+    ]
+
+
+def test_run_reload(config, monkeypatch, caplog):
+    clock = mock.Clock(START)
+    d = daemon.Daemon(config, clock)
+
+    def wait(delay):
+        with open(config, 'w') as f:
+            f.write('retention = 2\n[volumes]\nschedule = "5 * * * *"\n')
+        d.reload()
+        d.wait = lambda delay: d.stop()
+    monkeypatch.setattr(d, 'wait', wait)
+    with caplog.at_level('INFO'):
+        assert d.run() == 0
+    assert list(d.schedules) == ['volumes']
+    assert d.schedules['volumes'].expression == '5 * * * *'
+    assert 'Reloaded configuration' in caplog.records[0].message
+
+
+def test_run_reload_invalid_keeps_config(config, monkeypatch, caplog):
+    d = daemon.Daemon(config, mock.Clock(START))
+
+    def wait(delay):
+        with open(config, 'w') as f:
+            f.write('retention = 2\n[volumes]\nschedule = "5 * *"\n')
+        d.reload()
+        d.wait = lambda delay: d.stop()
+    monkeypatch.setattr(d, 'wait', wait)
+    with caplog.at_level('INFO'):
+        d.run()
+    assert sorted(d.schedules) == ['droplets', 'volumes']
+    assert caplog.records[0].levelname == 'CRITICAL'
+    assert caplog.records[1].message == 'Keeping the previous configuration'
+
+
+def test_load_rejects_accounts(config, caplog):
+    with open(config, 'w') as f:
+        f.write('retention = 2\n[[accounts]]\ntoken_env = "TOKEN"\n')
+    with caplog.at_level('INFO'):
+        with pytest.raises(SystemExit):
+            daemon.Daemon(config)
+    assert caplog.records[-1].levelname == 'CRITICAL'
+
+
+def test_cli_dispatches_daemon(monkeypatch):
+    calls = []
+    monkeypatch.setattr(main.sys, 'argv', ['goutte', 'daemon', 'a', 'b'])
+    monkeypatch.setattr(daemon, 'entrypoint',
+                        lambda args, prog_name: calls.append(args))
+    main.cli()
+    assert calls == [['a', 'b']]
+
+
+def test_entrypoint(config, monkeypatch):
+    monkeypatch.setattr(main, 'shared_provider', None)
+    monkeypatch.setattr(main, 'token', None)
+    monkeypatch.setattr(daemon.signal, 'signal', mock.nothing)
+    monkeypatch.setattr(daemon.Daemon, 'run', lambda self: 0)
+    monkeypatch.setattr(digitalocean, 'Manager', mock.Manager)
+    result = CliRunner().invoke(daemon.entrypoint, [config, 'token123'])
+    assert result.exit_code == 0
+    assert main.shared_provider.manager.token == 'token123'
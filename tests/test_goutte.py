@@ -1,10 +1,26 @@
+import io
+import json
+import logging
+import time
+
 from click.testing import CliRunner
 import digitalocean
 import pytest
 import toml
 
+import goutte
 from goutte import __version__
+from goutte import aio
 from goutte import main
+from goutte import profiling
+from goutte import provider
+from goutte import retention
+from goutte import sharding
+from goutte.cache import Cache
+from goutte.journal import Journal
+from goutte.provider import Resource
+from goutte.report import Report
+from goutte.scheduler import Scheduler
 from tests import mock
 
 
@@ -16,8 +32,9 @@ def test_entrypoint(caplog, monkeypatch):
     def load_config(*args):
         return {'retention': 2}
     monkeypatch.setattr(main, '_load_config', load_config)
-    monkeypatch.setattr(main, '_process_droplets', mock.nothing)
-    monkeypatch.setattr(main, '_process_volumes', mock.nothing)
+    monkeypatch.setattr(main, '_get_snapshots', mock.empty)
+    monkeypatch.setattr(main, '_process_droplets', mock.success)
+    monkeypatch.setattr(main, '_process_volumes', mock.success)
     runner = CliRunner()
     with runner.isolated_filesystem():
         with caplog.at_level('INFO'):
@@ -36,9 +53,10 @@ def test_entrypoint_debug(caplog, monkeypatch):
     def load_config(*args):
         return {'retention': 2}
     monkeypatch.setattr(main, '_load_config', load_config)
-    monkeypatch.setattr(main, '_process_droplets', mock.nothing)
-    monkeypatch.setattr(main, '_process_volumes', mock.nothing)
-    monkeypatch.setattr(main.log, 'setLevel', mock.nothing)
+    monkeypatch.setattr(main, '_get_snapshots', mock.empty)
+    monkeypatch.setattr(main, '_process_droplets', mock.success)
+    monkeypatch.setattr(main, '_process_volumes', mock.success)
+    monkeypatch.setattr(main.logger, 'setLevel', mock.nothing)
     runner = CliRunner()
     with runner.isolated_filesystem():
         with caplog.at_level('INFO'):
@@ -58,9 +76,10 @@ def test_entrypoint_only(caplog, monkeypatch):
     def load_config(*args):
         return {'retention': 2}
     monkeypatch.setattr(main, '_load_config', load_config)
-    monkeypatch.setattr(main, '_process_droplets', mock.nothing)
-    monkeypatch.setattr(main, '_process_volumes', mock.nothing)
-    monkeypatch.setattr(main.log, 'setLevel', mock.nothing)
+    monkeypatch.setattr(main, '_get_snapshots', mock.empty)
+    monkeypatch.setattr(main, '_process_droplets', mock.success)
+    monkeypatch.setattr(main, '_process_volumes', mock.success)
+    monkeypatch.setattr(main.logger, 'setLevel', mock.nothing)
     runner = CliRunner()
     with runner.isolated_filesystem():
         with caplog.at_level('INFO'):
@@ -77,6 +96,138 @@ def test_entrypoint_only(caplog, monkeypatch):
             assert caplog.records[0].levelname == 'INFO'
 
 
+def test_entrypoint_gfs_only(caplog, monkeypatch):
+    def load_config(*args):
+        return {'keep_daily': 7, 'droplets': {'keep_last': 2}}
+    monkeypatch.setattr(main, '_load_config', load_config)
+    monkeypatch.setattr(main, '_get_snapshots', mock.empty)
+    monkeypatch.setattr(main, '_process_droplets', mock.success)
+    monkeypatch.setattr(main, '_process_volumes', mock.success)
+    runner = CliRunner()
+    with runner.isolated_filesystem():
+        with caplog.at_level('DEBUG', logger='goutte'):
+            with open('test.toml', 'w') as f:
+                f.write('Hello World!')
+            result = runner.invoke(main.entrypoint, ['test.toml', 'token'])
+            assert result.exit_code == 0
+            assert ('Retention of the droplets: keep_last 2, keep_daily 7'
+                    in [record.message for record in caplog.records])
+
+
+def test_entrypoint_concurrency_error(monkeypatch):
+    confs = []
+
+    def load_config(*args):
+        return {'retention': 2, 'concurrency': 1}
+
+    def process_droplets(conf, only, snapshots, deletions, actions, taken,
+                         *args):
+        confs.append(conf)
+        return 1
+    monkeypatch.setattr(main, '_load_config', load_config)
+    monkeypatch.setattr(main, '_get_snapshots', mock.empty)
+    monkeypatch.setattr(main, '_process_droplets', process_droplets)
+    monkeypatch.setattr(main, '_process_volumes', mock.success)
+    runner = CliRunner()
+    with runner.isolated_filesystem():
+        with open('test.toml', 'w') as f:
+            f.write('Hello World!')
+        result = runner.invoke(main.entrypoint, [
+            'test.toml',
+            'token123',
+            '--concurrency', '8',
+        ])
+        assert result.exit_code == 1
+        assert confs[0]['concurrency'] == 8
+
+
+def test_entrypoint_async_engine(monkeypatch):
+    def load_config(*args):
+        return {'retention': 2}
+
+    def run(conf, only, token, scheduler):
+        return 1
+    monkeypatch.setattr(main, '_load_config', load_config)
+    monkeypatch.setattr(aio, 'run', run)
+    runner = CliRunner()
+    with runner.isolated_filesystem():
+        with open('test.toml', 'w') as f:
+            f.write('Hello World!')
+        result = runner.invoke(main.entrypoint, [
+            'test.toml',
+            'token123',
+            '--engine', 'async',
+        ])
+        assert result.exit_code == 1
+
+
+def test_entrypoint_wait(monkeypatch):
+    waited = []
+
+    def load_config(*args):
+        return {'retention': 2, 'poll_interval': 0}
+
+    def process_droplets(conf, only, snapshots, deletions, actions, taken,
+                         *args):
+        actions[1] = 'testdroplet'
+        return 0
+
+    def wait_actions(actions, timeout, interval):
+        waited.append((actions, timeout, interval))
+        return 0
+    monkeypatch.setattr(main, '_load_config', load_config)
+    monkeypatch.setattr(main, '_process_droplets', process_droplets)
+    monkeypatch.setattr(main, '_process_volumes', mock.success)
+    monkeypatch.setattr(main, '_wait_actions', wait_actions)
+    runner = CliRunner()
+    with runner.isolated_filesystem():
+        with open('test.toml', 'w') as f:
+            f.write('Hello World!')
+        result = runner.invoke(main.entrypoint, [
+            'test.toml',
+            'token123',
+            '--only', 'snapshot',
+            '--wait',
+            '--wait-timeout', '30',
+        ])
+        assert result.exit_code == 0
+    assert waited == [({1: 'testdroplet'}, 30, 0)]
+
+
+def test_entrypoint_no_cache(monkeypatch):
+    opened = []
+
+    def load_config(*args):
+        return {'retention': 2, 'cache_dir': 'cache'}
+    monkeypatch.setattr(main, '_load_config', load_config)
+    monkeypatch.setattr(main, '_open_cache', opened.append)
+    monkeypatch.setattr(main, '_run', mock.success)
+    monkeypatch.setattr(main, 'cache', None)
+    runner = CliRunner()
+    with runner.isolated_filesystem():
+        with open('test.toml', 'w') as f:
+            f.write('Hello World!')
+        for args in (['--no-cache'], []):
+            result = runner.invoke(main.entrypoint,
+                                   ['test.toml', 'token123'] + args)
+            assert result.exit_code == 0
+    assert len(opened) == 1
+
+
+def test_entrypoint_resume_needs_journal(monkeypatch):
+    def load_config(*args):
+        return {'retention': 2}
+    monkeypatch.setattr(main, '_load_config', load_config)
+    runner = CliRunner()
+    with runner.isolated_filesystem():
+        with open('test.toml', 'w') as f:
+            f.write('Hello World!')
+        result = runner.invoke(main.entrypoint,
+                               ['test.toml', 'token123', '--resume'])
+    assert result.exit_code == 2
+    assert '--resume needs a journal_file' in result.output
+
+
 def test_load_config(monkeypatch):
     def load(file):
         return {'retention': 2}
@@ -84,6 +235,51 @@ def test_load_config(monkeypatch):
     assert main._load_config(mock.File(name='test.toml'))['retention'] == 2
 
 
+def test_load_config_concurrency(caplog, monkeypatch):
+    def load(file):
+        return {'retention': 2, 'concurrency': 0}
+    monkeypatch.setattr(toml, 'load', load)
+    with caplog.at_level('INFO'):
+        with pytest.raises(SystemExit) as e:
+            main._load_config(mock.File(name='test.toml'))
+        assert caplog.records[0].levelname == 'CRITICAL'
+        assert e.value.code == 1
+
+
+def test_load_config_frequency(caplog, monkeypatch):
+    def load(file):
+        return {'retention': 2, 'droplets': {'frequency': 'monthly'}}
+    monkeypatch.setattr(toml, 'load', load)
+    with caplog.at_level('INFO'):
+        with pytest.raises(SystemExit) as e:
+            main._load_config(mock.File(name='test.toml'))
+        assert caplog.records[0].message == (
+            'Malformated configuration: frequency of droplets must be one '
+            'of hourly, daily, weekly')
+        assert e.value.code == 1
+
+
+def test_load_config_priority(caplog, monkeypatch):
+    def load(file):
+        return {'retention': 2, 'volumes': {'priority': 'high'}}
+    monkeypatch.setattr(toml, 'load', load)
+    with caplog.at_level('INFO'):
+        with pytest.raises(SystemExit):
+            main._load_config(mock.File(name='test.toml'))
+        assert caplog.records[0].message == (
+            'Malformated configuration: priority of volumes must be an '
+            'integer')
+
+
+def test_priorities():
+    assert main._priorities({}) == ['droplets', 'volumes']
+    assert main._priorities({'volumes': {'priority': 1}}) == [
+        'volumes', 'droplets']
+    assert main._priorities({'droplets': {'priority': 2},
+                             'volumes': {'priority': 1}}) == [
+        'droplets', 'volumes']
+
+
 def test_load_config_raise_typeerror(caplog, monkeypatch):
     def load(file):
         raise TypeError
@@ -110,6 +306,18 @@ def test_load_config_raise_tomldecodeerror(caplog, monkeypatch):
             assert e.value.code == 1
 
 
+def test_load_config_retention_error(caplog, monkeypatch):
+    def load(file):
+        return {'keep_daily': 0, 'droplets': {'names': ['testdroplet']}}
+    monkeypatch.setattr(toml, 'load', load)
+    with caplog.at_level('INFO'):
+        with pytest.raises(SystemExit) as e:
+            main._load_config(mock.File(name='test.toml'))
+    assert e.value.code == 1
+    assert caplog.records[-1].message == (
+        'Malformated configuration: No retention rule for droplets')
+
+
 def test_load_config_config_keyerror(caplog, monkeypatch):
     def load(file):
         return {}
@@ -124,123 +332,526 @@ def test_load_config_config_keyerror(caplog, monkeypatch):
 
 
 def test_process_droplets(caplog, monkeypatch):
-    def get_droplets(names):
+    def get_droplets(names, tags):
         return [mock.Droplet(name='testdroplet')]
     conf = {'retention': 1, 'droplets': {'names': ['testdroplet']}}
     monkeypatch.setattr(main, '_get_droplets', get_droplets)
-    monkeypatch.setattr(main, '_prune_droplet_snapshots', mock.nothing)
-    monkeypatch.setattr(main, '_snapshot_droplet', mock.nothing)
+    monkeypatch.setattr(main, '_prune', mock.nothing)
+    monkeypatch.setattr(main, '_snapshot_droplet', mock.success)
     with caplog.at_level('INFO'):
-        main._process_droplets(conf=conf, only=None)
+        main._process_droplets(conf=conf, only=None, expired={},
+                               deletions=[])
         assert len(caplog.records) == 0
 
 
 def test_process_droplets_no_vol(caplog, monkeypatch):
-    def get_droplets(names):
+    def get_droplets(names, tags):
         return []
     conf = {'retention': 1, 'droplets': {'names': ['testdroplet']}}
     monkeypatch.setattr(main, '_get_droplets', get_droplets)
-    monkeypatch.setattr(main, '_prune_droplet_snapshots', mock.nothing)
-    monkeypatch.setattr(main, '_snapshot_droplet', mock.nothing)
+    monkeypatch.setattr(main, '_prune', mock.nothing)
+    monkeypatch.setattr(main, '_snapshot_droplet', mock.success)
     with caplog.at_level('INFO'):
-        main._process_droplets(conf=conf, only=None)
+        main._process_droplets(conf=conf, only=None, expired={},
+                               deletions=[])
         assert len(caplog.records) == 1
         assert caplog.records[0].levelname == 'WARNING'
 
 
 def test_process_droplets_key_error(caplog, monkeypatch):
-    def get_droplets(names):
+    def get_droplets(names, tags):
         return [mock.Droplet(name='testdroplet')]
     conf = {'retention': 1, 'droplets': {'names': ['testdroplet2']}}
     monkeypatch.setattr(main, '_get_droplets', get_droplets)
-    monkeypatch.setattr(main, '_prune_droplet_snapshots', mock.nothing)
-    monkeypatch.setattr(main, '_snapshot_droplet', mock.nothing)
+    monkeypatch.setattr(main, '_prune', mock.nothing)
+    monkeypatch.setattr(main, '_snapshot_droplet', mock.success)
     with caplog.at_level('INFO'):
-        main._process_droplets(conf=conf, only=None)
+        main._process_droplets(conf=conf, only=None, expired={},
+                               deletions=[])
         assert len(caplog.records) == 0
 
 
 def test_process_volumes(caplog, monkeypatch):
-    def get_volumes(names):
+    def get_volumes(names, tags):
         return [mock.Volume(name='testvol')]
     conf = {'retention': 1, 'volumes': {'names': ['testvol']}}
     monkeypatch.setattr(main, '_get_volumes', get_volumes)
-    monkeypatch.setattr(main, '_prune_volume_snapshots', mock.nothing)
-    monkeypatch.setattr(main, '_snapshot_volume', mock.nothing)
+    monkeypatch.setattr(main, '_prune', mock.nothing)
+    monkeypatch.setattr(main, '_snapshot_volume', mock.success)
     with caplog.at_level('INFO'):
-        main._process_volumes(conf=conf, only=None)
+        main._process_volumes(conf=conf, only=None, expired={},
+                              deletions=[])
         assert len(caplog.records) == 0
 
 
 def test_process_volumes_no_vol(caplog, monkeypatch):
-    def get_volumes(names):
+    def get_volumes(names, tags):
         return []
     conf = {'retention': 1, 'volumes': {'names': ['testvol']}}
     monkeypatch.setattr(main, '_get_volumes', get_volumes)
-    monkeypatch.setattr(main, '_prune_volume_snapshots', mock.nothing)
-    monkeypatch.setattr(main, '_snapshot_volume', mock.nothing)
+    monkeypatch.setattr(main, '_prune', mock.nothing)
+    monkeypatch.setattr(main, '_snapshot_volume', mock.success)
     with caplog.at_level('INFO'):
-        main._process_volumes(conf=conf, only=None)
+        main._process_volumes(conf=conf, only=None, expired={},
+                              deletions=[])
         assert len(caplog.records) == 1
         assert caplog.records[0].levelname == 'WARNING'
 
 
 def test_process_volumes_key_error(caplog, monkeypatch):
-    def get_volumes(names):
+    def get_volumes(names, tags):
         return [mock.Volume(name='testvol')]
     conf = {'retention': 1, 'volumes': {'names': ['testvol2']}}
     monkeypatch.setattr(main, '_get_volumes', get_volumes)
-    monkeypatch.setattr(main, '_prune_volume_snapshots', mock.nothing)
-    monkeypatch.setattr(main, '_snapshot_volume', mock.nothing)
+    monkeypatch.setattr(main, '_prune', mock.nothing)
+    monkeypatch.setattr(main, '_snapshot_volume', mock.success)
     with caplog.at_level('INFO'):
-        main._process_volumes(conf=conf, only=None)
+        main._process_volumes(conf=conf, only=None, expired={},
+                              deletions=[])
         assert len(caplog.records) == 0
 
 
+def test_process_droplets_concurrency(caplog, monkeypatch):
+    order = []
+
+    def get_droplets(names, tags):
+        return [mock.Droplet(name=name) for name in names]
+
+    def prune(name, expired, deletions):
+        order.append(('prune', name))
+
+    def snapshot(droplet, actions, name):
+        order.append(('snapshot', droplet.name))
+        return 1 if droplet.name in ['d3', 'd1'] else 0
+    names = ['d{}'.format(i) for i in range(8)]
+    conf = {'retention': 1, 'concurrency': 4, 'droplets': {'names': names}}
+    monkeypatch.setattr(main, '_get_droplets', get_droplets)
+    monkeypatch.setattr(main, '_prune', prune)
+    monkeypatch.setattr(main, '_snapshot_droplet', snapshot)
+    with caplog.at_level('INFO'):
+        assert main._process_droplets(conf=conf, only=None,
+                                      expired={}, deletions=[]) == 1
+        assert len(caplog.records) == 1
+        assert caplog.records[0].message == 'Failed droplets: d1, d3'
+    for name in names:
+        assert order.index(('prune', name)) < order.index(('snapshot', name))
+
+
+def test_process_volumes_failure(caplog, monkeypatch):
+    snapshotted = []
+
+    def get_volumes(names, tags):
+        yield mock.Volume(name='testvol')
+        raise digitalocean.baseapi.DataReadError('Internal error')
+    conf = {'retention': 1, 'volumes': {'names': ['testvol']}}
+    monkeypatch.setattr(main, '_get_volumes', get_volumes)
+    monkeypatch.setattr(main, '_snapshot_volume', lambda volume, name:
+                        snapshotted.append(volume.name) or 0)
+    with caplog.at_level('INFO'):
+        assert main._process_volumes(conf=conf, only='snapshot', expired={},
+                                     deletions=[]) == 1
+        assert caplog.records[-1].message == (
+            'Could not read response: Internal error')
+    assert snapshotted == ['testvol']
+
+
+def test_run_pool_streams_resources():
+    listed, processed = [], []
+
+    def resources():
+        for name in ['d1', 'd2', 'd3', 'd4']:
+            listed.append(name)
+            yield mock.Droplet(name=name)
+
+    def process(droplet):
+        processed.append((droplet.name, list(listed)))
+        return droplet.name == 'd2'
+    assert main._run_pool('droplets', resources(), process, 1) == 1
+    assert 'd4' not in processed[0][1]
+    assert [name for name, _ in processed] == ['d1', 'd2', 'd3', 'd4']
+
+
+def test_run_pool_deadline(caplog, monkeypatch):
+    monkeypatch.setattr(main, 'report', Report())
+    processed = []
+
+    def process(droplet):
+        processed.append(droplet.name)
+        time.sleep(0.05)
+        return 0
+    droplets = [mock.Droplet(name=name, id=name)
+                for name in ['d1', 'd2', 'd3']]
+    with caplog.at_level('INFO'):
+        assert main._run_pool('droplets', droplets, process, 1,
+                              time.monotonic() + 0.08) == 0
+    assert processed == ['d1']
+    assert caplog.records[-1].message == (
+        'Deadline reached, deferred 2 droplets to the next run: d2, d3')
+    assert main.report.render()['totals']['deferred'] == 2
+
+
 def test_get_droplets(monkeypatch):
     monkeypatch.setattr(digitalocean, 'Manager', mock.Manager)
-    assert 'testdroplet' in main._get_droplets(['testdroplet'])[0].name
+    droplets = list(main._get_droplets(['testdroplet']))
+    assert droplets == [Resource(1, 'testdroplet')]
 
 
-def test_snapshot_droplet(caplog):
-    droplet = mock.Droplet(name='testdroplet')
+def test_get_droplets_tags(monkeypatch):
+    calls = []
+
+    class Manager(mock.Manager):
+        def get_data(self, url, params=None):
+            calls.append(params.get('tag_name'))
+            return super().get_data(url, params=params)
+    monkeypatch.setattr(digitalocean, 'Manager', Manager)
+    droplets = main._get_droplets([], ['backup'])
+    assert [droplet.name for droplet in droplets] == ['taggeddroplet']
+    assert calls == ['backup']
+
+
+def test_get_droplets_names_and_tags(caplog, monkeypatch):
+    calls = []
+
+    class Manager(mock.Manager):
+        def get_data(self, url, params=None):
+            calls.append(params.get('tag_name'))
+            return super().get_data(url, params=params)
+    monkeypatch.setattr(digitalocean, 'Manager', Manager)
+    with caplog.at_level('INFO'):
+        droplets = list(main._get_droplets(
+            ['testdroplet', 'taggeddroplet', 'missing'], ['backup']))
+        assert len(caplog.records) == 1
+        assert caplog.records[0].levelname == 'WARNING'
+        assert caplog.records[0].message.endswith(': missing')
+    assert [droplet.name for droplet in droplets] == ['testdroplet',
+                                                      'taggeddroplet']
+    assert calls == [None]
+
+
+def test_get_droplets_pages(monkeypatch):
+    pages = []
+
+    class Manager(mock.Manager):
+        droplets = [{'name': f'd{i}', 'id': i} for i in range(5)]
+
+        def get_data(self, url, params=None):
+            pages.append(params['page'])
+            return super().get_data(url, params=params)
+    monkeypatch.setattr(digitalocean, 'Manager', Manager)
+    monkeypatch.setattr(provider, 'PER_PAGE', 2)
+    droplets = main._get_droplets(['d0', 'd3', 'd4'])
+    assert next(droplets).name == 'd0'
+    assert pages == [1]
+    assert [droplet.name for droplet in droplets] == ['d3', 'd4']
+    assert pages == [1, 2, 3]
+
+
+def test_get_droplets_retries_pages(monkeypatch):
+    class Manager(mock.Manager):
+        droplets = [{'name': f'd{i}', 'id': i} for i in range(3)]
+        failed = []
+
+        def get_data(self, url, params=None):
+            if params['page'] == 2 and not self.failed:
+                self.failed.append(params['page'])
+                raise digitalocean.baseapi.DataReadError('Too many requests')
+            return super().get_data(url, params=params)
+    monkeypatch.setattr(digitalocean, 'Manager', Manager)
+    monkeypatch.setattr(main, 'scheduler', Scheduler(backoff=0))
+    monkeypatch.setattr(provider, 'PER_PAGE', 2)
+    droplets = main._get_droplets(['d0', 'd1', 'd2'])
+    assert [droplet.name for droplet in droplets] == ['d0', 'd1', 'd2']
+    assert main.scheduler.retries == 1
+
+
+def test_get_droplets_inventory_cache(monkeypatch):
+    calls = []
+
+    class Manager(mock.Manager):
+        def get_data(self, url, params=None):
+            calls.append(params.get('tag_name'))
+            return super().get_data(url, params=params)
+    monkeypatch.setattr(digitalocean, 'Manager', Manager)
+    monkeypatch.setattr(main, 'inventory', {})
+    monkeypatch.setattr(main, 'inventory_ttl', 60)
+    for _ in range(2):
+        droplets = main._get_droplets(['testdroplet'], ['backup'])
+        assert [d.name for d in droplets] == ['testdroplet', 'taggeddroplet']
+    assert calls == [None]
+
+
+def test_get_droplets_disk_cache(tmpdir, monkeypatch):
+    calls = []
+
+    class Manager(mock.Manager):
+        droplets = [{'name': 'testdroplet', 'id': 1, 'tags': ['backup']}]
+
+        def get_data(self, url, params=None):
+            calls.append(params.get('tag_name'))
+            return super().get_data(url, params=params)
+    monkeypatch.setattr(digitalocean, 'Manager', Manager)
+    monkeypatch.setattr(main, 'token', 'token123')
+    monkeypatch.setattr(main, 'cache', Cache(
+        str(tmpdir.join('goutte.sqlite')), 60))
+    for _ in range(2):
+        droplets = list(main._get_droplets(['testdroplet']))
+        assert droplets == [Resource(1, 'testdroplet')]
+    assert calls == [None]
+    main._invalidate('droplets')
+    list(main._get_droplets(['testdroplet']))
+    assert calls == [None, None]
+
+
+def test_get_droplets_interrupted_listing_is_not_cached(monkeypatch):
+    monkeypatch.setattr(digitalocean, 'Manager', mock.Manager)
+    monkeypatch.setattr(main, 'inventory', {})
+    monkeypatch.setattr(main, 'inventory_ttl', 60)
+    monkeypatch.setattr(provider, 'PER_PAGE', 1)
+    next(main._get_droplets(['testdroplet']))
+    assert main.inventory == {}
+
+
+def test_snapshot_volume_invalidates_snapshots(monkeypatch):
+    invalidated = []
+    monkeypatch.setattr(main, '_invalidate', invalidated.append)
+    monkeypatch.setattr(main, 'shared_provider', mock.memory())
+    main._snapshot_volume(mock.Volume('testvol', id='vol-1'))
+    assert invalidated == ['snapshots']
+
+
+def test_snapshot_droplet(caplog, monkeypatch):
+    memory = mock.memory()
+    monkeypatch.setattr(main, 'shared_provider', memory)
+    droplet = mock.Droplet(name='testdroplet', id=1)
     with caplog.at_level('INFO'):
         main._snapshot_droplet(droplet)
         assert len(caplog.records) == 1
         assert caplog.records[0].levelname == 'INFO'
         assert 'testdroplet' in caplog.records[0].message
+    assert [snapshot['resource_id'] for snapshot in memory.snapshots.values()
+            if snapshot['name'].startswith('goutte-testdroplet')] == ['1']
 
 
-def test_prune_droplet_snapshots(caplog, monkeypatch):
-    monkeypatch.setattr(digitalocean, 'Snapshot', mock.Snapshot)
-    droplet = mock.Droplet(name='testdroplet', snapshot_ids=['3', '2', '1'])
+def test_snapshot_droplet_error(caplog, monkeypatch):
+    monkeypatch.setattr(main, 'shared_provider', mock.memory(
+        errors={1: digitalocean.baseapi.NotFoundError('Gone')}))
     with caplog.at_level('INFO'):
-        main._prune_droplet_snapshots(droplet, 1)
-        assert len(caplog.records) == 2
-        for record in caplog.records:
-            assert record.levelname == 'INFO'
-            assert "goutte-snapshot3" not in record.message
+        assert main._snapshot_droplet(mock.Droplet('testdroplet', id=1)) == 1
+    assert caplog.records[0].message == 'Ressource not found: Gone.'
+
 
+def test_snapshot_droplet_retries_rate_limited(caplog, monkeypatch):
+    calls = []
 
-def test_prune_droplet_snapshots_goutte_prefix_only(caplog, monkeypatch):
-    monkeypatch.setattr(digitalocean, 'Snapshot', mock.Snapshot)
-    droplet = mock.Droplet(name='testdroplet', snapshot_ids=['1337', '2', '1'])
+    class Manager(mock.Manager):
+        def post(self, url, params):
+            calls.append(params['name'])
+            if len(calls) == 1:
+                raise digitalocean.baseapi.DataReadError(
+                    'API Rate limit exceeded.')
+            return {'action': {'id': 1}}
+    droplet = mock.Droplet(name='testdroplet')
+    monkeypatch.setattr(digitalocean, 'Manager', Manager)
+    monkeypatch.setattr(main, 'scheduler',
+                        Scheduler(backoff=0, sleep=mock.nothing))
     with caplog.at_level('INFO'):
-        main._prune_droplet_snapshots(droplet, 1)
+        assert main._snapshot_droplet(droplet) == 0
         assert len(caplog.records) == 1
-        for record in caplog.records:
-            assert record.levelname == 'INFO'
-            assert "snapshot1337" not in record.message
-            assert "goutte-snapshot2" not in record.message
+    assert len(calls) == 2
+    assert main.scheduler.retries == 1
+
+
+def test_snapshot_droplet_records_action(monkeypatch):
+    monkeypatch.setattr(main, 'shared_provider', mock.memory())
+    actions = {}
+    main._snapshot_droplet(mock.Droplet(name='testdroplet', id=1), actions)
+    assert actions == {1: 'testdroplet'}
+
+
+def test_snapshot_droplet_journaled(tmpdir, monkeypatch):
+    monkeypatch.setattr(main, 'token', 'token123')
+    monkeypatch.setattr(main, 'shared_provider', mock.memory())
+    monkeypatch.setattr(main, 'journal',
+                        Journal(str(tmpdir.join('journal.jsonl'))))
+    main._snapshot_droplet(mock.Droplet(name='testdroplet', id=1), {},
+                           'goutte-testdroplet')
+    assert [(line['event'], line['target'], line['snapshot'])
+            for line in map(json.loads, tmpdir.join(
+                'journal.jsonl').readlines())] == [
+        ('intent', 'droplet:1', 'goutte-testdroplet'),
+        ('done', 'droplet:1', 'goutte-testdroplet'),
+    ]
+
+
+def test_snapshot_droplet_resumed(caplog, tmpdir, monkeypatch):
+    memory = mock.memory()
+    monkeypatch.setattr(main, 'token', 'token123')
+    monkeypatch.setattr(main, 'shared_provider', memory)
+    monkeypatch.setattr(main, 'journal',
+                        Journal(str(tmpdir.join('journal.jsonl'))))
+    monkeypatch.setattr(main, 'resuming', True)
+    droplet = mock.Droplet(name='testdroplet', id=1)
+    assert main._snapshot_droplet(droplet, {}) == 0
+    actions = {}
+    with caplog.at_level('INFO'):
+        assert main._snapshot_droplet(droplet, actions) == 0
+    assert memory.calls['snapshot_droplet'] == 1
+    assert actions == {1: 'testdroplet'}
+    assert caplog.records[-1].message == (
+        f'testdroplet - Already snapshotted '
+        f'({list(memory.snapshots.values())[-1]["name"]})')
+
+
+def test_run_resumed_hourly(tmpdir, monkeypatch):
+    memory = mock.memory()
+    monkeypatch.setattr(main, 'token', 'token123')
+    monkeypatch.setattr(main, 'shared_provider', memory)
+    monkeypatch.setattr(main, 'inventory_ttl', 0)
+    monkeypatch.setattr(main, 'cache', None)
+    monkeypatch.setattr(main, 'journal',
+                        Journal(str(tmpdir.join('journal.jsonl'))))
+    monkeypatch.setattr(main, 'resuming', True)
+    conf = {'retention': 5, 'frequency': 'hourly',
+            'droplets': {'names': ['testdroplet']},
+            'volumes': {'names': ['testvol']}}
+    names = []
+    for hour in ('01', '02', '02'):
+        monkeypatch.setitem(main.FREQUENCIES, 'hourly', f'%Y%m%d{hour}')
+        assert main._run(conf, 'snapshot') == 0
+        names.append(sorted(snapshot['name'] for snapshot
+                            in memory.snapshots.values()
+                            if not snapshot['id'].isdigit()))
+    day = time.strftime('%Y%m%d')
+    assert names[0] == [f'goutte-testdroplet-{day}01',
+                        f'goutte-testvol-{day}01']
+    assert names[1] == names[2] == sorted(names[0] + [
+        f'goutte-testdroplet-{day}02', f'goutte-testvol-{day}02'])
+
+
+def test_wait_actions(caplog, monkeypatch):
+    class Manager(mock.Manager):
+        rounds = 0
+
+        def get_data(self, url, params=None):
+            Manager.rounds += 1
+            status = 'in-progress' if Manager.rounds == 1 else 'completed'
+            return {'actions': [{'id': 1, 'status': status},
+                                {'id': 2, 'status': 'errored'}]}
+    monkeypatch.setattr(digitalocean, 'Manager', Manager)
+    actions = {1: 'd1', 2: 'd2', 3: 'd3'}
+    with caplog.at_level('INFO'):
+        assert main._wait_actions(actions, 60, 0) == 1
+        assert [r.message for r in caplog.records] == [
+            'd1 - Snapshot completed',
+            'd2 - Snapshot errored',
+            'd3 - Snapshot completed',
+        ]
+    assert Manager.rounds == 2
+
+
+def test_wait_actions_timeout(caplog, monkeypatch):
+    class Manager(mock.Manager):
+        actions = [{'id': 1, 'status': 'in-progress'}]
+
+        def get_action(self, action_id):
+            return mock.Action(id=action_id, status='in-progress')
+    monkeypatch.setattr(digitalocean, 'Manager', Manager)
+    with caplog.at_level('INFO'):
+        assert main._wait_actions({1: 'd1', 2: 'd2'}, 0, 0) == 1
+        assert [r.message for r in caplog.records] == [
+            'd1 - Snapshot timed-out',
+            'd2 - Snapshot timed-out',
+        ]
+
+
+def test_prune(caplog):
+    expired = [mock.Snapshot(name=f'goutte-snapshot{snapshot_id}')
+               for snapshot_id in ['1', '2']]
+    deletions = []
+    with caplog.at_level('INFO'):
+        main._prune('testdroplet', expired, deletions)
+        assert [record.message for record in caplog.records] == [
+            'testdroplet - Prune (goutte-snapshot1)',
+            'testdroplet - Prune (goutte-snapshot2)',
+        ]
+    assert [(name, snapshot.name) for name, snapshot in deletions] == [
+        ('testdroplet', 'goutte-snapshot1'),
+        ('testdroplet', 'goutte-snapshot2'),
+    ]
+
+
+def test_get_snapshots(monkeypatch):
+    monkeypatch.setattr(digitalocean, 'Manager', mock.Manager)
+    snapshots = list(main._get_snapshots())
+    assert [s.name for s in snapshots] == ['goutte-snapshot1',
+                                           'goutte-snapshot2',
+                                           'goutte-snapshot3']
+    assert snapshots[1] == retention.Snapshot(
+        '2', 'goutte-snapshot2', 1546387200, '1', 'droplet', True)
+    assert [s.name for s in main._get_snapshots('volume')] == [
+        'goutte-snapshot3']
+
+
+def test_get_snapshots_not_profiled(monkeypatch):
+    monkeypatch.setattr(digitalocean, 'Manager', mock.Manager)
+    monkeypatch.setattr(main, '_resolve', mock.failure)
+    assert [s.name for s in main._get_snapshots('volume')] == [
+        'goutte-snapshot3']
+
+
+def test_process_droplets_uses_plan(monkeypatch):
+    pruned = []
+
+    def get_droplets(names, tags):
+        return [mock.Droplet(name='testdroplet', id=1)]
+
+    def prune(name, expired, deletions):
+        pruned.extend(expired)
+    conf = {'retention': 1, 'droplets': {'names': ['testdroplet']}}
+    monkeypatch.setattr(main, '_get_droplets', get_droplets)
+    monkeypatch.setattr(main, '_prune', prune)
+    monkeypatch.setattr(main, '_snapshot_droplet', mock.success)
+    main._process_droplets(conf=conf, only='prune',
+                           expired={'1': ['a', 'b'], '2': ['c']},
+                           deletions=[])
+    assert pruned == ['a', 'b']
+
+
+def test_run_plans_retention(monkeypatch):
+    planned = []
+
+    def process_droplets(conf, only, expired, deletions, actions, taken,
+                         *args):
+        planned.append(expired)
+        return 0
+    snapshots = [
+        mock.record(name=f'goutte-{day}', id=day,
+                    created_at=f'2019-01-0{day}T00:00:00Z')
+        for day in range(1, 4)]
+    monkeypatch.setattr(main, '_get_snapshots',
+                        lambda resource_type: iter(snapshots))
+    monkeypatch.setattr(main, '_process_droplets', process_droplets)
+    monkeypatch.setattr(main, '_process_volumes', mock.success)
+    conf = {'retention': 1, 'droplets': {'keep_daily': 2}}
+    assert main._run(conf, 'prune') == 0
+    assert planned == [{'1': [snapshots[0]]}]
 
 
 def test_get_volumes(monkeypatch):
     monkeypatch.setattr(digitalocean, 'Manager', mock.Manager)
-    assert 'testvol' in main._get_volumes(['testvol'])[0].name
+    assert [volume.name for volume in main._get_volumes(['testvol'])] == [
+        'testvol']
 
 
-def test_snapshot_volume(caplog):
-    volume = mock.Volume('testvol')
+def test_get_volumes_tags(monkeypatch):
+    monkeypatch.setattr(digitalocean, 'Manager', mock.Manager)
+    volumes = main._get_volumes(['testvol'], ['backup'])
+    assert [volume.name for volume in volumes] == ['testvol', 'taggedvol']
+
+
+def test_snapshot_volume(caplog, monkeypatch):
+    monkeypatch.setattr(main, 'shared_provider', mock.memory())
+    volume = mock.Volume('testvol', id='vol-1')
     with caplog.at_level('INFO'):
         main._snapshot_volume(volume)
         assert len(caplog.records) == 1
@@ -248,37 +859,621 @@ def test_snapshot_volume(caplog):
         assert 'testvol' in caplog.records[0].message
 
 
-def test_prune_volume_snapshots(caplog):
-    volume = mock.Volume('testvol', [
-        mock.Snapshot(name='goutte-snapshot1', created_at='2018'),
-        mock.Snapshot(name='goutte-snapshot2', created_at='2017'),
-        mock.Snapshot(name='goutte-snapshot3', created_at='2016'),
-    ])
+def test_prune_nothing(caplog):
+    deletions = []
+    with caplog.at_level('INFO'):
+        main._prune('testvol', [], deletions)
+        assert len(caplog.records) == 0
+    assert deletions == []
+
+
+def test_delete_snapshots(caplog, monkeypatch):
+    destroyed = []
+
+    class Manager(mock.Manager):
+        def delete(self, url):
+            snapshot_id = url.split('/')[1]
+            destroyed.append(snapshot_id)
+            if snapshot_id == 'gone':
+                raise digitalocean.baseapi.NotFoundError()
+            if snapshot_id == 'locked':
+                raise digitalocean.baseapi.DataReadError('Forbidden')
+            return True
+    monkeypatch.setattr(digitalocean, 'Manager', Manager)
+    deletions = [('testvol', mock.record(name=name, id=name))
+                 for name in ['s1', 'gone', 'locked', 's2']]
     with caplog.at_level('INFO'):
-        main._prune_volume_snapshots(volume, 1)
-        assert len(caplog.records) == 2
-        for record in caplog.records:
-            assert record.levelname == 'INFO'
-            assert "goutte-snapshot1" not in record.message
+        assert main._delete_snapshots(deletions, 2) == 1
+        assert caplog.records[0].levelname == 'ERROR'
+        assert 'locked' in caplog.records[0].message
+        assert caplog.records[1].message.startswith(
+            'Deleted 3/4 snapshots in ')
+    assert sorted(destroyed) == ['gone', 'locked', 's1', 's2']
+
 
+def test_delete_snapshots_resumed(tmpdir, monkeypatch):
+    destroyed = []
 
-def test_prune_volume_snapshots_goutte_prefix_only(caplog):
-    volume = mock.Volume('testvol', [
-        mock.Snapshot(name='snapshot1', created_at='2018'),
-        mock.Snapshot(name='snapshot2', created_at='2017'),
-    ])
+    class Manager(mock.Manager):
+        def delete(self, url):
+            snapshot_id = url.split('/')[1]
+            destroyed.append(snapshot_id)
+            if snapshot_id == 'locked':
+                raise digitalocean.baseapi.DataReadError('Forbidden')
+            return True
+    monkeypatch.setattr(digitalocean, 'Manager', Manager)
+    monkeypatch.setattr(main, 'token', 'token123')
+    monkeypatch.setattr(main, 'journal',
+                        Journal(str(tmpdir.join('journal.jsonl'))))
+    monkeypatch.setattr(main, 'resuming', True)
+    deletions = [('testvol', mock.record(name=name, id=name))
+                 for name in ['s1', 'locked']]
+    assert main._delete_snapshots(deletions, 2) == 1
+    assert main._delete_snapshots(deletions, 2) == 1
+    assert sorted(destroyed) == ['locked', 'locked', 's1']
+
+
+def test_delete_snapshots_nothing(caplog):
     with caplog.at_level('INFO'):
-        main._prune_volume_snapshots(volume, 1)
+        assert main._delete_snapshots([], 2) == 0
         assert len(caplog.records) == 0
 
 
-def test_order_snapshots():
-    snapshots = [
-        mock.Snapshot(created_at='2014-01-26T11:20:14Z'),
-        mock.Snapshot(created_at='2018-12-26T16:41:44Z'),
-        mock.Snapshot(created_at='2018-12-26T16:40:98Z'),
+def test_delete_snapshots_deadline(caplog, monkeypatch):
+    memory = mock.memory()
+    monkeypatch.setattr(main, 'shared_provider', memory)
+    deletions = [('testdroplet', mock.record(name='goutte-snapshot1',
+                                             id='1'))]
+    with caplog.at_level('INFO'):
+        assert main._delete_snapshots(deletions, 2, time.monotonic()) == 0
+    assert memory.calls['destroy_snapshot'] == 0
+    assert caplog.records[-1].message == (
+        'Deadline reached, deferred 1 snapshot deletions to the next run')
+
+
+def test_run_deadline_overdue_first(monkeypatch):
+    memory = mock.memory(call=main._call)
+    monkeypatch.setattr(main, 'shared_provider', memory)
+    monkeypatch.setattr(main, 'inventory_ttl', 0)
+    monkeypatch.setattr(main, 'cache', None)
+    conf = {'retention': 5, 'deadline': 3600,
+            'droplets': {'names': ['testdroplet', 'taggeddroplet']},
+            'volumes': {'names': ['testvol'], 'priority': 1}}
+    assert main._run(conf, 'snapshot') == 0
+    assert [(snapshot['resource_type'], snapshot['resource_id'])
+            for snapshot in memory.snapshots.values()][3:] == [
+        ('volume', 'vol-1'), ('droplet', '2'), ('droplet', '1')]
+    assert memory.calls['list_snapshots'] == 1
+
+
+def test_snapshot_name_frequency(monkeypatch):
+    monkeypatch.setattr(main.time, 'strftime', {
+        '%Y%m%d%H': '2018122013', '%Y%m%d': '20181220',
+        '%GW%V': '2018W51'}.get)
+    assert main._snapshot_name('web', 'hourly') == 'goutte-web-2018122013'
+    assert main._snapshot_name('web', 'daily') == 'goutte-web-20181220'
+    assert main._snapshot_name('web', 'weekly') == 'goutte-web-2018W51'
+
+
+def test_run_once_per_period(caplog, monkeypatch):
+    class Manager(mock.Manager):
+        snapshots = mock.Manager.snapshots + [
+            {'name': main._snapshot_name('testdroplet', 'daily'),
+             'id': '4', 'resource_id': 1, 'resource_type': 'droplet',
+             'created_at': '2019-01-03T00:00:00Z'}]
+
+        def post(self, url, params):
+            taken.append(params['name'])
+            return super().post(url, params)
+    taken = []
+    monkeypatch.setattr(main, 'token', 'token123')
+    monkeypatch.setattr(main, 'inventory_ttl', 0)
+    monkeypatch.setattr(main, 'cache', None)
+    monkeypatch.setattr(digitalocean, 'Manager', Manager)
+    conf = {'retention': 5, 'frequency': 'daily',
+            'droplets': {'names': ['testdroplet']},
+            'volumes': {'names': ['testvol']}}
+    with caplog.at_level('INFO'):
+        assert main._run(conf, 'snapshot') == 0
+    assert taken == [main._snapshot_name('testvol', 'daily')]
+    assert caplog.records[0].message == (
+        'testdroplet - Already snapshotted this period '
+        f'({main._snapshot_name("testdroplet", "daily")})')
+
+
+def test_run_keeps_one_provider(monkeypatch):
+    providers = []
+
+    class DigitalOcean(main.DigitalOcean):
+        def __init__(self, *args):
+            super().__init__(*args)
+            providers.append(self)
+    monkeypatch.setattr(main, 'token', 'token123')
+    monkeypatch.setattr(main, 'inventory_ttl', 0)
+    monkeypatch.setattr(main, 'cache', None)
+    monkeypatch.setattr(main, 'DigitalOcean', DigitalOcean)
+    monkeypatch.setattr(digitalocean, 'Manager', mock.Manager)
+    conf = {'retention': 1, 'concurrency': 2,
+            'droplets': {'names': ['testdroplet', 'taggeddroplet']},
+            'volumes': {'names': ['testvol']}}
+    assert main._run(conf, None) == 0
+    assert len(providers) == 1
+    assert main.shared_provider is None
+
+
+def test_run_once_per_period_listing_failed(caplog, monkeypatch):
+    def fail(resource_type=None):
+        raise digitalocean.baseapi.DataReadError('Server error')
+    memory = mock.memory()
+    monkeypatch.setattr(main, 'shared_provider', memory)
+    monkeypatch.setattr(main, 'inventory_ttl', 0)
+    monkeypatch.setattr(main, 'cache', None)
+    monkeypatch.setattr(main, '_get_snapshots', fail)
+    conf = {'retention': 5, 'droplets': {'names': ['testdroplet'],
+                                         'frequency': 'daily'},
+            'volumes': {'names': ['testvol']}}
+    with caplog.at_level('INFO'):
+        assert main._run(conf, 'snapshot') == 1
+    assert memory.calls['snapshot_droplet'] == 0
+    assert memory.calls['snapshot_volume'] == 1
+    assert ('Not snapshotting the droplets, their snapshots of this period '
+            'could not be listed') in caplog.text
+
+
+def test_run_writes_metrics(tmpdir, monkeypatch):
+    monkeypatch.setattr(main, 'token', 'token123')
+    monkeypatch.setattr(main, 'inventory_ttl', 0)
+    monkeypatch.setattr(main, 'cache', None)
+    monkeypatch.setattr(main, 'metrics', main.Metrics())
+    monkeypatch.setattr(digitalocean, 'Manager', mock.Manager)
+    path = tmpdir.join('goutte.prom')
+    conf = {'retention': 1, 'droplets': {'names': ['testdroplet']},
+            'metrics_file': str(path)}
+    assert main._run(conf, 'snapshot') == 0
+    text = path.read()
+    assert 'goutte_api_requests_total{endpoint="list_droplets"} 1' in text
+    assert 'goutte_api_requests_total{endpoint="snapshot_droplet"} 1' in text
+    assert ('goutte_stage_duration_seconds_count{kind="droplet",'
+            'stage="snapshot"} 1') in text
+    assert 'goutte_last_run_success 1' in text
+
+
+def test_entrypoint_report_json(monkeypatch):
+    memory = mock.memory(call=main._call)
+    monkeypatch.setattr(main, 'shared_provider', memory)
+    monkeypatch.setattr(main, 'report', Report())
+    monkeypatch.setattr(main, 'inventory_ttl', 0)
+    monkeypatch.setattr(main, 'cache', None)
+    runner = CliRunner()
+    with runner.isolated_filesystem():
+        with open('test.toml', 'w') as f:
+            toml.dump({'retention': 1, 'droplets': {'names': ['testdroplet']},
+                       'volumes': {'names': ['testvol']}}, f)
+        result = runner.invoke(main.entrypoint, [
+            'test.toml', 'token123', '--report-json', 'report.json'])
+        assert result.exit_code == 0
+        with open('report.json') as f:
+            report = json.load(f)
+    assert report['error'] == 0
+    assert report['totals'] == {
+        'resources': 2, 'failed': 0, 'deferred': 0,
+        'api_calls': sum(memory.calls.values()), 'snapshots': 2, 'kept': 2,
+        'deleted': 1}
+    droplet, volume = report['resources']
+    assert (droplet['name'], droplet['api_calls'], droplet['kept'],
+            droplet['deleted'], droplet['error']) == (
+        'testdroplet', 2, 1, 1, None)
+    assert droplet['snapshot'].startswith('goutte-testdroplet-')
+    assert droplet['prune_seconds'] is not None
+    assert (volume['name'], volume['api_calls'], volume['kept'],
+            volume['deleted']) == ('testvol', 1, 1, 0)
+
+
+def test_entrypoint_shard(monkeypatch):
+    memory = mock.memory()
+    monkeypatch.setattr(main, 'shared_provider', memory)
+    monkeypatch.setattr(main, 'report', Report())
+    monkeypatch.setattr(main, 'shard', None)
+    monkeypatch.setattr(main, 'inventory_ttl', 0)
+    monkeypatch.setattr(main, 'cache', None)
+    runner = CliRunner()
+    with runner.isolated_filesystem():
+        with open('test.toml', 'w') as f:
+            toml.dump({'retention': 1,
+                       'droplets': {'names': ['testdroplet'],
+                                    'tags': ['backup']},
+                       'volumes': {'names': ['testvol', 'taggedvol']}}, f)
+        result = runner.invoke(main.entrypoint, [
+            'test.toml', 'token123', '--shard', '2/2', '--report-json',
+            'report.json'])
+        assert result.exit_code == 0
+        with open('report.json') as f:
+            report = json.load(f)
+    assert main.shard == sharding.Shard(2, 2)
+    assert report['shard'] == '2/2'
+    assert [record['name'] for record in report['resources']] == [
+        'testdroplet']
+    assert sorted(memory.snapshots) == ['2', '3', 'snapshot-1']
+    assert memory.snapshots['snapshot-1']['resource_id'] == '1'
+
+
+def test_entrypoint_shard_error(monkeypatch):
+    monkeypatch.setattr(main, 'shard', None)
+    runner = CliRunner()
+    with runner.isolated_filesystem():
+        with open('test.toml', 'w') as f:
+            toml.dump({'retention': 1}, f)
+        result = runner.invoke(main.entrypoint, [
+            'test.toml', 'token123', '--shard', '3/2'])
+    assert result.exit_code == 2
+    assert 'i must be between 1 and N' in result.output
+
+
+def test_get_snapshots_shard(monkeypatch):
+    monkeypatch.setattr(main, 'shared_provider', mock.memory())
+    monkeypatch.setattr(main, 'shard', sharding.Shard(2, 2))
+    monkeypatch.setattr(main, 'inventory', {})
+    monkeypatch.setattr(main, 'inventory_ttl', 60)
+    monkeypatch.setattr(main, 'cache', None)
+    assert [s.id for s in main._get_snapshots()] == ['1', '2']
+    (key, (_, cached)), = main.inventory.items()
+    assert key == ('snapshots', 'shard2of2')
+    assert [attributes['id'] for attributes in cached] == ['1', '2']
+    monkeypatch.setattr(main, 'shard', sharding.Shard(1, 2))
+    assert [s.id for s in main._get_snapshots()] == ['3']
+    assert [d.name for d in main._get_droplets(
+        ['testdroplet', 'taggeddroplet'])] == ['taggeddroplet']
+
+
+def test_entrypoint_profile(tmpdir, monkeypatch):
+    monkeypatch.setattr(main, 'shared_provider', mock.memory(
+        call=main._call))
+    monkeypatch.setattr(main, 'inventory_ttl', 0)
+    monkeypatch.setattr(main, 'cache', None)
+    directory = tmpdir.join('profile')
+    runner = CliRunner()
+    with runner.isolated_filesystem():
+        with open('test.toml', 'w') as f:
+            toml.dump({'retention': 1, 'requests_per_minute': 6000,
+                       'droplets': {'names': ['testdroplet']}}, f)
+        result = runner.invoke(main.entrypoint, [
+            'test.toml', 'token123', '--profile', str(directory)])
+    assert result.exit_code == 0
+    assert main.profiler is None
+    assert main._profiled('list') is profiling.IDLE
+    for stage in ('list', 'resolve', 'order', 'create', 'destroy'):
+        assert directory.join(f'{stage}.pstats').check()
+        assert f'{stage}: top 10 functions by own time' in directory.join(
+            'summary.txt').read()
+    assert directory.join('goutte.pstats').check()
+
+
+def test_process_droplets_reports_errors(monkeypatch):
+    monkeypatch.setattr(main, 'shared_provider', mock.memory(
+        call=main._call,
+        errors={1: digitalocean.baseapi.NotFoundError('Gone')}))
+    monkeypatch.setattr(main, 'report', Report())
+    assert main._process_droplets(
+        {'droplets': {'names': ['testdroplet']}}, 'snapshot', {}, []) == 1
+    record = main.report.record(None, 'droplet', 1)
+    assert (record['api_calls'], record['error'], record['failed'],
+            record['snapshot']) == (1, 'NotFoundError', True, None)
+
+
+def test_json_logs(capsys):
+    formatter = goutte._JsonFormatter()
+    record = logging.LogRecord('goutte.main', logging.INFO, __file__, 1,
+                               'Snapshot %s', ('goutte-d1',), None)
+    record.account = 'staging'
+    line = json.loads(formatter.format(record))
+    assert line['message'] == 'Snapshot goutte-d1'
+    assert (line['level'], line['logger'], line['account']) == (
+        'INFO', 'goutte.main', 'staging')
+    assert line['time'].endswith('Z')
+    assert '\x1b' not in formatter.format(record)
+
+
+def plan_snapshots(resource_type=None):
+    return iter([mock.record(name=f'goutte-{day}', id=f's{day}',
+                             created_at=f'2019-01-0{day}T00:00:00Z')
+                 for day in range(1, 4)])
+
+
+def test_plan(monkeypatch):
+    monkeypatch.setattr(main, 'token', 'token123')
+    monkeypatch.setattr(main, 'inventory_ttl', 0)
+    monkeypatch.setattr(main, 'cache', None)
+    monkeypatch.setattr(main, 'scheduler', Scheduler())
+    monkeypatch.setattr(digitalocean, 'Manager', mock.Manager)
+    monkeypatch.setattr(main, '_get_snapshots', plan_snapshots)
+    conf = {'retention': 1, 'droplets': {'names': ['testdroplet']},
+            'volumes': {'names': ['testvol']}}
+    error, plan = main._plan(conf, None)
+    assert error == 0
+    assert plan['account'] == main._cache_key(())
+    assert [(s['kind'], s['id'], s['name']) for s in plan['snapshots']] == [
+        ('droplet', 1, 'testdroplet'), ('volume', 'vol-1', 'testvol')]
+    assert plan['snapshots'][0]['snapshot'].startswith('goutte-testdroplet-')
+    assert [(d['resource'], d['id']) for d in plan['deletions']] == [
+        ('testdroplet', 's1'), ('testdroplet', 's2')]
+    assert plan['requests'] == {'listing': 2, 'snapshot': 2, 'delete': 2}
+    assert plan['estimated_seconds'] >= 0
+
+
+def test_plan_only_prune(monkeypatch):
+    monkeypatch.setattr(main, '_get_snapshots', plan_snapshots)
+    monkeypatch.setattr(main, '_get_droplets',
+                        lambda names, tags: [mock.Droplet('d', id=1)])
+    error, plan = main._plan({'keep_last': 2, 'droplets': {}}, 'prune')
+    assert error == 0
+    assert plan['snapshots'] == []
+    assert [d['id'] for d in plan['deletions']] == ['s1']
+
+
+def test_entrypoint_dry_run(monkeypatch):
+    def load_config(*args):
+        return {'retention': 2}
+
+    def plan(conf, only):
+        return 0, {'snapshots': [], 'deletions': [], 'requests': {'a': 1},
+                   'estimated_seconds': 0}
+    monkeypatch.setattr(main, '_load_config', load_config)
+    monkeypatch.setattr(main, '_plan', plan)
+    monkeypatch.setattr(main, '_run', mock.failure)
+    runner = CliRunner()
+    with runner.isolated_filesystem():
+        with open('test.toml', 'w') as f:
+            f.write('Hello World!')
+        result = runner.invoke(main.entrypoint, [
+            'test.toml', 'token123', '--dry-run'])
+        assert result.exit_code == 0
+        assert json.loads(result.output)['requests'] == {'a': 1}
+        result = runner.invoke(main.entrypoint, [
+            'test.toml', 'token123', '--plan', 'plan.json',
+            '--apply', 'test.toml'])
+        assert result.exit_code == 2
+
+
+def test_apply(monkeypatch):
+    calls = []
+
+    def snapshot_droplet(droplet, actions, name):
+        calls.append(('droplet', droplet.id, droplet.name, name))
+        actions[7] = droplet.name
+        return 0
+
+    def snapshot_volume(volume, name):
+        calls.append(('volume', volume.id, volume.name, name))
+        return 0
+
+    def delete_snapshots(deletions, concurrency):
+        calls.extend(('delete', name, snapshot.id)
+                     for name, snapshot in deletions)
+        return 0
+
+    def wait_actions(actions, timeout, interval):
+        calls.append(('wait', actions))
+        return 0
+    monkeypatch.setattr(main, 'token', 'token123')
+    monkeypatch.setattr(main, '_snapshot_droplet', snapshot_droplet)
+    monkeypatch.setattr(main, '_snapshot_volume', snapshot_volume)
+    monkeypatch.setattr(main, '_delete_snapshots', delete_snapshots)
+    monkeypatch.setattr(main, '_wait_actions', wait_actions)
+    plan = {'account': main._cache_key(()), 'created_at': 'now',
+            'snapshots': [
+                {'kind': 'droplet', 'id': 1, 'name': 'd', 'snapshot': 's-d'},
+                {'kind': 'volume', 'id': 'v', 'name': 'v', 'snapshot': 's-v'},
+            ],
+            'deletions': [{'kind': 'droplet', 'resource': 'd', 'id': 's1',
+                           'name': 'goutte-1',
+                           'created_at': '2019-01-01T00:00:00Z'}]}
+    plan_file = io.StringIO(json.dumps(plan))
+    assert main._apply({'wait': True}, plan_file) == 0
+    assert calls == [('droplet', 1, 'd', 's-d'), ('volume', 'v', 'v', 's-v'),
+                     ('delete', 'd', 's1'), ('wait', {7: 'd'})]
+
+
+def test_apply_other_account(caplog, monkeypatch):
+    monkeypatch.setattr(main, 'token', 'token123')
+    monkeypatch.setattr(main, '_delete_snapshots', mock.failure)
+    plan = {'account': 'other', 'snapshots': [], 'deletions': []}
+    with caplog.at_level('INFO'):
+        assert main._apply({}, io.StringIO(json.dumps(plan))) == 1
+    assert caplog.records[-1].levelname == 'CRITICAL'
+
+
+def test_apply_malformated(caplog):
+    plan_file = mock.File(name='plan.json')
+    plan_file.read = lambda *args: '{'
+    with caplog.at_level('INFO'):
+        assert main._apply({}, plan_file) == 1
+    assert caplog.records[-1].message.startswith(
+        'Malformated plan plan.json: ')
+
+
+def test_accounts():
+    conf = {'retention': 2, 'concurrency': 4, 'droplets': {'names': ['d']},
+            'accounts': [
+                {'name': 'a', 'token_env': 'TOKEN_A',
+                 'volumes': {'names': ['v']}},
+                {'token_env': 'TOKEN_B', 'retention': 5,
+                 'droplets': {'tags': ['backup']}},
+            ]}
+    assert main._accounts(conf) == [
+        {'retention': 2, 'concurrency': 4, 'name': 'a',
+         'token_env': 'TOKEN_A', 'volumes': {'names': ['v']}},
+        {'retention': 5, 'concurrency': 4, 'name': 'account2',
+         'token_env': 'TOKEN_B', 'droplets': {'tags': ['backup']}},
     ]
-    ordered_snapshots = main._order_snapshots(snapshots)
-    assert ordered_snapshots[0].created_at == '2014-01-26T11:20:14Z'
-    assert ordered_snapshots[1].created_at == '2018-12-26T16:40:98Z'
-    assert ordered_snapshots[2].created_at == '2018-12-26T16:41:44Z'
+
+
+@pytest.mark.parametrize('accounts', [
+    [],
+    [{'name': 'a'}],
+    [{'name': 'a', 'token_env': 'A'}, {'name': 'a', 'token_env': 'B'}],
+])
+def test_accounts_invalid(accounts):
+    with pytest.raises(ValueError):
+        main._accounts({'retention': 1, 'accounts': accounts})
+
+
+def test_load_config_accounts(caplog, monkeypatch):
+    def load(file):
+        return {'accounts': [{'token_env': 'A', 'retention': 1},
+                             {'token_env': 'B'}]}
+    monkeypatch.setattr(toml, 'load', load)
+    with caplog.at_level('INFO'):
+        with pytest.raises(SystemExit):
+            main._load_config(mock.File(name='test.toml'))
+    assert caplog.records[-1].message == (
+        'Malformated configuration: No retention rule for droplets')
+
+
+def test_run_accounts(caplog, monkeypatch):
+    runs, workers = {}, {}
+
+    def run(conf, only, engine):
+        runs[conf['name']] = (main._token(), main._scheduler(), only, engine)
+        main._run_pool('droplets', [mock.Droplet(conf['name'])], worker, 1)
+        return 1 if conf['name'] == 'b' else 0
+
+    def worker(droplet):
+        workers[droplet.name] = main._token()
+        return 0
+    monkeypatch.setenv('TOKEN_A', 'token-a')
+    monkeypatch.setenv('TOKEN_B', 'token-b')
+    monkeypatch.setattr(main, '_run', run)
+    conf = {'retention': 1, 'requests_per_minute': 100, 'accounts': [
+        {'name': 'a', 'token_env': 'TOKEN_A'},
+        {'name': 'b', 'token_env': 'TOKEN_B'},
+        {'name': 'c', 'token_env': 'TOKEN_C'},
+    ]}
+    with caplog.at_level('INFO'):
+        assert main._run_accounts(conf, 'prune', 'async') == 1
+    assert sorted(runs) == ['a', 'b']
+    assert runs['a'][0] == 'token-a' and runs['b'][0] == 'token-b'
+    assert workers == {'a': 'token-a', 'b': 'token-b'}
+    assert runs['a'][1] is not runs['b'][1]
+    assert runs['a'][1].rate == pytest.approx(100 / 60)
+    assert runs['a'][2:] == ('prune', 'async')
+    summaries = [(record.levelname, record.message)
+                 for record in caplog.records[-3:]]
+    assert summaries[0][1].startswith('a - Done, 0 API requests')
+    assert summaries[1][0] == 'ERROR'
+    assert summaries[1][1].startswith('b - Failed, 0 API requests')
+    assert summaries[2] == ('ERROR', 'c - Failed, no token')
+    assert main._token() == main.token
+
+
+def test_run_accounts_sharing_a_token(caplog, monkeypatch):
+    listed, taken = [], []
+
+    class Manager(mock.Manager):
+        def get_data(self, url, type='GET', params=None):
+            if type == 'GET':
+                listed.append(url)
+            return super().get_data(url, type, params)
+
+        def post(self, url, params):
+            taken.append(url)
+            return super().post(url, params)
+    monkeypatch.setattr(digitalocean, 'Manager', Manager)
+    monkeypatch.setattr(main, 'inventory_ttl', 0)
+    monkeypatch.setattr(main, 'cache', None)
+    monkeypatch.setenv('TOKEN', 'token')
+    conf = {'retention': 1, 'accounts': [
+        {'name': name, 'token_env': 'TOKEN',
+         'droplets': {'names': ['testdroplet']}} for name in 'ab']}
+    with caplog.at_level('INFO'):
+        assert main._run_accounts(conf, 'snapshot', 'sync') == 0
+    assert listed == ['droplets/']
+    assert taken == ['droplets/1/actions/']
+    assert len([record for record in caplog.records
+                if 'testdroplet - Already snapshotted by ' in record.message
+                ]) == 1
+    assert main.coalescer is None
+
+
+def test_run_accounts_sharing_a_scheduler(monkeypatch):
+    schedulers = {}
+
+    def run(conf, only, engine):
+        schedulers[conf['name']] = main._scheduler()
+        return 0
+    monkeypatch.setenv('TOKEN', 'token')
+    monkeypatch.setenv('TOKEN_C', 'token-c')
+    monkeypatch.setattr(main, '_run', run)
+    conf = {'retention': 1, 'accounts': [
+        {'name': 'a', 'token_env': 'TOKEN'},
+        {'name': 'b', 'token_env': 'TOKEN', 'requests_per_minute': 60},
+        {'name': 'c', 'token_env': 'TOKEN_C'},
+    ]}
+    assert main._run_accounts(conf, 'prune') == 0
+    assert schedulers['a'] is schedulers['b']
+    assert schedulers['a'].rate == pytest.approx(1)
+    assert schedulers['c'] is not schedulers['a']
+
+
+def test_run_accounts_write_metrics_once(tmpdir, monkeypatch):
+    written = []
+    monkeypatch.setattr(digitalocean, 'Manager', mock.Manager)
+    monkeypatch.setattr(main, 'inventory_ttl', 0)
+    monkeypatch.setattr(main, 'cache', None)
+    monkeypatch.setattr(main, 'metrics', main.Metrics())
+    monkeypatch.setattr(main, '_write_metrics', written.append)
+    monkeypatch.setenv('TOKEN_A', 'token-a')
+    monkeypatch.setenv('TOKEN_B', 'token-b')
+    path = str(tmpdir.join('goutte.prom'))
+    conf = {'retention': 1, 'metrics_file': path, 'accounts': [
+        {'name': name, 'token_env': f'TOKEN_{name.upper()}',
+         'droplets': {'names': ['testdroplet']}} for name in 'ab']}
+    assert main._run_accounts(conf, 'snapshot', 'sync') == 0
+    assert written == [path]
+    text = main.metrics.render()
+    assert 'goutte_last_run_success{account="a"} 1' in text
+    assert 'goutte_last_run_success{account="b"} 1' in text
+
+
+def test_account_filter():
+    record = main.logging.LogRecord('goutte', 20, '', 0, '%s done',
+                                    ('snapshot',), None)
+    main._local.account = main.Account('100%s', 'token', Scheduler())
+    try:
+        assert main._AccountFilter().filter(record)
+        assert main._AccountFilter().filter(record)
+    finally:
+        main._local.account = None
+    assert record.account == '100%s'
+    assert record.getMessage() == 'snapshot done'
+    assert ' - [100%s] snapshot done' in goutte._ColoredFormatter(
+        '%(levelname)s - %(account_prefix)s%(message)s', None).format(record)
+    assert json.loads(goutte._JsonFormatter().format(record))[
+        'message'] == 'snapshot done'
+
+
+def test_entrypoint_accounts(monkeypatch):
+    def load_config(*args):
+        return {'retention': 2, 'accounts': [{'token_env': 'A'}]}
+    monkeypatch.setattr(main, '_load_config', load_config)
+    monkeypatch.setattr(main, '_run_accounts', mock.success)
+    runner = CliRunner()
+    with runner.isolated_filesystem():
+        with open('test.toml', 'w') as f:
+            f.write('Hello World!')
+        assert runner.invoke(main.entrypoint, ['test.toml']).exit_code == 0
+        result = runner.invoke(main.entrypoint, ['test.toml', '--dry-run'])
+        assert result.exit_code == 2
+
+
+def test_entrypoint_missing_token(monkeypatch):
+    def load_config(*args):
+        return {'retention': 2}
+    monkeypatch.setattr(main, '_load_config', load_config)
+    monkeypatch.delenv('GOUTTE_DO_TOKEN', raising=False)
+    runner = CliRunner()
+    with runner.isolated_filesystem():
+        with open('test.toml', 'w') as f:
+            f.write('Hello World!')
+        result = runner.invoke(main.entrypoint, ['test.toml'])
+        assert result.exit_code == 2
+        assert 'DO_TOKEN' in result.output
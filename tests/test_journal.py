@@ -0,0 +1,55 @@
+import json
+
+from goutte.journal import Journal
+from tests.mock import Clock
+
+
+def test_completed(tmpdir):
+    journal = Journal(str(tmpdir.join('sub', 'journal.jsonl')))
+    journal.intend('a', 'snapshot', 'droplet:1', snapshot='goutte-d1')
+    assert journal.completed('a', 'snapshot', 'droplet:1') is None
+    journal.complete('a', 'snapshot', 'droplet:1', snapshot='goutte-d1',
+                     action_id=7)
+    entry = journal.completed('a', 'snapshot', 'droplet:1')
+    assert entry['snapshot'] == 'goutte-d1' and entry['action_id'] == 7
+    assert journal.completed('b', 'snapshot', 'droplet:1') is None
+    assert journal.completed('a', 'destroy', 'droplet:1') is None
+    journal.close()
+
+
+def test_persistent(tmpdir):
+    path = str(tmpdir.join('journal.jsonl'))
+    journal = Journal(path)
+    journal.complete('a', 'destroy', 'snapshot:s1', name='d1')
+    journal.intend('a', 'snapshot', 'volume:v1', name='vol1')
+    journal.close()
+    journal = Journal(path)
+    assert journal.completed('a', 'destroy', 'snapshot:s1')['name'] == 'd1'
+    assert [entry['name'] for entry in journal.interrupted('a')] == ['vol1']
+    assert journal.interrupted('b') == []
+
+
+def test_skips_cut_lines(tmpdir):
+    path = tmpdir.join('journal.jsonl')
+    journal = Journal(str(path))
+    journal.complete('a', 'destroy', 'snapshot:s1')
+    journal.close()
+    path.write('{"event": "do', mode='a')
+    journal = Journal(str(path))
+    assert journal.completed('a', 'destroy', 'snapshot:s1')
+    assert journal.interrupted('a') == []
+
+
+def test_keeps_the_current_day(tmpdir):
+    clock = Clock(1545000000.0)
+    path = tmpdir.join('journal.jsonl')
+    journal = Journal(str(path), clock)
+    journal.complete('a', 'destroy', 'snapshot:s1')
+    clock.now += 86400
+    assert journal.completed('a', 'destroy', 'snapshot:s1') is None
+    journal.complete('a', 'destroy', 'snapshot:s2')
+    journal.close()
+    journal = Journal(str(path), clock)
+    assert [json.loads(line)['target']
+            for line in path.readlines()] == ['snapshot:s2']
+    journal.close()
@@ -0,0 +1,84 @@
+from concurrent.futures import ThreadPoolExecutor
+from urllib.request import urlopen
+import urllib.error
+
+import pytest
+
+from goutte import metrics
+from tests.mock import Clock
+
+
+def test_render():
+    m = metrics.Metrics()
+    m.inc('goutte_api_requests_total', endpoint='list_droplets')
+    m.inc('goutte_api_requests_total', endpoint='list_droplets')
+    m.set('goutte_last_run_success', 1)
+    m.observe('goutte_stage_duration_seconds', 0.3, stage='prune',
+              kind='droplet')
+    text = m.render()
+    assert 'goutte_api_requests_total{endpoint="list_droplets"} 2\n' in text
+    assert 'goutte_last_run_success 1\n' in text
+    assert ('goutte_stage_duration_seconds_bucket{kind="droplet",'
+            'stage="prune",le="0.25"} 0\n') in text
+    assert ('goutte_stage_duration_seconds_bucket{kind="droplet",'
+            'stage="prune",le="0.5"} 1\n') in text
+    assert ('goutte_stage_duration_seconds_count{kind="droplet",'
+            'stage="prune"} 1\n') in text
+    assert '# TYPE goutte_stage_duration_seconds histogram\n' in text
+    assert 'goutte_api_errors_total' not in text
+
+
+def test_request():
+    m = metrics.Metrics(clock=Clock(0, tick=0.2))
+    with m.request('destroy_snapshot'):
+        pass
+    with pytest.raises(KeyError):
+        with m.request('destroy_snapshot'):
+            raise KeyError()
+    text = m.render()
+    assert 'goutte_api_requests_total{endpoint="destroy_snapshot"} 2' in text
+    assert ('goutte_api_errors_total{endpoint="destroy_snapshot",'
+            'error="KeyError"} 1') in text
+    assert ('goutte_api_request_duration_seconds_sum'
+            '{endpoint="destroy_snapshot"} 0.4') in text
+
+
+def test_render_escapes_labels():
+    m = metrics.Metrics()
+    m.inc('goutte_api_errors_total', endpoint='a"b\\c')
+    assert 'endpoint="a\\"b\\\\c"' in m.render()
+
+
+def test_write(tmpdir):
+    m = metrics.Metrics()
+    m.set('goutte_last_run_success', 0)
+    path = tmpdir.join('goutte.prom')
+    m.write(str(path))
+    assert path.read() == m.render()
+    assert tmpdir.listdir() == [path]
+
+
+def test_write_in_parallel(tmpdir):
+    m = metrics.Metrics()
+    m.set('goutte_last_run_success', 1)
+    path = tmpdir.join('goutte.prom')
+    with ThreadPoolExecutor(max_workers=8) as executor:
+        list(executor.map(lambda _: m.write(str(path)), range(200)))
+    assert path.read() == m.render()
+    assert tmpdir.listdir() == [path]
+
+
+def test_serve():
+    m = metrics.Metrics()
+    m.set('goutte_last_run_success', 1)
+    server = metrics.serve(m, '127.0.0.1:0')
+    try:
+        url = 'http://127.0.0.1:{}'.format(server.server_address[1])
+        with urlopen(url + '/metrics') as response:
+            assert response.read().decode() == m.render()
+            assert response.headers['Content-Type'].startswith('text/plain')
+        with pytest.raises(urllib.error.HTTPError):
+            urlopen(url + '/other')
+    finally:
+        server.shutdown()
+        server.server_close()
@@ -0,0 +1,82 @@
+import pstats
+import threading
+import time
+
+import pytest
+
+from goutte import profiling
+from goutte.profiling import Profiler
+
+
+@pytest.fixture
+def profiler():
+    profiler = Profiler(top=3)
+    profiler.start()
+    yield profiler
+    profiler.stop()
+
+
+def test_stage_nested_counts_the_inner_stage_only(profiler):
+    with profiler.stage('order'):
+        for _ in range(2):
+            with profiler.stage('list'):
+                time.sleep(0.05)
+                with profiler.stage('list'):
+                    data = [bytes(1024) for _ in range(100)]
+        del data
+    assert dict(profiler.runs) == {'order': 1, 'list': 2}
+    assert profiler.seconds['list'] >= 0.1
+    assert profiler.seconds['order'] < 0.05
+    assert profiler.allocated['list'] >= 100 * 1024
+    assert profiler.sites['list'][0].traceback[0].filename == __file__
+
+
+def test_stage_error(profiler):
+    with pytest.raises(ValueError):
+        with profiler.stage('create'):
+            raise ValueError('failed')
+    assert profiler.runs['create'] == 1
+    assert not profiler.local.stack
+
+
+def test_write(profiler, tmpdir):
+    with profiler.stage('resolve'):
+        sorted(range(1000), key=str)
+    summary = profiler.write(str(tmpdir.join('profile')))
+    assert summary[0].split() == ['stage', 'runs', 'seconds', 'allocated',
+                                  'KiB']
+    assert summary[1].split()[:2] == ['resolve', '1']
+    stats = pstats.Stats(str(tmpdir.join('profile', 'resolve.pstats')))
+    assert any(function == "<method 'sort' of 'list' objects>" or
+               function == '<built-in method builtins.sorted>'
+               for _, _, function in stats.stats)
+    assert tmpdir.join('profile', 'goutte.pstats').check()
+    text = tmpdir.join('profile', 'summary.txt').read()
+    assert 'resolve: top 3 functions by own time' in text
+    assert 'resolve: top 3 allocation sites of its first run' in text
+
+
+def test_write_threads_in_a_stage(profiler, tmpdir, monkeypatch):
+    # From Python 3.12 a single profile can be enabled at once
+    enabled = []
+
+    def enable(profile):
+        if enabled:
+            return False
+        enabled.append(profile)
+        profile.enable()
+        return True
+    monkeypatch.setattr(profiling, '_enable', enable)
+    barrier = threading.Barrier(2)
+
+    def create():
+        with profiler.stage('create'):
+            barrier.wait()
+    threads = [threading.Thread(target=create) for _ in range(2)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    summary = profiler.write(str(tmpdir.join('profile')))
+    assert summary[1].split()[:2] == ['create', '2']
+    assert pstats.Stats(str(tmpdir.join('profile', 'create.pstats'))).stats
@@ -0,0 +1,146 @@
+import digitalocean
+
+from goutte import main
+from goutte import provider
+from goutte.provider import DigitalOcean, Memory, Result
+from goutte.scheduler import Scheduler
+from tests import mock
+
+
+def test_memory_pages(monkeypatch):
+    monkeypatch.setattr(provider, 'PER_PAGE', 2)
+    memory = Memory(droplets=[{'id': i, 'name': f'd{i}',
+                               'tags': ['backup'] if i % 2 else []}
+                              for i in range(5)])
+    assert [[droplet['id'] for droplet in page]
+            for page in memory.pages('droplets')] == [[0, 1], [2, 3], [4]]
+    assert [[droplet['id'] for droplet in page]
+            for page in memory.pages('droplets', tag_name='backup')] == [
+        [1, 3]]
+    assert list(memory.pages('volumes')) == [[]]
+    assert memory.calls == {'list_droplets': 4, 'list_volumes': 1}
+
+
+def test_memory_take_snapshot():
+    memory = mock.memory(clock=lambda: 1546300800)
+    assert memory.take_snapshot('droplet', 1, 'goutte-a') == Result(1, None)
+    assert isinstance(memory.take_snapshot('droplet', 9, 'b').error,
+                      LookupError)
+    assert memory.take_snapshot('volume', 'vol-1', 'goutte-c') == Result(
+        None, None)
+    listed = [snapshot for page in memory.pages(
+        'snapshots', resource_type='volume') for snapshot in page]
+    assert listed[-1] == {'id': 'snapshot-2', 'name': 'goutte-c',
+                          'created_at': '2019-01-01T00:00:00Z',
+                          'resource_id': 'vol-1', 'resource_type': 'volume'}
+    assert memory.poll_actions({1, 2}) == {1: 'in-progress', 2: 'errored'}
+    assert memory.poll_actions({1}) == {1: 'completed'}
+
+
+def test_memory_delete_snapshot():
+    error = Exception('Forbidden')
+    memory = mock.memory(errors={'2': error})
+    assert [memory.delete_snapshot(snapshot_id) for snapshot_id
+            in ['1', '1', '2']] == [
+        Result(True, None), Result(False, None), Result(None, error)]
+    assert sorted(memory.snapshots) == ['2', '3']
+    assert memory.calls == {'destroy_snapshot': 3}
+
+
+def test_memory_goes_through_call():
+    endpoints = []
+
+    def call(endpoint, func, *args):
+        endpoints.append(endpoint)
+        return func(*args)
+    memory = mock.memory(call=call)
+    list(memory.pages('volumes'))
+    memory.take_snapshot('volume', 'vol-1', 'goutte-c')
+    memory.delete_snapshot('1')
+    memory.poll_actions(set())
+    assert endpoints == ['list_volumes', 'snapshot_volume',
+                         'destroy_snapshot', 'poll_actions']
+
+
+def test_digitalocean_pages_retried(monkeypatch):
+    class Manager(mock.Manager):
+        droplets = [{'name': f'd{i}', 'id': i} for i in range(3)]
+        failed = []
+
+        def get_data(self, url, params=None):
+            if params['page'] == 2 and not self.failed:
+                self.failed.append(params['page'])
+                raise digitalocean.baseapi.DataReadError('Too many requests')
+            return super().get_data(url, params=params)
+    monkeypatch.setattr(digitalocean, 'Manager', Manager)
+    monkeypatch.setattr(provider, 'PER_PAGE', 2)
+    monkeypatch.setattr(main, 'scheduler', Scheduler(backoff=0))
+    pages = DigitalOcean('token123', main._call).pages('droplets')
+    assert [[droplet['id'] for droplet in page] for page in pages] == [
+        [0, 1], [2]]
+    assert main.scheduler.retries == 1
+
+
+def test_digitalocean_delete_snapshot(monkeypatch):
+    class Manager(mock.Manager):
+        def delete(self, url):
+            if url == 'snapshots/gone/':
+                raise digitalocean.baseapi.NotFoundError()
+            if url == 'snapshots/locked/':
+                raise digitalocean.baseapi.DataReadError('Forbidden')
+            return True
+    monkeypatch.setattr(digitalocean, 'Manager', Manager)
+    api = DigitalOcean('token123')
+    results = [api.delete_snapshot(snapshot_id)
+               for snapshot_id in ['s1', 'gone', 'locked']]
+    assert results[:2] == [Result(True, None), Result(False, None)]
+    assert str(results[2].error) == 'Forbidden'
+
+
+def test_digitalocean_requests_through_manager(monkeypatch):
+    managers, requests = [], []
+
+    class Manager(mock.Manager):
+        def __init__(self, token=None):
+            super().__init__(token)
+            managers.append(self)
+
+        def get_data(self, url, type='GET', params=None):
+            requests.append((type, url))
+            return super().get_data(url, type, params)
+    monkeypatch.setattr(digitalocean, 'Manager', Manager)
+    api = DigitalOcean('token123')
+    assert api.take_snapshot('droplet', 1, 'goutte-a') == Result(1, None)
+    assert api.take_snapshot('volume', 'vol-1', 'goutte-b') == Result(
+        None, None)
+    assert api.delete_snapshot('s1') == Result(True, None)
+    assert len(managers) == 1
+    assert requests == [('POST', 'droplets/1/actions/'),
+                        ('POST', 'volumes/vol-1/snapshots/'),
+                        ('DELETE', 'snapshots/s1/')]
+
+
+def test_digitalocean_poll_actions(monkeypatch):
+    class Manager(mock.Manager):
+        actions = [{'id': 1, 'status': 'completed'},
+                   {'id': 3, 'status': 'in-progress'}]
+    monkeypatch.setattr(digitalocean, 'Manager', Manager)
+    assert DigitalOcean('token123').poll_actions({1, 2, 3}) == {
+        1: 'completed', 2: 'completed', 3: 'in-progress'}
+
+
+def test_run_with_memory(monkeypatch):
+    memory = mock.memory(call=main._call)
+    monkeypatch.setattr(main, 'shared_provider', memory)
+    monkeypatch.setattr(main, 'inventory_ttl', 0)
+    monkeypatch.setattr(main, 'cache', None)
+    conf = {'retention': 1, 'concurrency': 2, 'wait': True,
+            'poll_interval': 0, 'droplets': {'names': ['testdroplet']},
+            'volumes': {'names': ['testvol']}}
+    assert main._run(conf, None) == 0
+    names = sorted(snapshot['name'] for snapshot in memory.snapshots.values())
+    assert names[:2] == ['goutte-snapshot2', 'goutte-snapshot3']
+    assert names[2].startswith('goutte-testdroplet-')
+    assert names[3].startswith('goutte-testvol-')
+    assert len(names) == 4
+    assert memory.calls['poll_actions'] == 2
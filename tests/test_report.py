@@ -0,0 +1,95 @@
+import io
+import json
+
+import pytest
+
+from goutte.report import Report, percentiles
+
+
+def clock():
+    clock.now += 1
+    return clock.now
+
+
+clock.now = 0
+
+
+def test_record():
+    report = Report()
+    record = report.record(None, 'droplet', 1)
+    assert report.record(None, 'droplet', '1', 'd1') is record
+    assert record['name'] == 'd1'
+    assert report.record('staging', 'droplet', 1) is not record
+
+
+def test_stage_counts_the_thread_requests():
+    report = Report(clock)
+    record = report.record(None, 'droplet', 1, 'd1')
+    with report.request():
+        pass
+    with report.stage(record, 'snapshot'):
+        with report.request():
+            pass
+        with pytest.raises(KeyError):
+            with report.request():
+                raise KeyError('gone')
+        report.update(snapshot='goutte-d1')
+    with report.stage(record, 'snapshot'):
+        pass
+    assert report.requests == 3
+    assert record['api_calls'] == 2
+    assert record['error'] == 'KeyError'
+    assert record['snapshot'] == 'goutte-d1'
+    assert record['snapshot_seconds'] == 2
+
+
+def test_stage_unbound():
+    report = Report()
+    record = report.record(None, 'volume', 'v1')
+    with report.stage(record, 'prune', bind=False):
+        with report.request():
+            pass
+        with report.request(record):
+            pass
+    assert record['api_calls'] == 1
+    assert record['prune_seconds'] is not None
+
+
+def test_kept():
+    report = Report()
+    report.record(None, 'droplet', 1)
+    report.record(None, 'volume', 'v1')
+    report.record('staging', 'droplet', 1)
+    report.kept(None, {'1': 3})
+    assert [record['kept'] for record in report.records.values()] == [
+        3, 0, None]
+
+
+def test_write():
+    report = Report()
+    for resource_id, name in ((2, 'd2'), (1, 'd1')):
+        record = report.record(None, 'droplet', resource_id, name)
+        with report.stage(record, 'snapshot'):
+            with report.request():
+                pass
+        report.update(record, snapshot=f'goutte-{name}')
+    report.deleted(record)
+    report.update(record, failed=True)
+    output = io.StringIO()
+    report.write(output, error=1)
+    written = json.loads(output.getvalue())
+    assert written['error'] == 1
+    assert [record['name'] for record in written['resources']] == [
+        'd1', 'd2']
+    assert written['totals'] == {'resources': 2, 'failed': 1, 'deferred': 0,
+                                 'api_calls': 2, 'snapshots': 2, 'kept': 0,
+                                 'deleted': 1}
+    assert written['percentiles']['api_calls'] == {
+        'p50': 1, 'p90': 1, 'p99': 1, 'max': 1}
+    assert written['percentiles']['prune_seconds']['max'] is None
+
+
+def test_percentiles():
+    assert percentiles(list(range(100, 0, -1))) == {
+        'p50': 50, 'p90': 90, 'p99': 99, 'max': 100}
+    assert percentiles([3]) == {'p50': 3, 'p90': 3, 'p99': 3, 'max': 3}
@@ -0,0 +1,132 @@
+import pytest
+
+from goutte import retention
+
+
+def snapshot(created_at, resource_id=1, name=None, resource_type='droplet'):
+    return retention.record({
+        'id': created_at, 'name': name or f'goutte-{created_at}',
+        'created_at': created_at, 'resource_id': resource_id,
+        'resource_type': resource_type})
+
+
+def test_record():
+    record = retention.record({
+        'id': '42', 'name': 'goutte-web-20190102-abcde',
+        'created_at': '2019-01-02T03:04:05Z', 'resource_id': 7,
+        'resource_type': 'droplet', 'regions': ['sgp1'],
+        'size_gigabytes': 1})
+    assert record == retention.Snapshot(
+        '42', 'goutte-web-20190102-abcde', 1546398245, '7', 'droplet', True)
+    assert retention.isoformat(record.created_at) == '2019-01-02T03:04:05Z'
+    assert not snapshot('2019-01-02T03:04:05Z', name='gouttelette').owned
+
+
+def test_epoch():
+    assert retention.epoch('1970-01-01T00:00:00Z') == 0
+    assert retention.epoch('2019-03-31T12:00:00Z') == 1554033600
+    with pytest.raises(ValueError):
+        retention.epoch('2019-03-31')
+
+
+@pytest.mark.parametrize('day, week', [
+    ('2019-03-24', '2019-03-18'), ('2019-03-25', '2019-03-31'),
+    ('2019-12-29', '2019-12-23'), ('2019-12-30', '2020-01-05'),
+])
+def test_weekly_periods_start_on_monday(day, week):
+    period = retention.PERIODS['keep_weekly']
+    assert period(retention.epoch(f'{day}T12:00:00Z')) == period(
+        retention.epoch(f'{week}T12:00:00Z'))
+
+
+def test_policy():
+    conf = {'retention': 7, 'keep_monthly': 6,
+            'droplets': {'keep_daily': 3}, 'volumes': {'retention': 2}}
+    assert retention.policy(conf, 'droplets') == retention.Policy(
+        keep_last=7, keep_daily=3, keep_weekly=0, keep_monthly=6)
+    assert retention.policy(conf, 'volumes') == retention.Policy(
+        keep_last=2, keep_daily=0, keep_weekly=0, keep_monthly=6)
+
+
+def test_policy_keep_last_overrides_retention():
+    conf = {'retention': 7, 'droplets': {'keep_last': 1}}
+    assert retention.policy(conf, 'droplets').keep_last == 1
+
+
+@pytest.mark.parametrize('conf', [
+    {},
+    {'keep_last': 0},
+    {'keep_daily': -1, 'keep_last': 2},
+    {'keep_weekly': '2'},
+])
+def test_policy_invalid(conf):
+    with pytest.raises(ValueError):
+        retention.policy(conf, 'droplets')
+
+
+@pytest.mark.parametrize('conf', [
+    {'keep_last': True},
+    {'keep_last': 2, 'keep_daily': False},
+])
+def test_policy_bool(conf):
+    with pytest.raises(ValueError, match='must be a non-negative integer'):
+        retention.policy(conf, 'droplets')
+
+
+def test_policy_zero():
+    assert retention.policy({'keep_last': 2, 'keep_daily': 0},
+                            'droplets').keep_daily == 0
+
+
+def test_plan_keep_last():
+    snapshots = [snapshot(f'2019-01-0{day}T00:00:00Z') for day in (2, 1, 3)]
+    policies = {'droplet': retention.Policy(2, 0, 0, 0)}
+    assert retention.plan(snapshots, policies) == {'1': [snapshots[1]]}
+
+
+def test_plan_gfs():
+    times = ['2019-03-31T12:00:00Z', '2019-03-31T06:00:00Z',
+             '2019-03-30T12:00:00Z', '2019-03-25T12:00:00Z',
+             '2019-03-20T12:00:00Z', '2019-02-27T12:00:00Z',
+             '2019-02-01T12:00:00Z', '2019-01-15T12:00:00Z']
+    snapshots = [snapshot(time) for time in times]
+    policies = {'droplet': retention.Policy(keep_last=1, keep_daily=2,
+                                            keep_weekly=2, keep_monthly=3)}
+    expired = retention.plan(snapshots, policies)['1']
+    # Kept: last (31 12h), daily (31 12h, 30), weekly (31 12h and 20 as
+    # 25 is in the same week as 31), monthly (31 12h, 27 feb, 15 jan)
+    assert [retention.isoformat(s.created_at) for s in expired] == [
+        '2019-02-01T12:00:00Z',
+        '2019-03-25T12:00:00Z',
+        '2019-03-31T06:00:00Z',
+    ]
+
+
+def test_plan_per_resource_and_type():
+    snapshots = [
+        snapshot('2019-01-01T00:00:00Z', resource_id=1),
+        snapshot('2019-01-02T00:00:00Z', resource_id=1),
+        snapshot('2019-01-01T00:00:00Z', resource_id='v', name='goutte-v1',
+                 resource_type='volume'),
+        snapshot('2019-01-02T00:00:00Z', resource_id='v', name='goutte-v2',
+                 resource_type='volume'),
+        snapshot('2019-01-03T00:00:00Z', resource_id='v', name='goutte-v3',
+                 resource_type='volume'),
+    ]
+    policies = {'droplet': retention.Policy(1, 0, 0, 0),
+                'volume': retention.Policy(0, 2, 0, 0)}
+    kept = {}
+    assert retention.plan(snapshots, policies, kept) == {
+        '1': [snapshots[0]], 'v': [snapshots[2]]}
+    assert kept == {'1': 1, 'v': 2}
+    assert retention.plan(snapshots, {'volume': policies['volume']}) == {
+        'v': [snapshots[2]]}
+
+
+def test_plan_goutte_prefix_only():
+    snapshots = [snapshot('2019-01-01T00:00:00Z', name='manual'),
+                 snapshot('2019-01-01T00:00:00Z', name='goutteless'),
+                 snapshot('2019-01-02T00:00:00Z'),
+                 snapshot('2019-01-03T00:00:00Z')]
+    policies = {'droplet': retention.Policy(1, 0, 0, 0)}
+    assert retention.plan(snapshots, policies) == {'1': [snapshots[2]]}
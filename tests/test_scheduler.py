@@ -0,0 +1,107 @@
+import digitalocean
+import pytest
+
+from goutte.scheduler import RetryableError, Scheduler, retryable
+from tests.mock import Clock
+
+
+def scheduler(**kwargs):
+    clock = Clock()
+    return Scheduler(clock=clock, sleep=clock.sleep, **kwargs), clock
+
+
+def test_reserve_burst_then_paced():
+    s, clock = scheduler(per_minute=60)
+    assert [s.reserve() for _ in range(60)] == [0] * 60
+    assert s.reserve() == pytest.approx(1)
+    assert s.reserve() == pytest.approx(2)
+    assert s.requests == 62
+    assert s.waited == pytest.approx(3)
+
+
+def test_observe_spreads_hourly_budget():
+    s, clock = scheduler(per_minute=60)
+    s.observe('10', str(clock.now + 100))
+    s.tokens = 0
+    assert s.reserve() == pytest.approx(10)
+
+
+def test_observe_keeps_the_rate_while_the_budget_lasts():
+    s, clock = scheduler(per_minute=250)
+    s.observe('4990', str(clock.now + 3600))
+    started = clock.now
+    for _ in range(1000):
+        clock.sleep(s.reserve())
+    assert clock.now - started == pytest.approx(180)
+
+
+def test_observe_exhausted_budget_waits_for_reset():
+    s, clock = scheduler(per_minute=60)
+    s.observe(0, clock.now + 30)
+    assert s.reserve() == pytest.approx(30)
+
+
+def test_estimate():
+    s, clock = scheduler(per_minute=60)
+    assert s.estimate(30) == 0
+    assert s.estimate(90) == pytest.approx(30)
+    s.observe('10', str(clock.now + 100))
+    assert s.estimate(70) == pytest.approx(100)
+
+
+def test_call_retries_throttled_requests():
+    s, clock = scheduler(backoff=1)
+    attempts = []
+
+    def throttled():
+        attempts.append(1)
+        if len(attempts) < 3:
+            raise digitalocean.baseapi.DataReadError(
+                'API Rate limit exceeded.')
+        return 'ok'
+    assert s.call(throttled) == 'ok'
+    assert s.retries == 2
+    assert s.requests == 3
+    assert 0 <= s.waited <= 3
+
+
+def test_call_gives_up_after_max_retries():
+    s, clock = scheduler(retries=2)
+
+    def throttled():
+        raise RetryableError('429')
+    with pytest.raises(RetryableError):
+        s.call(throttled)
+    assert s.retries == 2
+
+
+def test_call_does_not_retry_client_errors():
+    s, clock = scheduler()
+
+    def not_found():
+        raise digitalocean.baseapi.NotFoundError()
+    with pytest.raises(digitalocean.baseapi.NotFoundError):
+        s.call(not_found)
+    assert s.retries == 0
+
+
+def test_call_reads_ratelimit_headers():
+    s, clock = scheduler(per_minute=60)
+
+    class Manager:
+        ratelimit_remaining = '0'
+        ratelimit_reset = str(clock.now + 50)
+
+        def get(self):
+            return 'ok'
+    assert s.call(Manager().get) == 'ok'
+    assert s.reserve() == pytest.approx(50)
+
+
+def test_retryable():
+    assert retryable(digitalocean.baseapi.DataReadError(
+        'Server was unable to give you a response.'))
+    assert retryable(digitalocean.baseapi.JSONReadError('502'))
+    assert not retryable(digitalocean.baseapi.DataReadError(
+        'Unprocessable entity'))
+    assert not retryable(ValueError())
@@ -0,0 +1,40 @@
+from collections import Counter
+
+import pytest
+
+from goutte import sharding
+from goutte.sharding import Shard
+
+
+def test_parse():
+    assert sharding.parse('2/4') == Shard(2, 4)
+    assert sharding.parse('1/1') == Shard(1, 1)
+    for spec in ('0/4', '5/4', '2', 'a/b', '2/'):
+        with pytest.raises(ValueError):
+            sharding.parse(spec)
+
+
+def test_owns_one_shard_per_resource():
+    shards = [Shard(index, 3) for index in range(1, 4)]
+    for resource_id in range(100):
+        assert sum(sharding.owns(shard, 'droplet', resource_id)
+                   for shard in shards) == 1
+    assert sharding.owns(Shard(1, 1), 'volume', 'vol-1')
+
+
+def test_owner_is_stable_and_balanced():
+    owners = Counter(sharding.owner('droplet', resource_id, 4)
+                     for resource_id in range(4000))
+    assert set(owners) == {1, 2, 3, 4}
+    assert min(owners.values()) > 800
+    assert sharding.owner('droplet', 42, 4) == sharding.owner(
+        'droplet', '42', 4)
+
+
+def test_adding_a_shard_moves_few_resources():
+    moved = [(sharding.owner('volume', resource_id, 4),
+              sharding.owner('volume', resource_id, 5))
+             for resource_id in range(5000)]
+    moved = [(before, after) for before, after in moved if before != after]
+    assert all(after == 5 for _, after in moved)
+    assert 800 < len(moved) < 1200
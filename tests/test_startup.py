@@ -0,0 +1,47 @@
+import os
+import subprocess
+import sys
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Packages which must not be imported before a run needs them
+HEAVY = {'digitalocean', 'requests', 'urllib3', 'aiohttp', 'sqlite3',
+         'http'}
+
+
+def imported(args, cwd=ROOT):
+    """Run the console script under -X importtime, return the exit code
+    and the top level packages it imported
+    """
+    code = ('import sys; from goutte.main import cli; '
+            f'sys.argv = ["goutte"] + {args!r}; cli()')
+    env = dict(os.environ, PYTHONPATH=ROOT)
+    env.pop('GOUTTE_DO_TOKEN', None)
+    process = subprocess.run(
+        [sys.executable, '-X', 'importtime', '-c', code], cwd=cwd, env=env,
+        stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+        universal_newlines=True)
+    packages = {line.rsplit('|', 1)[1].strip().split('.')[0]
+                for line in process.stderr.splitlines()
+                if line.startswith('import time:') and '|' in line}
+    return process.returncode, packages
+
+
+@pytest.mark.parametrize('args', [
+    ['--version'], ['--help'], ['daemon', '--version'], ['daemon', '--help'],
+])
+def test_cli_does_not_load_the_api_client(args):
+    code, packages = imported(args)
+    assert code == 0
+    assert 'goutte' in packages and 'click' in packages
+    assert not packages & (HEAVY | {'toml', 'colorlog'})
+
+
+def test_config_validation_does_not_load_the_api_client(tmpdir):
+    tmpdir.join('goutte.toml').write('retention = -1\n')
+    code, packages = imported(['goutte.toml', 'token'], str(tmpdir))
+    assert code == 1
+    assert 'toml' in packages and 'colorlog' in packages
+    assert not packages & HEAVY